@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+'''Measure the startup time of picc.
+
+Runs bin/picc several times (by default with --version, that loads nothing
+but the command line interface) and compares the median wall time with a
+budget. It also runs it once with 'python -X importtime' and prints the
+modules that take longer to import. The exit status is 1 if the budget is
+exceeded. The arguments for picc go after '--':
+
+    python bench/startup.py -n 50 -- object1.o object2.o -o /tmp/a.hex
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+_PICC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin',
+    'picc')
+
+# Median wall time, in milliseconds, allowed for 'picc --version'
+DEFAULT_BUDGET = 60.0
+
+def run(args, runs):
+    '''Returns the wall times, in milliseconds, of several runs of picc.'''
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.check_call([sys.executable, _PICC] + args,
+                stdout=devnull)
+            times.append((time.time() - start) * 1000)
+    return times
+
+def importtimes(args):
+    '''Returns the list of (cumulative, self, module) import times in us.'''
+    with open(os.devnull, 'w') as devnull:
+        p = subprocess.Popen(
+            [sys.executable, '-X', 'importtime', _PICC] + args,
+            stdout=devnull, stderr=subprocess.PIPE)
+        _, err = p.communicate()
+    times = []
+    for line in err.decode('utf-8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            times.append((int(fields[1]), int(fields[0]), fields[2].rstrip()))
+        except ValueError:
+            # The header line
+            pass
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time '
+        'of picc.')
+    parser.add_argument('-n', '--runs', type=int, default=20,
+        help='number of runs (default: %(default)s)')
+    parser.add_argument('-b', '--budget', type=float, default=DEFAULT_BUDGET,
+        help='maximum median time in ms (default: %(default)s)')
+    parser.add_argument('-t', '--top', type=int, default=10,
+        help='number of slowest imports to show (default: %(default)s)')
+    parser.add_argument('args', nargs='*', default=['--version'],
+        help='arguments for picc (default: --version)')
+    args = parser.parse_args()
+
+    # Warm up, so that the bytecode cache is written
+    run(args.args, 1)
+    times = sorted(run(args.args, args.runs))
+    median = times[len(times) // 2]
+    print('picc {}: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms '
+        '({} runs)'.format(' '.join(args.args), median, times[0], times[-1],
+        args.runs))
+
+    imports = importtimes(args.args)
+    print('\nSlowest imports (cumulative us, self us, module):')
+    for cumulative, own, module in sorted(imports, reverse=True)[:args.top]:
+        print('{:>10} {:>10} {}'.format(cumulative, own, module))
+
+    if median > args.budget:
+        print('\nover budget: {:.1f} ms > {:.1f} ms'.format(median,
+            args.budget))
+        sys.exit(1)
+    print('\nwithin budget: {:.1f} ms <= {:.1f} ms'.format(median,
+        args.budget))
+
+if __name__ == '__main__':
+    main()
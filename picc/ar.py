@@ -41,10 +41,16 @@ def _getlongname(table, index):
     while table[i] != '/': i += 1
     return table[index:i]
 
-def extract(stream):
-    '''Extract the COFF objects from this ar file.'''
-    objects = []
-    stream.seek(_AR_MAGIC_SIZE)
+def members(stream, symbolsonly=False):
+    '''Reads the COFF objects of an ar file, one at a time.
+
+    stream: the ar file, at its beginning. It's read in a single pass, so
+        it needs not to be seekable.
+    symbolsonly: if True, only the symbols of the objects are read (see
+        coff.readcoff).
+    Yields the COFF objects as they are read.
+    '''
+    stream.read(_AR_MAGIC_SIZE)
     try:
         hdr = stream.read(_AR_HEADER_SIZE).decode('ascii')
         while len(hdr) == _AR_HEADER_SIZE:
@@ -66,26 +72,29 @@ def extract(stream):
                 if filename[0] == '/':
                     filename = _getlongname(namestable, int(filename[1:]))
                 bytestream = io.BytesIO(stream.read(size))
-                bytestream.name = stream.name
-                objects.append(coff.readcoff(bytestream))
+                # Name the member after the archive, the way binutils does
+                bytestream.name = '{}({})'.format(stream.name,
+                    filename.rstrip('/'))
+                yield coff.readcoff(bytestream, symbolsonly)
                 # If size is odd, read a padding byte
                 if size % 2:
                     stream.read(1)
             hdr = stream.read(_AR_HEADER_SIZE).decode('ascii')
         if len(hdr):
             error.fatalf(stream.name, 'truncated ar header')
-        return objects
     except (UnicodeDecodeError, ValueError, IndexError) as e:
         error.fatalf(stream.name, str(e))
 
+def extract(stream, symbolsonly=False):
+    '''Extract the COFF objects from this ar file.'''
+    return list(members(stream, symbolsonly))
+
 def isar(stream):
     '''Check if the given filename corresponds to an ar file.'''
-    current = stream.tell()
     res = False
     try:
-        magic = stream.read(_AR_MAGIC_SIZE).decode('ascii')
+        magic = coff.peek(stream, _AR_MAGIC_SIZE).decode('ascii')
         res = (magic == _AR_MAGIC)
     except UnicodeDecodeError: pass
-    stream.seek(current)
     return res
 
@@ -0,0 +1,135 @@
+'''Cache of linked programs, addressed by the contents of the link inputs.
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
+__version__ = '0.2.2'
+__license__ = 'GPL'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+DEFAULT_SIZE = 64 * 1024 * 1024
+
+_ENTRY_SUFFIX = '.hex'
+
+class LinkCache(object):
+    '''A directory with the outputs of previous links.
+
+    Each entry is named after the hash of everything that determines the
+    output of a link, so an entry never needs to be invalidated. When the
+    cache grows over its maximum size, the least recently used entries are
+    removed.
+    '''
+
+    def __init__(self, directory, maxsize=None):
+        '''Creates a cache in the given directory.
+
+        directory: where the entries are stored. Created if necessary.
+        maxsize: maximum size in bytes of all the entries together. By
+            default, DEFAULT_SIZE.
+        '''
+        self.directory = directory
+        self.maxsize = DEFAULT_SIZE if maxsize is None else maxsize
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, inputs, options, processors_file=None):
+        '''Returns the key of a link.
+
+        inputs: list with the contents (bytes) of the input files, in the
+            order they are given to the linker.
+        options: dictionary with the link options that affect the output.
+        processors_file: the processors database used by the linker.
+        '''
+        h = hashlib.sha256()
+        h.update(__version__.encode('ascii'))
+        for name in sorted(options):
+            h.update('{}={!r};'.format(name, options[name]).encode('utf-8'))
+        if processors_file is not None and os.path.isfile(processors_file):
+            with open(processors_file, 'rb') as f:
+                self._update(h, f.read())
+        for data in inputs:
+            self._update(h, data)
+        return h.hexdigest()
+
+    def _update(self, h, data):
+        # Prefix each input with its length, so that the boundaries between
+        # the inputs are also part of the key
+        h.update(struct.pack('=Q', len(data)))
+        h.update(data)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _ENTRY_SUFFIX)
+
+    def get(self, key, output):
+        '''Copies the entry with the given key to output.
+
+        Returns True if the entry was in the cache, False otherwise.
+        '''
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, output)
+        except (IOError, OSError):
+            return False
+        # Mark the entry as recently used
+        os.utime(path, None)
+        return True
+
+    def put(self, key, output):
+        '''Stores the file output in the cache with the given key.'''
+        # Copy to a temporary file first, so that concurrent links never see
+        # a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        os.close(fd)
+        shutil.copyfile(output, tmp)
+        os.rename(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        '''Removes the least recently used entries that exceed the size.'''
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(_ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,595 @@
+'''Command line interface of the picc linker.
+
+The bin/picc script only imports this module, so that its code is compiled
+once and loaded from the bytecode cache in each run. The modules needed by
+each phase are imported when the phase starts, to keep the startup fast.
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import io
+import os
+import sys
+import time
+
+import picc
+from . import error
+
+__script__ = 'picc'
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
+__version__ = '0.2.2'
+__license__ = 'GPL'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+# Options that don't change the output of a link
+_NOCACHE_OPTIONS = ['objfiles', 'output', 'cache_dir', 'cache_size', 'batch',
+    'jobs', 'delta_from', 'delta_output', 'delta_format', 'delta_manifest',
+    'erase_page', 'listing', 'simulate', 'wcet', 'loop_bounds', 'watch',
+    'watch_interval', 'error_limit', 'diagnostics_format', 'memory_report',
+    'check_symbols', 'symbol_index', 'io_threads', 'io_queue', 'timings']
+# Name of the standard input in the messages
+_STDIN_NAME = '<stdin>'
+
+def readinput(filename):
+    '''Returns the contents of an input file.
+
+    The input file is read in a single pass, so it can be a pipe. '-' is the
+    standard input.
+    '''
+    if filename == '-':
+        return getattr(sys.stdin, 'buffer', sys.stdin).read()
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def readinputs(filenames):
+    '''Returns the contents of the input files.'''
+    return [readinput(filename) for filename in filenames]
+
+def _readeach(filenames, stage):
+    '''Yields the contents of the input files, reading one at a time.'''
+    for filename in filenames:
+        start = time.time()
+        data = readinput(filename)
+        elapsed = time.time() - start
+        stage.busy += elapsed
+        stage.waited += elapsed
+        yield data
+
+def iterinputs(args, filenames, stages):
+    '''Yields the contents of the input files, as they are needed.
+
+    With --io-threads, the files are read ahead in a pool of threads.
+    stages: list where the pipeline.Stage of the reads is appended.
+    '''
+    from . import pipeline
+    if args.io_threads > 0:
+        reader = pipeline.Prefetcher(readinput, filenames, args.io_threads,
+            args.io_queue)
+        stages.append(reader.stage)
+        return iter(reader)
+    stage = pipeline.Stage('read')
+    stages.append(stage)
+    return _readeach(filenames, stage)
+
+def _consume(inputs):
+    '''Yields the items of a list, dropping each one from it.'''
+    for i in range(len(inputs)):
+        data, inputs[i] = inputs[i], None
+        yield data
+
+def parse(filename, data, symbolsonly=False):
+    '''Returns the objects contained in an input file.
+
+    The input file can be a COFF object, an ar archive of COFF objects or a
+    program in the Intel HEX format.
+    symbolsonly: if True, only the symbols of the objects are read, and the
+        HEX programs, that have none, are skipped.
+    '''
+    from . import ar, coff, ihex
+    f = io.BytesIO(data)
+    f.name = _STDIN_NAME if filename == '-' else filename
+    if ar.isar(f):
+        return ar.extract(f, symbolsonly)
+    elif ihex.ishex(f):
+        return [] if symbolsonly else [ihex.readhex(f)]
+    else:
+        return [coff.readcoff(f, symbolsonly)]
+
+def findfile(filename, libpath):
+    '''Looks for a file in the directories of libpath.'''
+    for d in libpath:
+        path = os.path.join(d, filename)
+        if os.path.isfile(path):
+            return path
+    return filename
+
+def linkoptions(args):
+    '''Returns the keyword arguments for linker.link from the arguments.'''
+    script = None
+    if args.script:
+        from . import lkr
+        defines = dict(d.split('=', 1) if '=' in d else (d, '')
+            for d in args.define)
+        script = lkr.readscript(args.script, defines)
+    return {'relax': args.relax, 'script': script, 'merge': args.merge,
+        'icf': args.icf, 'optimize_access': args.optimize_access,
+        'cluster': args.cluster, 'overlay': args.overlay,
+        'color_banks': args.color_banks,
+        # The listing and the estimations need the data of the sections
+        'release': not (args.listing or args.wcet)}
+
+def cacheoptions(args):
+    '''Returns the arguments that make a difference in the output.'''
+    return dict((k, v) for k, v in vars(args).items()
+        if k not in _NOCACHE_OPTIONS)
+
+def makedelta(args, h, processor):
+    '''Writes the erase pages that changed from a previous program.
+
+    h: the IntelHex object with the new program.
+    processor: the processor the program is for, to get the page size.
+    '''
+    import intelhex
+    from . import delta, linker
+    pagesize = args.erase_page
+    if pagesize is None:
+        pagesize = linker._loadpicinfo(processor).erasepage
+    try:
+        old = intelhex.IntelHex(args.delta_from)
+    except intelhex.IntelHexError as e:
+        error.fatalf(args.delta_from, e)
+    changed = delta.changedpages(old, h, pagesize)
+    output = args.delta_output
+    if output is None:
+        output = '{}.delta.{}'.format(os.path.splitext(args.output)[0],
+            args.delta_format)
+    manifest = args.delta_manifest
+    if manifest is None:
+        manifest = output + '.json'
+    delta.writedelta(changed, pagesize, output, args.delta_format, manifest)
+
+# The objects shared by all the variants of a batch
+_shared = []
+
+def _setshared(objects):
+    global _shared
+    _shared = objects
+
+def readbatch(filename):
+    '''Returns the list of variants described in a batch file.
+
+    The batch file is a JSON list of objects with the keys 'output'
+    (mandatory), 'processor' and 'objects' (the list of objects linked only
+    in this variant).
+    '''
+    import json
+    with open(filename) as f:
+        try:
+            variants = json.load(f)
+        except ValueError as e:
+            error.fatalf(filename, 'malformed batch file: {}'.format(e))
+    if not isinstance(variants, list):
+        error.fatalf(filename, 'malformed batch file: expected a list')
+    for v in variants:
+        if not isinstance(v, dict) or 'output' not in v:
+            error.fatalf(filename,
+                "malformed batch file: variant without 'output'")
+        v.setdefault('processor', None)
+        v.setdefault('objects', [])
+    return variants
+
+def linkvariant(variant, options):
+    '''Links a variant of a batch against copies of the shared objects.
+
+    options: the keyword arguments for linker.link.
+    Returns the number of errors found.
+    '''
+    from . import linker
+    errors = error.errors
+    objects = [o.clone() for o in _shared]
+    for filename, data in zip(variant['objects'],
+            readinputs(variant['objects'])):
+        objects.extend(parse(filename, data))
+    h = linker.link(objects, processor=variant['processor'], **options)
+    if error.errors == errors:
+        h.write_hex_file(variant['output'])
+    error.flush()
+    return error.errors - errors
+
+def linkbatch(args, objects, options):
+    '''Links all the variants of a batch.'''
+    variants = readbatch(args.batch)
+    options = [options] * len(variants)
+    if args.jobs > 1 and len(variants) > 1:
+        import concurrent.futures
+        # The objects are given to each worker once, when it starts, instead
+        # of parsed again: inherited if the workers are forked, or else
+        # pickled
+        with concurrent.futures.ProcessPoolExecutor(args.jobs,
+                initializer=_setshared, initargs=(objects,)) as pool:
+            error.errors += sum(pool.map(linkvariant, variants, options))
+    else:
+        _setshared(objects)
+        for v, o in zip(variants, options):
+            linkvariant(v, o)
+
+def simulate(h, objects, cycles):
+    '''Runs a linked program and prints the cycles spent in each symbol.'''
+    from . import disasm, sim
+    simulator = sim.Simulator(h, disasm.programlabels(objects))
+    try:
+        simulator.run(cycles)
+    except sim.SimulationError as e:
+        error.warn('simulation stopped: {}'.format(e))
+    total = simulator.cycles
+    print('{:>10} {:>6}  symbol'.format('cycles', '%'))
+    for name, c in simulator.profile():
+        print('{:>10} {:>6.1f}  {}'.format(c, 100.0 * c / total, name))
+    print('{:>10} {:>6.1f}  total'.format(total, 100.0 if total else 0.0))
+
+def estimate(objects, boundsfile):
+    '''Prints the minimum and maximum cycles of each function.'''
+    from . import disasm, wcet
+    bounds = None
+    if boundsfile:
+        bounds = wcet.readbounds(boundsfile, disasm.programlabels(objects))
+    print('{:>10} {:>10}  function'.format('min', 'max'))
+    for cost in wcet.Analyzer(objects, bounds).functions():
+        maxcycles = 'unbounded' if cost.maxcycles is None else cost.maxcycles
+        print('{:>10} {:>10}  {}'.format(cost.mincycles, maxcycles,
+            cost.name))
+        for note in cost.notes:
+            print('{:>23}{}'.format('', note))
+
+def suggestproviders(objects, database):
+    '''Tells which indexed objects define the undefined symbols.
+
+    database: the file of the picc-index database.
+    '''
+    from . import index, linker
+    if not os.path.isfile(database):
+        error.warn("symbol index {b}'{f}'{re} not found".format(b=error.BOLD,
+            re=error.RESET, f=database))
+        return
+    symbols = index.SymbolIndex(database)
+    for name in linker.undefinedsymbols(objects):
+        for obj, _, _, _ in symbols.definitions(name):
+            error.note("symbol {b}'{s}'{re} is defined in {b}'{o}'{re}".format(
+                b=error.BOLD, re=error.RESET, s=name, o=obj))
+    symbols.close()
+
+def _stamp(filename):
+    '''Returns what tells if a file has changed, or None if it's missing.'''
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size)
+
+def watch(args, objfiles, options):
+    '''Links the objects again each time that one of them changes.
+
+    Only the files that changed are read and parsed again, and each link
+    works on copies of the parsed objects. Runs until interrupted.
+    '''
+    from . import linker
+    stamps = {}
+    parsed = {}
+    while True:
+        changed = []
+        for filename in objfiles:
+            stamp = _stamp(filename)
+            if stamp != stamps.get(filename, False):
+                stamps[filename] = stamp
+                if filename not in changed:
+                    changed.append(filename)
+        if changed:
+            start = time.time()
+            error.errors = 0
+            for filename in changed:
+                parsed.pop(filename, None)
+                try:
+                    parsed[filename] = parse(filename,
+                        readinput(filename))
+                except IOError as ioe:
+                    error.warn(ioe)
+                except SystemExit:
+                    # The fatal error has been printed, wait for the next
+                    # change of the file
+                    pass
+            if all(f in parsed for f in objfiles):
+                try:
+                    objects = [o.clone() for f in objfiles for o in parsed[f]]
+                    h = linker.link(objects, **options)
+                    if not error.errors:
+                        h.write_hex_file(args.output)
+                        error.note('{} linked in {:.1f} ms ({} of {} inputs '
+                            'read)'.format(args.output,
+                            (time.time() - start) * 1000, len(changed),
+                            len(objfiles)))
+                except IOError as ioe:
+                    error.warn(ioe)
+                except SystemExit:
+                    pass
+            error.flush()
+        time.sleep(args.watch_interval)
+
+def main():
+    from . import memmap
+    parser = argparse.ArgumentParser(prog=__script__, epilog=picc.HELP_EPILOG,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('objfiles', nargs='+',
+        help='object files to link (COFF objects, archives or\n'
+             'programs in Intel HEX format)')
+    parser.add_argument('-o', '--output',
+        help='alternate name for output file', default='a.hex')
+    parser.add_argument('--no-relax', dest='relax', action='store_false',
+        help='report out of range relative branches instead of\n'
+             'redirecting them through trampolines')
+    parser.add_argument('--no-merge', dest='merge', action='store_false',
+        help='place each section on its own instead of together\n'
+             'with the sections of the same name')
+    parser.add_argument('--icf', action='store_true',
+        help='fold the identical code sections into one copy')
+    parser.add_argument('--optimize-access', action='store_true',
+        help='place the most accessed udata sections in the free\n'
+             'access RAM')
+    parser.add_argument('--cluster', action='store_true',
+        help='place together the code sections that call each\n'
+             'other')
+    parser.add_argument('--auto-overlay', dest='overlay',
+        action='store_true',
+        help='share RAM between the overlay sections of code\n'
+             'that never runs at the same time')
+    parser.add_argument('--color-banks', action='store_true',
+        help='place in the same bank the udata sections used by\n'
+             'the same code')
+    parser.add_argument('-s', '--script', metavar='FILE',
+        help='linker script with the memory regions (.lkr)')
+    parser.add_argument('-D', '--define', metavar='NAME[=VALUE]',
+        action='append', default=[],
+        help='define a name for the #IFDEF of the linker script')
+    parser.add_argument('--check-symbols', action='store_true',
+        help='only check that the symbols of the objects resolve,\n'
+             'without linking them')
+    parser.add_argument('--symbol-index', metavar='FILE',
+        help='database made by picc-index where to look for the\n'
+             'objects that define the undefined symbols')
+    parser.add_argument('--listing', metavar='FILE',
+        help='also write the disassembly of the linked program')
+    parser.add_argument('--simulate', type=int, metavar='CYCLES',
+        help='run the linked program in the simulator for this\n'
+             'number of cycles (or until SLEEP) and print the\n'
+             'cycles spent in each symbol')
+    parser.add_argument('--wcet', action='store_true',
+        help='print the minimum and maximum cycles of each\n'
+             'function of the linked program')
+    parser.add_argument('--loop-bounds', metavar='FILE',
+        help='maximum iterations of the loops, for --wcet')
+    parser.add_argument('--memory-report', nargs='?', const='text',
+        choices=memmap.FORMATS, metavar='FORMAT',
+        help='print the use of each memory region, the free holes\n'
+             'and the largest sections, as text or json (default:\n'
+             'text)')
+    parser.add_argument('--watch', action='store_true',
+        help='stay running and link again each time an input\n'
+             'file changes')
+    parser.add_argument('--watch-interval', type=float, default=0.2,
+        metavar='SECONDS',
+        help='time between checks of the input files (default:\n'
+             '0.2)')
+    parser.add_argument('--cache-dir',
+        help='reuse the output of previous links with the same\n'
+             'inputs, stored in this directory')
+    parser.add_argument('--cache-size', type=int,
+        help='maximum size in bytes of the cache directory\n'
+             '(default: 64 MiB)')
+    parser.add_argument('--delta-from', metavar='FILE',
+        help='also write the Flash erase pages that changed from\n'
+             'this previous program (HEX file)')
+    parser.add_argument('--delta-output', metavar='FILE',
+        help='file for the changed pages (default: the output\n'
+             'file with extension .delta.hex or .delta.bin)')
+    parser.add_argument('--delta-format', choices=['hex', 'bin'],
+        default='hex', help='format of the changed pages (default: hex)')
+    parser.add_argument('--delta-manifest', metavar='FILE',
+        help='JSON file with the list of changed pages (default:\n'
+             'the delta output file with extension .json added)')
+    parser.add_argument('--erase-page', type=lambda x: int(x, 0),
+        metavar='SIZE', help='size of the erase pages (default: from the\n'
+             'processors database)')
+    parser.add_argument('--batch', metavar='FILE',
+        help='link several variants of the objects, described\n'
+             'in a JSON file, instead of a single output')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of batch variants to link in parallel')
+    parser.add_argument('--io-threads', type=int, default=0, metavar='N',
+        help='read the input files ahead in N threads and write\n'
+             'the output file in the background (default: 0, read\n'
+             'and write in order)')
+    parser.add_argument('--io-queue', type=int, metavar='N',
+        default=8,
+        help='maximum number of files read ahead and of chunks\n'
+             'waiting to be written, with --io-threads (default:\n'
+             '8)')
+    parser.add_argument('--timings', action='store_true',
+        help='print the time spent reading, parsing, linking and\n'
+             'writing')
+    parser.add_argument('--error-limit', type=int, metavar='N',
+        help='stop after N errors')
+    parser.add_argument('--diagnostics-format', choices=error.FORMATS,
+        default='text',
+        help='format of the error messages (default: text)')
+    parser.add_argument('--version', action='version',
+        version=picc.VERSION_STRING)
+    args = parser.parse_args()
+    error.configure(args.error_limit, args.diagnostics_format)
+    try:
+        _link(args)
+    finally:
+        error.flush()
+
+def _link(args):
+    '''Does what the command line arguments say.'''
+    from . import linker
+    try:
+        options = linkoptions(args)
+        objfiles = args.objfiles
+        script = options['script']
+        if script is not None:
+            # Add the objects listed in the linker script
+            objfiles = objfiles + [findfile(f, script.libpath)
+                for f in script.files]
+        if args.watch:
+            if '-' in objfiles:
+                error.fatal('the standard input cannot be watched')
+            try:
+                watch(args, objfiles, options)
+            except KeyboardInterrupt:
+                pass
+            return
+        stages = []
+        inputs = iterinputs(args, objfiles, stages)
+        if args.check_symbols:
+            objects = []
+            for filename, data in zip(objfiles, inputs):
+                objects.extend(parse(filename, data, symbolsonly=True))
+            linker.checksymbols(objects)
+            if error.errors and args.symbol_index:
+                suggestproviders(objects, args.symbol_index)
+            return
+        if args.batch:
+            # The variants are only written, not analysed nor cached
+            unsupported = [name for name, used in (
+                ('--cache-dir', args.cache_dir),
+                ('--delta-from', args.delta_from),
+                ('--listing', args.listing),
+                ('--simulate', args.simulate is not None),
+                ('--wcet', args.wcet),
+                ('--memory-report', args.memory_report)) if used]
+            if unsupported:
+                error.fatal('{} cannot be used with --batch'.format(
+                    ', '.join(unsupported)))
+            objects = []
+            for filename, data in zip(objfiles, inputs):
+                objects.extend(parse(filename, data))
+            linkbatch(args, objects, options)
+            return
+        from . import pipeline
+        if args.cache_dir:
+            from . import cache
+            linkcache = cache.LinkCache(args.cache_dir, args.cache_size)
+            inputs = list(inputs)
+            keyinputs = inputs
+            if args.script:
+                keyinputs = inputs + readinputs([args.script])
+            start = time.time()
+            key = linkcache.key(keyinputs, cacheoptions(args),
+                linker._PROCESSORS_FILE)
+            stage = pipeline.Stage('hash')
+            stage.busy = stage.waited = time.time() - start
+            stages.append(stage)
+            # The listing and the analyses need the linked objects
+            hit = False
+            if (not args.listing and args.simulate is None and not args.wcet
+                    and not args.memory_report):
+                start = time.time()
+                hit = linkcache.get(key, args.output)
+                stage = pipeline.Stage('copy')
+                stage.busy = stage.waited = time.time() - start
+                stages.append(stage)
+            if hit:
+                if args.delta_from:
+                    import intelhex
+                    # The HEX inputs have no processor, nor symbols
+                    processor = linker.getprocessor(o
+                        for filename, data in zip(objfiles, inputs)
+                        for o in parse(filename, data, symbolsonly=True))
+                    makedelta(args, intelhex.IntelHex(args.output), processor)
+                if args.timings:
+                    for stage in stages:
+                        error.note(stage)
+                return
+            # The contents of each file are dropped as soon as they are
+            # parsed
+            keyinputs = None
+            inputs = _consume(inputs)
+        read = stages[0]
+        waited = read.waited
+        start = time.time()
+        objects = []
+        for filename, data in zip(objfiles, inputs):
+            objects.extend(parse(filename, data))
+        stage = pipeline.Stage('parse')
+        stage.busy = stage.waited = (time.time() - start
+            - (read.waited - waited))
+        stages.append(stage)
+        memory = None
+        if args.memory_report:
+            from . import memmap
+            memory = memmap.MemoryReport()
+        start = time.time()
+        h = linker.link(objects, memory=memory, **options)
+        stage = pipeline.Stage('link')
+        stage.busy = stage.waited = time.time() - start
+        stages.append(stage)
+        if error.errors and args.symbol_index:
+            suggestproviders(objects, args.symbol_index)
+        if not error.errors:
+            writer = None
+            if args.io_threads > 0:
+                # The file is written while the rest of the work is done
+                writer = pipeline.BackgroundWriter(args.output, args.io_queue)
+                h.write_hex_file(writer)
+                stage = writer.stage
+            else:
+                start = time.time()
+                h.write_hex_file(args.output)
+                stage = pipeline.Stage('write')
+                stage.busy = stage.waited = time.time() - start
+            stages.append(stage)
+            try:
+                if memory is not None:
+                    print(memory.tojson() if args.memory_report == 'json'
+                        else memory)
+                if args.listing:
+                    from . import disasm
+                    with open(args.listing, 'w') as f:
+                        f.write(disasm.listing(objects))
+                if args.simulate is not None:
+                    simulate(h, objects, args.simulate)
+                if args.wcet:
+                    estimate(objects, args.loop_bounds)
+            finally:
+                # The output is complete even if the analyses fail
+                if writer is not None:
+                    writer.close()
+            if args.cache_dir:
+                linkcache.put(key, args.output)
+            if args.delta_from:
+                makedelta(args, h, linker.getprocessor(objects))
+        if args.timings:
+            for stage in stages:
+                error.note(stage)
+    except IOError as ioe:
+        error.fatal(ioe)
@@ -20,7 +20,9 @@ along with picc; see the file COPYING.  If not, see
 <http://www.gnu.org/licenses/>.
 '''
 
+import binascii
 import datetime
+import io
 import struct
 from . import error
 
@@ -35,7 +37,9 @@ __status__ = 'Development'
 _BASE_TYPES = {0: 'T_NULL'}
 _C_EXT = 2
 _C_FILE = 103
+_C_LABEL = 6
 _C_SECTION = 109
+_C_STAT = 3
 _DERIVED_TYPES = {0: 'DT_NON'}
 _HDR_SIZE = 20
 _LINENO_SIZE = 16
@@ -93,14 +97,17 @@ _STYP_ABS       = 0x01000
 _STYP_ACCESS    = 0x08000
 _STYP_BSS       = 0x00080
 _STYP_DATA_ROM  = 0x00100
+_STYP_OVERLAY   = 0x04000
 _STYP_TEXT      = 0x00020
-_STYP_FLAGS = [_STYP_TEXT, _STYP_BSS, _STYP_DATA_ROM, _STYP_ACCESS, _STYP_ABS]
+_STYP_FLAGS = [_STYP_TEXT, _STYP_BSS, _STYP_DATA_ROM, _STYP_ACCESS, _STYP_ABS,
+    _STYP_OVERLAY]
 _STYP_FLAGS_STR = {
     _STYP_TEXT:     '  Executable code.',
     _STYP_BSS:      '  Uninitialized data.',
     _STYP_DATA_ROM: '  Initialized data for ROM.',
     _STYP_ACCESS:   '  Available using access bit.',
-    _STYP_ABS:      '  Absolute.'
+    _STYP_ABS:      '  Absolute.',
+    _STYP_OVERLAY:  '  Overlaid with sections of the same name.'
 }
 _SYMENT_SIZE = 20
 
@@ -115,6 +122,7 @@ class Section(object):
         self.data = []
         self.relocations = []
         self.linenumbers = []
+        self._shared = False
 
     def isabsolute(self):
         return self.flags & _STYP_ABS
@@ -131,6 +139,37 @@ class Section(object):
     def isprogramdata(self):
         return self.flags & _STYP_DATA_ROM
 
+    def isoverlay(self):
+        return self.flags & _STYP_OVERLAY
+
+    def copy(self):
+        '''Returns a copy of this section that shares its data.
+
+        The data is copied the first time it is modified, see unshare. The
+        relocations are not copied, as they refer to symbols.
+        '''
+        section = Section(self.name, self.paddress, self.vaddress, self.flags)
+        section.data = self.data
+        section.linenumbers = self.linenumbers
+        section._shared = True
+        if hasattr(self, '_size'):
+            section.size = self._size
+        return section
+
+    def unshare(self):
+        '''Makes a private copy of the data, if it's shared.'''
+        if self._shared:
+            self.data = bytearray(self.data)
+            self._shared = False
+
+    def release(self):
+        '''Frees the data, relocations and line numbers, keeping the size.'''
+        self.size = self.size
+        self.data = bytearray()
+        self.relocations = []
+        self.linenumbers = []
+        self._shared = False
+
     @property
     def size(self):
         return self._size if hasattr(self, '_size') else len(self.data)
@@ -186,6 +225,17 @@ class Section(object):
                 text.append('\n')
         return ''.join(text)
 
+    def todict(self):
+        '''Returns a dictionary with the contents of this section.'''
+        d = {'name': self.name, 'paddress': self.paddress,
+             'vaddress': self.vaddress, 'size': self.size,
+             'flags': self.flags,
+             'relocations': [r.todict() for r in self.relocations],
+             'linenumbers': [l.todict() for l in self.linenumbers]}
+        if self.iscode() or self.isprogramdata():
+            d['data'] = binascii.hexlify(bytes(self.data)).decode('ascii')
+        return d
+
 class Relocation(object):
     '''Represents a relocation entry in the COFF file.'''
 
@@ -199,6 +249,10 @@ class Relocation(object):
         return '{:<#10x} {:<10} {:<#4x} {:20} {}'.format(self.address, self.offset,
             self.reltype, _RELOC_TYPES[self.reltype], self.symbol.name)
 
+    def todict(self):
+        return {'address': self.address, 'offset': self.offset,
+                'type': _RELOC_TYPES[self.reltype], 'symbol': self.symbol.name}
+
 class Symbol(object):
     '''Represents a program's symbol.'''
 
@@ -221,7 +275,7 @@ class Symbol(object):
     def isdefined(self):
         return isinstance(self.section, Section)
 
-    def __str__(self):
+    def _sectionname(self):
         if type(self.section) == int:
             if self.section < 0:
                 section = 'DEBUG'
@@ -229,11 +283,22 @@ class Symbol(object):
                 section = 'UNDEFINED'
         else:
             section = self.section.name
+        return section
+
+    def __str__(self):
+        section = self._sectionname()
         return '{:24} {!s:16} {:<#10x} {:8} {:12} {:9} {}'.format(
             self.name, section, self.value, _BASE_TYPES[self.base_type],
             _DERIVED_TYPES[self.derived_type],
             _STORAGE_CLASSES[self.storage_class], len(self.auxsymbols))
 
+    def todict(self):
+        return {'name': self.name, 'section': self._sectionname(),
+                'value': self.value, 'type': _BASE_TYPES[self.base_type],
+                'derived_type': _DERIVED_TYPES[self.derived_type],
+                'class': _STORAGE_CLASSES[self.storage_class],
+                'aux': [a.todict() for a in self.auxsymbols]}
+
 class FileAuxSymbol(object):
     '''Represents additional information for a symbol of type C_FILE.'''
 
@@ -251,6 +316,10 @@ class FileAuxSymbol(object):
                 '      flags = {}').format(self.filename, self.incline,
                     self.flags)
 
+    def todict(self):
+        return {'file': self.filename, 'incline': self.incline,
+                'flags': self.flags}
+
 class SectionAuxSymbol(object):
     '''Represents additional information for a symbol of type C_SECTION.'''
 
@@ -268,6 +337,10 @@ class SectionAuxSymbol(object):
                '      number of line numbers = {}').format(self.sectionlen,
                    self.numreloc, self.numlinenumbers)
 
+    def todict(self):
+        return {'length': self.sectionlen, 'numreloc': self.numreloc,
+                'numlinenumbers': self.numlinenumbers}
+
 class LineNumber(object):
     '''Represents a Line Number entry in a COFF file.'''
 
@@ -282,6 +355,10 @@ class LineNumber(object):
         return '{:<8d} {:<#8x} {}'.format(self.linenumber, self.paddr,
             self.srcsymbol.auxsymbols[0].filename)
 
+    def todict(self):
+        return {'line': self.linenumber, 'address': self.paddr,
+                'file': self.srcsymbol.auxsymbols[0].filename}
+
 class Coff(object):
     '''Represents a COFF object in the Microchip format.'''
 
@@ -335,6 +412,37 @@ class Coff(object):
     def addsection(self, section):
         self.sections.append(section)
 
+    def clone(self):
+        '''Returns a copy of this object that can be linked on its own.
+
+        Linking modifies the sections, symbols and relocations of the
+        objects, so each link needs its own copies. The data of the sections
+        is only copied when the linker patches it.
+        '''
+        obj = Coff(self.filename, self.timestamp, self.flags, self.magic,
+            self.version, self.processor, self.rom_width, self.ram_width)
+        obj.strtable = self.strtable
+        sections = {}
+        for s in self.sections[1:]:
+            sections[s] = s.copy()
+            obj.addsection(sections[s])
+        symbols = {}
+        for s in self.symbols:
+            if isinstance(s, Symbol):
+                section = sections[s.section] if s.isdefined() else s.section
+                symbol = Symbol(s.name, s.value, section, s.base_type,
+                    s.derived_type, s.storage_class)
+                symbol.auxsymbols = s.auxsymbols[:]
+                symbols[s] = symbol
+                obj.addsymbol(symbol)
+            else:
+                obj.addsymbol(s)
+        for s in self.sections[1:]:
+            sections[s].relocations = [Relocation(r.address,
+                symbols.get(r.symbol, r.symbol), r.offset, r.reltype)
+                for r in s.relocations]
+        return obj
+
     def __str__(self):
         # Add the header
         text = ['COFF File and Optional Headers',
@@ -365,6 +473,19 @@ class Coff(object):
             index += 1
         return ''.join(text)
 
+    def todict(self):
+        '''Returns a dictionary with the contents of this object.
+
+        Auxiliary symbols are nested inside the symbol they belong to.
+        '''
+        return {'filename': self.filename,
+                'processor': self.processor,
+                'timestamp': self.timestamp.isoformat(),
+                'flags': self.flags,
+                'sections': [s.todict() for s in self.sections[1:]],
+                'symbols': [s.todict() for s in self.symbols
+                    if isinstance(s, Symbol)]}
+
 def _readstrtable(obj, stream, offset):
     '''Read the string table, located at the end of the COFF file.
 
@@ -509,13 +630,32 @@ def _readlinenumbers(obj, section, stream, ptr, num):
             "{idx}".format(b=error.BOLD, re=error.RESET, name=section.name,
             pos=linenum_count, idx=symindex))
 
-def readcoff(stream):
+def peek(stream, size):
+    '''Returns the next bytes of a stream without consuming them.
+
+    The streams that can't seek (like pipes) must have a peek method.
+    '''
+    if hasattr(stream, 'peek'):
+        return stream.peek(size)[:size]
+    current = stream.tell()
+    data = stream.read(size)
+    stream.seek(current)
+    return data
+
+def readcoff(stream, symbolsonly=False):
     '''Read the contents of a COFF file.
 
-    stream: from where the COFF file is read.
+    stream: from where the COFF file is read. It's read from its current
+        position to the end in a single pass, so it needs not to be
+        seekable.
+    symbolsonly: if True, only the headers and the symbols table are read,
+        the sections have their sizes but not their data, relocations and
+        line numbers.
     Return a Coff object with the contents of the COFF file.
     '''
     filename = stream.name
+    if not isinstance(stream, io.BytesIO):
+        stream = io.BytesIO(stream.read())
     try:
         # Read filehdr
         where = 'header'
@@ -559,7 +699,8 @@ def readcoff(stream):
                     b=error.BOLD, re=error.RESET, name=name))
             # For the udata section, set size attribure. For the others, read
             # the raw data
-            if section.isudata():
+            if section.isudata() or (symbolsonly and (section.iscode()
+                    or section.isprogramdata())):
                 section.size = s_size
             elif section.iscode() or section.isprogramdata():
                 cur = stream.tell()
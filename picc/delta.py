@@ -0,0 +1,119 @@
+'''Compare two programs by Flash erase pages.
+
+Reflashing only the erase pages that changed between two builds is much
+faster than writing the whole program. The images are split in pages of the
+size of the erase blocks of the processor, and the pages are compared by
+their hashes.
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+import hashlib
+import json
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
+__version__ = '0.2.2'
+__license__ = 'GPL'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+# Value of the erased Flash memory
+_ERASED = 0xff
+
+FORMATS = ['hex', 'bin']
+
+def pages(ih, pagesize):
+    '''Splits an IntelHex object in pages.
+
+    Only the pages that contain data are returned, the rest of the memory
+    is considered erased.
+    Returns a dictionary from the address of each page to its contents.
+    '''
+    result = {}
+    for address, value in ih.todict().items():
+        # Skip the start address record
+        if not isinstance(address, int):
+            continue
+        start = address - address % pagesize
+        page = result.get(start)
+        if page is None:
+            page = result[start] = bytearray([_ERASED] * pagesize)
+        page[address - start] = value
+    return result
+
+def pagehashes(image):
+    '''Returns a dictionary with the hash of each page of an image.'''
+    return dict((start, hashlib.sha1(bytes(page)).hexdigest())
+        for start, page in image.items())
+
+def changedpages(old, new, pagesize):
+    '''Returns the pages of new that are different in old.
+
+    old, new: the IntelHex objects of the previous and current programs.
+    pagesize: the size of the erase pages.
+    Returns a sorted list of tuples (address, contents, hash) of the pages
+    that must be written to program new over old. The pages that have data
+    in old but are empty in new are returned erased.
+    '''
+    oldpages = pages(old, pagesize)
+    newpages = pages(new, pagesize)
+    oldhashes = pagehashes(oldpages)
+    newhashes = pagehashes(newpages)
+    erased = bytearray([_ERASED] * pagesize)
+    erasedhash = hashlib.sha1(bytes(erased)).hexdigest()
+    changed = []
+    for start in sorted(set(oldhashes) | set(newhashes)):
+        oldhash = oldhashes.get(start, erasedhash)
+        newhash = newhashes.get(start, erasedhash)
+        if oldhash != newhash:
+            changed.append((start, newpages.get(start, erased), newhash))
+    return changed
+
+def writedelta(changed, pagesize, output, fmt, manifest):
+    '''Writes the changed pages and their manifest.
+
+    changed: the list returned by changedpages.
+    pagesize: the size of the erase pages.
+    output: the file where the pages are written.
+    fmt: 'hex' to write an Intel HEX file with the pages, 'bin' to write
+        them one after the other.
+    manifest: the file where the JSON manifest of the pages is written. It
+        contains the address, hash and offset in a binary output of each
+        page.
+    '''
+    entries = []
+    if fmt == 'hex':
+        import intelhex
+        ih = intelhex.IntelHex()
+        for start, page, digest in changed:
+            ih.puts(start, bytes(page))
+            entries.append({'address': start, 'sha1': digest})
+        ih.write_hex_file(output)
+    else:
+        with open(output, 'wb') as f:
+            for start, page, digest in changed:
+                entries.append({'address': start, 'offset': f.tell(),
+                    'sha1': digest})
+                f.write(page)
+    with open(manifest, 'w') as f:
+        json.dump({'pagesize': pagesize, 'format': fmt, 'output': output,
+            'pages': entries}, f, indent=2, sort_keys=True)
+        f.write('\n')
@@ -0,0 +1,350 @@
+'''Disassemble the code of the PIC18 microcontrollers.
+
+The instructions are decoded with a table that has an entry for each of the
+65536 possible values of a program word, so decoding a word is a single
+lookup. The table is built the first time it's needed.
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+from . import coff
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
+__version__ = '0.2.2'
+__license__ = 'GPL'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+# Operand formats
+_NONE = 0
+_FDA = 1        # File register, destination and access bit
+_FA = 2         # File register and access bit
+_BFA = 3        # File register, bit and access bit
+_N8 = 4         # 8 bits relative branch
+_N11 = 5        # 11 bits relative branch
+_K8 = 6         # 8 bits literal
+_K4 = 7         # 4 bits literal (MOVLB)
+_S = 8          # Fast register stack bit (RETURN, RETFIE)
+_CALL = 9       # Two words, 20 bits address and s bit
+_GOTO = 10      # Two words, 20 bits address
+_LFSR = 11      # Two words, FSR number and 12 bits literal
+_MOVFF = 12     # Two words, 12 bits source and destination
+
+_TWO_WORDS = (_CALL, _GOTO, _LFSR, _MOVFF)
+
+# Opcode, mask, mnemonic and format of each instruction
+_INSTRUCTIONS = [
+    (0x0000, 0xffff, 'nop', _NONE),
+    (0x0003, 0xffff, 'sleep', _NONE),
+    (0x0004, 0xffff, 'clrwdt', _NONE),
+    (0x0005, 0xffff, 'push', _NONE),
+    (0x0006, 0xffff, 'pop', _NONE),
+    (0x0007, 0xffff, 'daw', _NONE),
+    (0x0008, 0xffff, 'tblrd*', _NONE),
+    (0x0009, 0xffff, 'tblrd*+', _NONE),
+    (0x000a, 0xffff, 'tblrd*-', _NONE),
+    (0x000b, 0xffff, 'tblrd+*', _NONE),
+    (0x000c, 0xffff, 'tblwt*', _NONE),
+    (0x000d, 0xffff, 'tblwt*+', _NONE),
+    (0x000e, 0xffff, 'tblwt*-', _NONE),
+    (0x000f, 0xffff, 'tblwt+*', _NONE),
+    (0x00ff, 0xffff, 'reset', _NONE),
+    (0x0010, 0xfffe, 'retfie', _S),
+    (0x0012, 0xfffe, 'return', _S),
+    (0x0100, 0xfff0, 'movlb', _K4),
+    (0x0200, 0xfe00, 'mulwf', _FA),
+    (0x0400, 0xfc00, 'decf', _FDA),
+    (0x0800, 0xff00, 'sublw', _K8),
+    (0x0900, 0xff00, 'iorlw', _K8),
+    (0x0a00, 0xff00, 'xorlw', _K8),
+    (0x0b00, 0xff00, 'andlw', _K8),
+    (0x0c00, 0xff00, 'retlw', _K8),
+    (0x0d00, 0xff00, 'mullw', _K8),
+    (0x0e00, 0xff00, 'movlw', _K8),
+    (0x0f00, 0xff00, 'addlw', _K8),
+    (0x1000, 0xfc00, 'iorwf', _FDA),
+    (0x1400, 0xfc00, 'andwf', _FDA),
+    (0x1800, 0xfc00, 'xorwf', _FDA),
+    (0x1c00, 0xfc00, 'comf', _FDA),
+    (0x2000, 0xfc00, 'addwfc', _FDA),
+    (0x2400, 0xfc00, 'addwf', _FDA),
+    (0x2800, 0xfc00, 'incf', _FDA),
+    (0x2c00, 0xfc00, 'decfsz', _FDA),
+    (0x3000, 0xfc00, 'rrcf', _FDA),
+    (0x3400, 0xfc00, 'rlcf', _FDA),
+    (0x3800, 0xfc00, 'swapf', _FDA),
+    (0x3c00, 0xfc00, 'incfsz', _FDA),
+    (0x4000, 0xfc00, 'rrncf', _FDA),
+    (0x4400, 0xfc00, 'rlncf', _FDA),
+    (0x4800, 0xfc00, 'infsnz', _FDA),
+    (0x4c00, 0xfc00, 'dcfsnz', _FDA),
+    (0x5000, 0xfc00, 'movf', _FDA),
+    (0x5400, 0xfc00, 'subfwb', _FDA),
+    (0x5800, 0xfc00, 'subwfb', _FDA),
+    (0x5c00, 0xfc00, 'subwf', _FDA),
+    (0x6000, 0xfe00, 'cpfslt', _FA),
+    (0x6200, 0xfe00, 'cpfseq', _FA),
+    (0x6400, 0xfe00, 'cpfsgt', _FA),
+    (0x6600, 0xfe00, 'tstfsz', _FA),
+    (0x6800, 0xfe00, 'setf', _FA),
+    (0x6a00, 0xfe00, 'clrf', _FA),
+    (0x6c00, 0xfe00, 'negf', _FA),
+    (0x6e00, 0xfe00, 'movwf', _FA),
+    (0x7000, 0xf000, 'btg', _BFA),
+    (0x8000, 0xf000, 'bsf', _BFA),
+    (0x9000, 0xf000, 'bcf', _BFA),
+    (0xa000, 0xf000, 'btfss', _BFA),
+    (0xb000, 0xf000, 'btfsc', _BFA),
+    (0xc000, 0xf000, 'movff', _MOVFF),
+    (0xd000, 0xf800, 'bra', _N11),
+    (0xd800, 0xf800, 'rcall', _N11),
+    (0xe000, 0xff00, 'bz', _N8),
+    (0xe100, 0xff00, 'bnz', _N8),
+    (0xe200, 0xff00, 'bc', _N8),
+    (0xe300, 0xff00, 'bnc', _N8),
+    (0xe400, 0xff00, 'bov', _N8),
+    (0xe500, 0xff00, 'bnov', _N8),
+    (0xe600, 0xff00, 'bn', _N8),
+    (0xe700, 0xff00, 'bnn', _N8),
+    (0xec00, 0xfe00, 'call', _CALL),
+    (0xee00, 0xffc0, 'lfsr', _LFSR),
+    (0xef00, 0xff00, 'goto', _GOTO),
+    # Also the second word of the two words instructions
+    (0xf000, 0xf000, 'nop', _NONE),
+]
+
+_TABLE = None
+
+def _gettable():
+    '''Returns the decoding table, building it the first time.
+
+    The entry of each word is a tuple (mnemonic, format), or None if the
+    word is not a valid instruction.
+    '''
+    global _TABLE
+    if _TABLE is None:
+        table = [None] * 0x10000
+        for opcode, mask, mnemonic, fmt in _INSTRUCTIONS:
+            # Go through all the values of the bits out of the mask
+            free = ~mask & 0xffff
+            bits = free
+            while True:
+                table[opcode | bits] = (mnemonic, fmt)
+                if not bits:
+                    break
+                bits = (bits - 1) & free
+        _TABLE = table
+    return _TABLE
+
+def _signed(value, bits):
+    '''Interprets value as a two's complement number of the given bits.'''
+    if value & (1 << (bits - 1)):
+        value -= 1 << bits
+    return value
+
+class Instruction(object):
+    '''A decoded instruction.'''
+
+    def __init__(self, address, words, mnemonic, operands, target=None):
+        '''Creates an instruction.
+
+        address: the program address of the instruction.
+        words: the list of words of the instruction (one or two).
+        mnemonic: the name of the instruction, or None if the word is not a
+            valid instruction.
+        operands: the text of the operands.
+        target: the program address where the instruction jumps or calls,
+            if any.
+        '''
+        self.address = address
+        self.words = words
+        self.mnemonic = mnemonic
+        self.operands = operands
+        self.target = target
+
+    @property
+    def size(self):
+        return 2 * len(self.words)
+
+def _operands(fmt, address, word, second):
+    '''Returns the text of the operands of an instruction and its target.'''
+    a = ('ACCESS', 'BANKED')[(word >> 8) & 1]
+    f = word & 0xff
+    if fmt == _FDA:
+        return '{:#04x}, {}, {}'.format(f, 'WF'[(word >> 9) & 1], a), None
+    elif fmt == _FA:
+        return '{:#04x}, {}'.format(f, a), None
+    elif fmt == _BFA:
+        return '{:#04x}, {}, {}'.format(f, (word >> 9) & 7, a), None
+    elif fmt in (_N8, _N11):
+        n = _signed(word & 0xff, 8) if fmt == _N8 else _signed(word & 0x7ff,
+            11)
+        target = address + 2 + 2 * n
+        return '{:#08x}'.format(target), target
+    elif fmt == _K8:
+        return '{:#04x}'.format(f), None
+    elif fmt == _K4:
+        return '{:#x}'.format(word & 0xf), None
+    elif fmt == _S:
+        return '{}'.format(word & 1), None
+    elif fmt in (_CALL, _GOTO):
+        target = ((second & 0xfff) << 8 | f) << 1
+        if fmt == _CALL:
+            return '{:#08x}, {}'.format(target, (word >> 8) & 1), target
+        return '{:#08x}'.format(target), target
+    elif fmt == _LFSR:
+        return '{}, {:#05x}'.format((word >> 4) & 3,
+            (word & 0xf) << 8 | second & 0xff), None
+    elif fmt == _MOVFF:
+        return '{:#05x}, {:#05x}'.format(word & 0xfff, second & 0xfff), None
+    return '', None
+
+def decode(data, address=0):
+    '''Decodes the instructions of a block of program memory.
+
+    data: the bytes of the program memory.
+    address: the program address of the first byte.
+    Yields an Instruction for each instruction in data. The words that are
+    not valid instructions and the two words instructions without a valid
+    second word are returned with None as mnemonic.
+    '''
+    table = _gettable()
+    data = bytearray(data)
+    end = len(data) - 1
+    index = 0
+    while index < end:
+        word = data[index] | data[index + 1] << 8
+        entry = table[word]
+        words = [word]
+        second = None
+        if entry is not None and entry[1] in _TWO_WORDS:
+            if index + 2 < end:
+                second = data[index + 2] | data[index + 3] << 8
+            if second is None or second & 0xf000 != 0xf000:
+                entry = None
+            else:
+                words.append(second)
+        if entry is None:
+            yield Instruction(address + index, [word], None,
+                '{:#06x}'.format(word))
+            index += 2
+            continue
+        mnemonic, fmt = entry
+        operands, target = _operands(fmt, address + index, word, second)
+        yield Instruction(address + index, words, mnemonic, operands, target)
+        index += 2 * len(words)
+
+def labels(objects):
+    '''Returns the names of the code symbols of some objects by address.
+
+    The addresses are the ones of the symbols in the sections where they
+    are placed, so for linked objects they are program addresses.
+    Returns a dictionary from section to a dictionary from address to the
+    list of names of the symbols at that address.
+    '''
+    result = {}
+    for o in objects:
+        for s in o.symbols:
+            if (not isinstance(s, coff.Symbol) or not s.isdefined()
+                    or not s.section.iscode()
+                    or s.storage_class in (coff._C_SECTION, coff._C_FILE)):
+                continue
+            address = s.value
+            if not s.section.isabsolute():
+                address += s.section.paddress
+            result.setdefault(s.section, {}).setdefault(address, []).append(
+                s.name)
+    return result
+
+def programlabels(objects):
+    '''Returns the names of the code symbols of some linked objects.
+
+    Returns a dictionary from program address to the list of names of the
+    symbols at that address.
+    '''
+    result = {}
+    for sectionlabels in labels(objects).values():
+        for address, names in sectionlabels.items():
+            result.setdefault(address, []).extend(names)
+    return result
+
+def _symbolname(names):
+    return ', '.join(sorted(names))
+
+def disassemble(section, labels=None, alllabels=None):
+    '''Returns the disassembly of a code section.
+
+    section: the code section to disassemble.
+    labels: dictionary from address to the names of the symbols in this
+        section (see the function labels).
+    alllabels: dictionary from program address to the names of the symbols
+        of all the sections, to show the names of the targets of jumps and
+        calls out of the section.
+    Returns the text with one line for each instruction. The instructions
+    with relocations show the symbol they refer to.
+    '''
+    labels = labels or {}
+    alllabels = alllabels or labels
+    relocs = {}
+    for r in section.relocations:
+        name = r.symbol.name
+        if r.offset:
+            name += '{:+#x}'.format(r.offset)
+        relocs.setdefault(r.address, []).append(name)
+    base = section.paddress
+    text = []
+    for i in decode(section.data, base):
+        names = labels.get(i.address)
+        if names:
+            text.append('{}:\n'.format(_symbolname(names)))
+        line = '  {:06x}:  {:<10} {:<8} {}'.format(i.address,
+            ' '.join('{:04x}'.format(w) for w in i.words),
+            i.mnemonic or 'dw', i.operands).rstrip()
+        comment = []
+        # The relocations of both words of an instruction use to point to
+        # the same symbol
+        for address in range(i.address, i.address + i.size):
+            for name in relocs.get(address - base, []):
+                if name not in comment:
+                    comment.append(name)
+        if not comment and i.target is not None and i.target in alllabels:
+            comment.append(_symbolname(alllabels[i.target]))
+        if comment:
+            line = '{:<48} ; {}'.format(line, ', '.join(comment))
+        text.append(line + '\n')
+    return ''.join(text)
+
+def listing(objects):
+    '''Returns the disassembly of all the code of some linked objects.
+
+    The code sections are shown by address.
+    '''
+    bysection = labels(objects)
+    alllabels = programlabels(objects)
+    sections = [(s.paddress, s.name, o.filename, s) for o in objects
+        for s in o.sections[1:] if s.iscode() and s.size]
+    sections.sort(key=lambda x: x[:3])
+    text = []
+    for address, name, filename, s in sections:
+        text.append('\nDisassembly of section {} ({}):\n\n'.format(name,
+            filename))
+        text.append(disassemble(s, bysection.get(s), alllabels))
+    return ''.join(text).lstrip('\n')
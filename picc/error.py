@@ -1,6 +1,10 @@
 
 '''Print error messages.
 
+By default the messages are printed as they come. After configure, they
+are kept in memory, the repeated ones are counted only once, and flush
+writes them all at once, sorted by file and position.
+
 Copyright 2016 Antonio Serrano Hernandez
 
 This file is part of picc.
@@ -49,41 +53,130 @@ else:
 
 errors = 0
 
+# The kept messages (None if not buffering), the index of each one by kind,
+# symbol or position and text, the maximum number of errors and the output
+# format
+_messages = None
+_seen = {}
+_limit = None
+_format = 'text'
+
+_COLORS = {'fatal': RED, 'error': RED, 'warning': YELLOW, 'note': CYAN}
+
+FORMATS = ['text', 'json']
+
+def configure(limit=None, fmt='text'):
+    '''Keeps the messages until flush.
+
+    limit: if given, stop after this number of errors.
+    fmt: 'text' to write the messages like they are printed, 'json' to write
+        one JSON object per line for each message.
+    '''
+    global _messages, _seen, _limit, _format
+    _messages = []
+    _seen = {}
+    _limit = limit
+    _format = fmt
+
+def _text(m):
+    location = m['file'] if m['file'] is not None else PROGNAME
+    if m['section'] is not None:
+        location = '{}:{}+{:#x}'.format(location, m['section'], m['offset'])
+    text = '{b}{loc}: {c}{kind}:{re} {msg}'.format(loc=location,
+        kind=m['kind'], msg=m['message'], b=BOLD, c=_COLORS[m['kind']],
+        re=RESET)
+    if m['count'] > 1:
+        text += ' (repeated {} times)'.format(m['count'])
+    return text
+
+def _json(m):
+    # Only needed by the JSON format, so they are imported here
+    import json
+    import re
+    m = dict(m)
+    m['message'] = re.sub(r'\033\[[0-9;]*m', '', m['message'])
+    return json.dumps(m, sort_keys=True)
+
+def _emit(kind, msg, filename=None, section=None, offset=None, symbol=None):
+    '''Prints a message, or keeps it if configured so.
+
+    symbol: if given, the name of the symbol the message is about. The same
+        message about the same symbol is kept once, at its first position.
+    '''
+    m = {'kind': kind, 'file': filename, 'section': section,
+         'offset': offset, 'message': str(msg), 'count': 1}
+    if _messages is None:
+        print(_text(m), file=sys.stderr)
+        return
+    # The messages without symbol are only repeated at the same position
+    if symbol is not None:
+        key = (kind, symbol, m['message'])
+    else:
+        key = (kind, filename, section, offset, m['message'])
+    if key in _seen:
+        _seen[key]['count'] += 1
+        return
+    _seen[key] = m
+    _messages.append(m)
+    if kind == 'error' and _limit and errors >= _limit:
+        _emit('fatal', 'too many errors, stopping')
+        flush()
+        sys.exit(1)
+
+def flush():
+    '''Writes the kept messages, sorted by file and position.'''
+    global _messages, _seen
+    if not _messages:
+        return
+    # The messages about the whole program go last
+    messages = sorted(enumerate(_messages), key=lambda im: (
+        im[1]['file'] is None, im[1]['file'] or '', im[1]['section'] or '',
+        im[1]['offset'] or 0, im[0]))
+    write = _json if _format == 'json' else _text
+    sys.stderr.write(''.join(write(m) + '\n' for i, m in messages))
+    sys.stderr.flush()
+    _messages = []
+    _seen = {}
+
 def fatal(msg):
     '''Prints a fatal error and exits.'''
-    print('{b}{prog}: {r}fatal:{re} {msg}'.format(prog=PROGNAME, msg=msg,
-        b=BOLD, r=RED, re=RESET), file=sys.stderr)
+    _emit('fatal', msg)
+    flush()
     sys.exit(1)
 
 def fatalf(filename, msg):
     '''Prints a fatal error occurred while treating a given file and exits.'''
-    print('{b}{file}: {r}fatal:{re} {msg}'.format(file=filename, msg=msg,
-        b=BOLD, r=RED, re=RESET), file=sys.stderr)
+    _emit('fatal', msg, filename)
+    flush()
     sys.exit(1)
 
 def errorf(filename, msg):
     '''Prints an error message.'''
     global errors
-    print('{b}{file}: {r}error:{re} {msg}'.format(file=filename, msg=msg,
-        b=BOLD, r=RED, re=RESET), file=sys.stderr)
     errors += 1
+    _emit('error', msg, filename)
 
-def errorfa(filename, section, offset, msg):
-    '''Prints an error message.'''
+def errorfa(filename, section, offset, msg, symbol=None):
+    '''Prints an error message.
+
+    symbol: if given, the name of the symbol the error is about (see _emit).
+    '''
     global errors
-    print('{b}{file}:{section}+{offset:#x}: {r}error:{re} {msg}'.format(
-        file=filename, section=section, offset=offset, msg=msg, b=BOLD, r=RED,
-        re=RESET), file=sys.stderr)
     errors += 1
+    _emit('error', msg, filename, section, offset, symbol)
 
 def warnf(filename, msg):
     '''Prints a warning message.'''
-    print('{b}{file}: {y}warning:{re} {msg}'.format(file=filename, msg=msg,
-        b=BOLD, y=YELLOW, re=RESET), file=sys.stderr)
+    _emit('warning', msg, filename)
 
 def notefa(filename, section, offset, msg):
     '''Prints a note.'''
-    print('{b}{file}:{section}+{offset:#x}: {c}note:{re} {msg}'.format(
-        file=filename, section=section, offset=offset, msg=msg, b=BOLD, c=CYAN,
-        re=RESET), file=sys.stderr)
+    _emit('note', msg, filename, section, offset)
+
+def warn(msg):
+    '''Prints a warning about the whole program.'''
+    _emit('warning', msg)
 
+def note(msg):
+    '''Prints a note about the whole program.'''
+    _emit('note', msg)
@@ -0,0 +1,116 @@
+'''Read programs in the Intel HEX format as objects to link.
+
+A HEX file (for instance, a bootloader) is read as a Coff object with one
+absolute section for each range of consecutive bytes, so that it's placed
+exactly where the file says and the rest of the sections are placed around
+it.
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+import binascii
+from . import coff, error
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
+__version__ = '0.2.2'
+__license__ = 'GPL'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+_REC_DATA = 0
+_REC_EOF = 1
+_REC_EXT_SEGMENT = 2
+_REC_START_SEGMENT = 3
+_REC_EXT_LINEAR = 4
+_REC_START_LINEAR = 5
+
+_SECTION_FLAGS = coff._STYP_DATA_ROM | coff._STYP_ABS
+
+def ishex(stream):
+    '''Check if the given stream contains an Intel HEX file.'''
+    return coff.peek(stream, 1) == b':'
+
+def records(stream):
+    '''Reads the records of a HEX file, one at a time.
+
+    Yields tuples (line number, record type, address, data).
+    '''
+    filename = stream.name
+    for linenum, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if line[:1] != b':':
+                raise ValueError('missing start code')
+            record = bytearray(binascii.unhexlify(line[1:]))
+        except (ValueError, TypeError, binascii.Error) as e:
+            error.fatalf(filename, 'line {}: {}'.format(linenum, e))
+        if len(record) < 5 or len(record) != record[0] + 5:
+            error.fatalf(filename, 'line {}: wrong record length'.format(
+                linenum))
+        if sum(record) & 0xff:
+            error.fatalf(filename, 'line {}: wrong checksum'.format(linenum))
+        yield (linenum, record[3], (record[1] << 8) | record[2],
+            record[4:-1])
+
+def _addsection(obj, start, data):
+    section = coff.Section('.hex_{:06x}'.format(start), start, start,
+        _SECTION_FLAGS)
+    section.data = data
+    obj.addsection(section)
+
+def readhex(stream):
+    '''Read the contents of a HEX file.
+
+    stream: from where the HEX file is read.
+    Return a Coff object with an absolute section for each range of
+    consecutive bytes in the file.
+    '''
+    obj = coff.Coff(stream.name, None, 0)
+    base = 0
+    # The range of consecutive bytes being read
+    start = None
+    data = bytearray()
+    for linenum, rectype, address, recdata in records(stream):
+        if rectype == _REC_DATA:
+            address += base
+            if start is not None and address != start + len(data):
+                _addsection(obj, start, data)
+                start = None
+            if start is None:
+                start = address
+                data = bytearray()
+            data.extend(recdata)
+        elif rectype == _REC_EOF:
+            break
+        elif rectype in (_REC_EXT_SEGMENT, _REC_EXT_LINEAR):
+            if len(recdata) != 2:
+                error.fatalf(stream.name, 'line {}: wrong extended address '
+                    'record'.format(linenum))
+            base = (recdata[0] << 8) | recdata[1]
+            base <<= 4 if rectype == _REC_EXT_SEGMENT else 16
+        elif rectype not in (_REC_START_SEGMENT, _REC_START_LINEAR):
+            error.fatalf(stream.name, 'line {}: unknown record type {}'.format(
+                linenum, rectype))
+    if start is not None:
+        _addsection(obj, start, data)
+    return obj
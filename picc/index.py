@@ -0,0 +1,197 @@
+'''Database of the symbols and sections of many objects and archives.
+
+The symbols and sections of the indexed files are kept in a sqlite
+database, so that the objects that define or use a symbol can be found
+without reading all of them again. The database is updated incrementally:
+only the files whose modification time or size changed are read again, and
+only the ones whose contents changed are indexed again.
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+import hashlib
+import io
+import os
+import sqlite3
+
+from . import ar, coff, error, ihex
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
+__version__ = '0.2.2'
+__license__ = 'GPL'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+DEFAULT_DATABASE = 'picc-index.db'
+
+# Version of the tables, the database is built again when it changes
+_SCHEMA_VERSION = 1
+_SCHEMA = '''
+CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL,
+    mtime REAL, size INTEGER, hash TEXT);
+CREATE TABLE objects (id INTEGER PRIMARY KEY,
+    file INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    name TEXT NOT NULL);
+CREATE TABLE sections (
+    object INTEGER NOT NULL REFERENCES objects(id) ON DELETE CASCADE,
+    name TEXT NOT NULL, kind TEXT NOT NULL, size INTEGER NOT NULL);
+CREATE TABLE symbols (
+    object INTEGER NOT NULL REFERENCES objects(id) ON DELETE CASCADE,
+    name TEXT NOT NULL, section TEXT, value INTEGER, defined INTEGER NOT NULL);
+CREATE INDEX objects_file ON objects(file);
+CREATE INDEX sections_name ON sections(name);
+CREATE INDEX sections_object ON sections(object);
+CREATE INDEX symbols_name ON symbols(name);
+CREATE INDEX symbols_object ON symbols(object);
+'''
+
+def _kind(section):
+    '''Returns the kind of a section, as shown by the queries.'''
+    if section.iscode():
+        return 'code'
+    elif section.isprogramdata():
+        return 'romdata'
+    return 'udata'
+
+def _readobjects(path, data):
+    '''Returns the objects of a file, with their symbols but not their data.
+
+    The HEX programs have no symbols, so they have no objects.
+    '''
+    f = io.BytesIO(data)
+    f.name = path
+    if ar.isar(f):
+        return ar.extract(f, symbolsonly=True)
+    elif ihex.ishex(f):
+        return []
+    return [coff.readcoff(f, symbolsonly=True)]
+
+class SymbolIndex(object):
+    '''A database of the external symbols and the sections of objects.'''
+
+    def __init__(self, filename=DEFAULT_DATABASE):
+        '''Opens the database, creating it if necessary.'''
+        self.filename = filename
+        try:
+            self._db = sqlite3.connect(filename)
+            self._db.execute('PRAGMA foreign_keys = ON')
+            version, = self._db.execute('PRAGMA user_version').fetchone()
+            if version != _SCHEMA_VERSION:
+                self._create()
+        except sqlite3.Error as e:
+            error.fatalf(filename, e)
+
+    def _create(self):
+        '''Creates the tables, removing the old ones.'''
+        with self._db:
+            for table in ('symbols', 'sections', 'objects', 'files'):
+                self._db.execute('DROP TABLE IF EXISTS {}'.format(table))
+        self._db.executescript(_SCHEMA)
+        self._db.execute('PRAGMA user_version = {}'.format(_SCHEMA_VERSION))
+
+    def close(self):
+        self._db.close()
+
+    def update(self, paths):
+        '''Indexes the given files, and forgets the ones that don't exist.
+
+        Only the files that changed since they were indexed are read. The
+        update is a single transaction, undone if a file can't be read.
+        Returns the number of files indexed again.
+        '''
+        indexed = 0
+        try:
+            with self._db:
+                for fileid, path in self._db.execute(
+                        'SELECT id, path FROM files').fetchall():
+                    if not os.path.isfile(path):
+                        self._db.execute('DELETE FROM files WHERE id = ?',
+                            (fileid,))
+                for path in paths:
+                    if self._updatefile(os.path.abspath(path)):
+                        indexed += 1
+        except sqlite3.Error as e:
+            error.fatalf(self.filename, e)
+        return indexed
+
+    def _updatefile(self, path):
+        '''Indexes a file again, if it changed.
+
+        Returns True if the file was indexed again.
+        '''
+        st = os.stat(path)
+        row = self._db.execute('SELECT id, mtime, size, hash FROM files '
+            'WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[1:3] == (st.st_mtime, st.st_size):
+            return False
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if row is not None:
+            self._db.execute('UPDATE files SET mtime = ?, size = ?, hash = ? '
+                'WHERE id = ?', (st.st_mtime, st.st_size, digest, row[0]))
+            if row[3] == digest:
+                return False
+            self._db.execute('DELETE FROM objects WHERE file = ?', (row[0],))
+            fileid = row[0]
+        else:
+            fileid = self._db.execute('INSERT INTO files (path, mtime, size, '
+                'hash) VALUES (?, ?, ?, ?)', (path, st.st_mtime, st.st_size,
+                digest)).lastrowid
+        for o in _readobjects(path, data):
+            objectid = self._db.execute('INSERT INTO objects (file, name) '
+                'VALUES (?, ?)', (fileid, o.filename)).lastrowid
+            self._db.executemany('INSERT INTO sections VALUES (?, ?, ?, ?)',
+                [(objectid, s.name, _kind(s), s.size)
+                for s in o.sections[1:]])
+            self._db.executemany('INSERT INTO symbols VALUES (?, ?, ?, ?, ?)',
+                [(objectid, s.name, s.section.name if s.isdefined() else None,
+                s.value if s.isdefined() else None, s.isdefined())
+                for s in o.symbols
+                if isinstance(s, coff.Symbol) and s.isexternal()])
+        return True
+
+    def definitions(self, name):
+        '''Returns where a symbol is defined.
+
+        Returns a list of tuples (object, section, value, section size).
+        '''
+        return self._db.execute('SELECT o.name, y.section, y.value, '
+            '(SELECT SUM(s.size) FROM sections s WHERE s.object = o.id AND '
+            's.name = y.section) FROM symbols y JOIN objects o ON '
+            'y.object = o.id WHERE y.name = ? AND y.defined ORDER BY o.name',
+            (name,)).fetchall()
+
+    def references(self, name):
+        '''Returns the names of the objects that use a symbol they don't
+        define.'''
+        return [r[0] for r in self._db.execute('SELECT o.name FROM symbols y '
+            'JOIN objects o ON y.object = o.id WHERE y.name = ? AND NOT '
+            'y.defined ORDER BY o.name', (name,))]
+
+    def sizes(self, name):
+        '''Returns the sizes of the sections with a given name.
+
+        Returns a list of tuples (object, kind, size).
+        '''
+        return self._db.execute('SELECT o.name, s.kind, s.size FROM sections s '
+            'JOIN objects o ON s.object = o.id WHERE s.name = ? ORDER BY '
+            'o.name', (name,)).fetchall()
@@ -20,11 +20,10 @@ along with picc; see the file COPYING.  If not, see
 <http://www.gnu.org/licenses/>.
 '''
 
-import intelhex
+import bisect
 import os
 import struct
-import xml.etree.ElementTree as ET
-from . import coff, error
+from . import coff, error, lkr
 
 __author__ = 'Antonio Serrano Hernandez'
 __copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
@@ -37,6 +36,8 @@ __status__ = 'Development'
 _DATA_PATH = '/usr/share/picc'
 _PROCESSORS_FILENAME = 'processors.xml'
 _PROCESSORS_FILE = os.path.join(_DATA_PATH, _PROCESSORS_FILENAME)
+# Size of the flash erase page when the processors file doesn't give it
+_DEFAULT_ERASE_PAGE = 64
 
 _RELOCT_CALL = 1
 _RELOCT_GOTO = 2
@@ -83,7 +84,7 @@ def bra_rcall_patch(c):
     if offset < -1024 or offset > 1023:
         error.errorfa(c.filename, c.section.name, c.offset,
             "relative jump too long (use {b}'goto'{re} or {b}'call'{re} "
-            "instead)".format(b=error.BOLD, re=error.RESET))
+            "instead)".format(b=error.BOLD, re=error.RESET), c.symbol)
     else:
         opcode = c.opcode | (offset & 0x07ff)
     return opcode
@@ -94,56 +95,88 @@ def condbra_patch(c):
     if offset < -128 or offset > 127:
         error.errorfa(c.filename, c.section.name, c.offset,
             "conditional branch too long (use {b}'goto'{re} instead)".format(
-            b=error.BOLD, re=error.RESET))
+            b=error.BOLD, re=error.RESET), c.symbol)
     else:
         opcode = c.opcode | (offset & 0xff)
     return opcode
 
-_RELOCT_DICT = {
-    _RELOCT_CALL: lambda c: c.opcode | (int(c.value/2) & 0xff),
-    _RELOCT_GOTO: lambda c: c.opcode | (int(c.value/2) & 0xff),
-    _RELOCT_HIGH: unimplemented_patch(_RELOCT_HIGH),
-    _RELOCT_LOW: unimplemented_patch(_RELOCT_LOW),
-    _RELOCT_P: unimplemented_patch(_RELOCT_P),
-    _RELOCT_BANKSEL: unimplemented_patch(_RELOCT_BANKSEL),
-    _RELOCT_PAGESEL: unimplemented_patch(_RELOCT_PAGESEL),
-    _RELOCT_ALL: unimplemented_patch(_RELOCT_ALL),
-    _RELOCT_IBANKSEL: unimplemented_patch(_RELOCT_IBANKSEL),
-    _RELOCT_F: lambda c: c.opcode | (c.value & 0xff),
-    _RELOCT_TRIS: unimplemented_patch(_RELOCT_TRIS),
-    _RELOCT_MOVLR: unimplemented_patch(_RELOCT_MOVLR),
-    _RELOCT_MOVLB: unimplemented_patch(_RELOCT_MOVLB),
-    _RELOCT_GOTO2: lambda c: c.opcode | ((c.value >> 8) & 0xfff),
-    _RELOCT_FF1: lambda c: c.opcode | (c.value & 0xfff),
-    _RELOCT_FF2: lambda c: c.opcode | (c.value & 0xfff),
-    _RELOCT_LFSR1: lambda c: c.opcode | ((c.value >> 8) & 0x0f),
-    _RELOCT_LFSR2: lambda c: c.opcode | (c.value & 0xff),
-    _RELOCT_BRA_RCALL: bra_rcall_patch,
-    _RELOCT_CONDBRA: condbra_patch,
-    _RELOCT_UPPER: unimplemented_patch(_RELOCT_UPPER),
-    _RELOCT_ACCESS: lambda c: c.opcode & 0xfeff if c.value < c.picinfo.access
-        else c.opcode | 0x0100,
-    _RELOCT_PAGESEL_WREG: unimplemented_patch(_RELOCT_PAGESEL_WREG),
-    _RELOCT_PAGESEL_BITS: unimplemented_patch(_RELOCT_PAGESEL_BITS),
-    _RELOCT_SCNSZ_LOW: unimplemented_patch(_RELOCT_SCNSZ_LOW),
-    _RELOCT_SCNSZ_HIGH: unimplemented_patch(_RELOCT_SCNSZ_HIGH),
-    _RELOCT_SCNSZ_UPPER: unimplemented_patch(_RELOCT_SCNSZ_UPPER),
-    _RELOCT_SCNEND_LOW: unimplemented_patch(_RELOCT_SCNEND_LOW),
-    _RELOCT_SCNEND_HIGH: unimplemented_patch(_RELOCT_SCNEND_HIGH),
-    _RELOCT_SCNEND_UPPER: unimplemented_patch(_RELOCT_SCNEND_UPPER),
-    _RELOCT_SCNEND_LFSR1: unimplemented_patch(_RELOCT_SCNEND_LFSR1),
-    _RELOCT_SCNEND_LFSR2: unimplemented_patch(_RELOCT_SCNEND_LFSR2),
+# Range of the relative branches, in words, for each relocation type
+_BRANCH_RANGES = {
+    _RELOCT_BRA_RCALL: (-1024, 1023),
+    _RELOCT_CONDBRA: (-128, 127),
 }
 
+# Trampolines are just a GOTO to the real target of a branch
+# The relocations of the instructions that call or jump to other code
+_CALL_RELOCS = (_RELOCT_CALL, _RELOCT_GOTO, _RELOCT_BRA_RCALL, _RELOCT_CONDBRA)
+
+_GOTO_OPCODE = 0xef00
+_GOTO2_OPCODE = 0xf000
+
+# Maximum number of times the layout is repeated to add trampolines
+_MAX_RELAX_PASSES = 16
+
+# Size of the banks of data memory selected by the BSR
+_BANK_SIZE = 256
+
+# Built the first time it's needed, see _getpatches
+_RELOCT_DICT = None
+
+# Processor information already loaded, by processor name
+_PICINFOS = {}
+
+def _getpatches():
+    '''Returns the dictionary with the patch function of each relocation.'''
+    global _RELOCT_DICT
+    if _RELOCT_DICT is None:
+        _RELOCT_DICT = {
+            _RELOCT_CALL: lambda c: c.opcode | (int(c.value/2) & 0xff),
+            _RELOCT_GOTO: lambda c: c.opcode | (int(c.value/2) & 0xff),
+            _RELOCT_HIGH: unimplemented_patch(_RELOCT_HIGH),
+            _RELOCT_LOW: unimplemented_patch(_RELOCT_LOW),
+            _RELOCT_P: unimplemented_patch(_RELOCT_P),
+            _RELOCT_BANKSEL: lambda c: c.opcode | ((c.value >> 8) & 0x0f),
+            _RELOCT_PAGESEL: unimplemented_patch(_RELOCT_PAGESEL),
+            _RELOCT_ALL: unimplemented_patch(_RELOCT_ALL),
+            _RELOCT_IBANKSEL: unimplemented_patch(_RELOCT_IBANKSEL),
+            _RELOCT_F: lambda c: c.opcode | (c.value & 0xff),
+            _RELOCT_TRIS: unimplemented_patch(_RELOCT_TRIS),
+            _RELOCT_MOVLR: unimplemented_patch(_RELOCT_MOVLR),
+            _RELOCT_MOVLB: unimplemented_patch(_RELOCT_MOVLB),
+            _RELOCT_GOTO2: lambda c: c.opcode | ((c.value >> 9) & 0xfff),
+            _RELOCT_FF1: lambda c: c.opcode | (c.value & 0xfff),
+            _RELOCT_FF2: lambda c: c.opcode | (c.value & 0xfff),
+            _RELOCT_LFSR1: lambda c: c.opcode | ((c.value >> 8) & 0x0f),
+            _RELOCT_LFSR2: lambda c: c.opcode | (c.value & 0xff),
+            _RELOCT_BRA_RCALL: bra_rcall_patch,
+            _RELOCT_CONDBRA: condbra_patch,
+            _RELOCT_UPPER: unimplemented_patch(_RELOCT_UPPER),
+            _RELOCT_ACCESS: lambda c: c.opcode & 0xfeff
+                if c.value < c.picinfo.access else c.opcode | 0x0100,
+            _RELOCT_PAGESEL_WREG: unimplemented_patch(_RELOCT_PAGESEL_WREG),
+            _RELOCT_PAGESEL_BITS: unimplemented_patch(_RELOCT_PAGESEL_BITS),
+            _RELOCT_SCNSZ_LOW: unimplemented_patch(_RELOCT_SCNSZ_LOW),
+            _RELOCT_SCNSZ_HIGH: unimplemented_patch(_RELOCT_SCNSZ_HIGH),
+            _RELOCT_SCNSZ_UPPER: unimplemented_patch(_RELOCT_SCNSZ_UPPER),
+            _RELOCT_SCNEND_LOW: unimplemented_patch(_RELOCT_SCNEND_LOW),
+            _RELOCT_SCNEND_HIGH: unimplemented_patch(_RELOCT_SCNEND_HIGH),
+            _RELOCT_SCNEND_UPPER: unimplemented_patch(_RELOCT_SCNEND_UPPER),
+            _RELOCT_SCNEND_LFSR1: unimplemented_patch(_RELOCT_SCNEND_LFSR1),
+            _RELOCT_SCNEND_LFSR2: unimplemented_patch(_RELOCT_SCNEND_LFSR2),
+        }
+    return _RELOCT_DICT
+
 class _RelocationContext(object):
     '''Gathers information to perform a relocation.'''
 
-    def __init__(self, filename, section, offset, value, picinfo):
+    def __init__(self, filename, section, offset, value, picinfo,
+                 symbol=None):
         self.filename = filename
         self.section = section
         self.offset = offset
         self.value = value
         self.picinfo = picinfo
+        self.symbol = symbol
 
     @property
     def address(self):
@@ -157,18 +190,21 @@ class _RelocationContext(object):
 class _PicInfo(object):
     '''Holds some information about a PIC processor.'''
 
-    def __init__(self, name, ram, access, progmem):
+    def __init__(self, name, ram, access, progmem,
+                 erasepage=_DEFAULT_ERASE_PAGE):
         '''Creates a PicInfo instance with the given information.
         
         name: the processor's name.
         ram: the size of RAM (excluding space for SFR).
         access: the size of access RAM.
         flash: the size of Flash memory (program memory).
+        erasepage: the size of the blocks erased at once in Flash memory.
         '''
         self.name = name
         self.ram = ram
         self.access = access
         self.progmem = progmem
+        self.erasepage = erasepage
 
 class _FreeMemory(object):
     '''Represents a consecutive stream of free bytes.'''
@@ -217,6 +253,21 @@ class _MemoryAllocator(object):
     def __init__(self, size):
         self.freemem = [_FreeMemory(0, size)]
 
+    def _first(self, address):
+        '''Returns the index of the first hole that ends after address.
+
+        The holes are kept sorted by address, so a binary search is used.
+        '''
+        low, high = 0, len(self.freemem)
+        while low < high:
+            mid = (low + high) // 2
+            h = self.freemem[mid]
+            if h.start + h.size <= address:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
     def alloc(self, size, start=None, end=None):
         '''Allocates size bytes of memory.
         
@@ -235,8 +286,10 @@ class _MemoryAllocator(object):
         if start is not None and end is not None:
             # Search for a hole that intersects the given space whith enough
             # free bytes
-            for i in range(len(self.freemem)):
+            for i in range(self._first(start), len(self.freemem)):
                 h = self.freemem[i]
+                if h.start >= end:
+                    break
                 newh = h.intersection(_FreeMemory(start, end - start))
                 if newh is not None and size <= newh.size:
                     address = newh.start
@@ -245,7 +298,7 @@ class _MemoryAllocator(object):
                     break
         elif start is not None:
             # Search for the hole that contains the start address
-            for i in range(len(self.freemem)):
+            for i in range(self._first(start), len(self.freemem)):
                 h = self.freemem[i]
                 if h.contains(_FreeMemory(start, size)):
                     address = start
@@ -265,13 +318,26 @@ class _MemoryAllocator(object):
         return address
 
 def _loadpicinfo(processor):
-    '''Load the processor's information needed by the linker.'''
+    '''Load the processor's information needed by the linker.
+
+    The information is kept for the next links in the same process.
+    '''
+    picinfo = _PICINFOS.get(processor)
+    if picinfo is None:
+        picinfo = _PICINFOS[processor] = _readpicinfo(processor)
+    return picinfo
+
+def _readpicinfo(processor):
+    '''Read the processor's information from the processors file.'''
+    import xml.etree.ElementTree as ET
     try:
         tree = ET.parse(_PROCESSORS_FILE)
         for p in tree.getroot():
             if processor == p.attrib['name']:
                 return _PicInfo(processor, int(p.attrib['ram'], 16),
-                    int(p.attrib['access'], 16), int(p.attrib['progmem'], 16))
+                    int(p.attrib['access'], 16), int(p.attrib['progmem'], 16),
+                    int(p.attrib.get('erasepage', hex(_DEFAULT_ERASE_PAGE)),
+                    16))
         error.fatal("info from processor {b}'{proc}'{re} not found".format(
             b=error.BOLD, re=error.RESET, proc=processor))
     except IOError as ioe:
@@ -281,61 +347,776 @@ def _loadpicinfo(processor):
             "{attr}".format(b=error.BOLD, re=error.RESET, f=_PROCESSORS_FILE,
             attr=ke))
 
-def _getallocator(obj, section, codemem, datamem):
-    '''Returns the right allocator for the given section.'''
-    allocator = None
-    if section.iscode() or section.isprogramdata(): allocator = codemem
-    elif section.isudata(): allocator = datamem
-    return allocator
+class _PlacementPlan(object):
+    '''Decides in which memory region each section is placed.
+
+    The regions come from a linker script or, if there is none, from the
+    processor's information. They are indexed once, when the plan is
+    created, and the plan can then be used for several layouts (see reset).
+    '''
+
+    def __init__(self, picinfo, script=None):
+        '''Compiles the placement plan.
+
+        picinfo: the information of the processor.
+        script: a lkr.LinkerScript object, or None.
+        '''
+        if script is None:
+            # The access RAM is also part of the RAM used for the rest of
+            # the data sections
+            regions = [
+                lkr.Region(lkr.CODEPAGE, 'progmem', 0, picinfo.progmem - 1,
+                    False),
+                lkr.Region(lkr.ACCESSBANK, 'access', 0, picinfo.access - 1,
+                    False),
+                lkr.Region(lkr.DATABANK, 'ram', 0, picinfo.ram - 1, False)]
+            mapping = {}
+            self.filename = None
+            self.stack = None
+        else:
+            regions = script.regions
+            mapping = script.sections
+            self.filename = script.filename
+            self.stack = script.stack
+        self.coderegions = sorted([r for r in regions if r.iscode()],
+            key=lambda r: r.start)
+        self.dataregions = sorted([r for r in regions if not r.iscode()],
+            key=lambda r: r.start)
+        self._codestarts = [r.start for r in self.coderegions]
+        self._datastarts = [r.start for r in self.dataregions]
+        # The regions of each kind where any section can be placed
+        self._defaults = {}
+        for r in regions:
+            if not r.protected:
+                self._defaults.setdefault(r.kind, []).append(r)
+        # All the ranges of each region, by name
+        self._byname = {}
+        for r in self.coderegions + self.dataregions:
+            self._byname.setdefault(r.name, []).append(r)
+        # The regions for each section explicitly mapped
+        self._sections = {}
+        for section, region in mapping.items():
+            if region not in self._byname:
+                error.fatalf(script.filename, "section {b}'{s}'{re} mapped "
+                    "to unknown region {b}'{r}'{re}".format(b=error.BOLD,
+                    re=error.RESET, s=section, r=region))
+            self._sections[section] = self._byname[region]
+        self.codesize = max([picinfo.progmem] +
+            [r.end + 1 for r in self.coderegions])
+        self.datasize = max([picinfo.ram] +
+            [r.end + 1 for r in self.dataregions])
+        self.reset()
+
+    def reset(self):
+        '''Frees all the memory, to start a new layout.'''
+        self.codemem = _MemoryAllocator(self.codesize)
+        self.datamem = _MemoryAllocator(self.datasize)
+        # The sections that couldn't be placed
+        self.unplaced = set()
+
+    def iscodespace(self, section):
+        '''Tells if a section goes to program memory.'''
+        return bool(section.iscode() or section.isprogramdata())
+
+    def _space(self, section):
+        '''Returns the allocator, regions and starts for a section.'''
+        if self.iscodespace(section):
+            return self.codemem, self.coderegions, self._codestarts
+        return self.datamem, self.dataregions, self._datastarts
+
+    def allocabsolute(self, section):
+        '''Reserves the memory of an absolute section.
+
+        Absolute sections can be placed in any region, even protected, but
+        not outside them. The configuration words, the device ID and the
+        EEPROM data are above the program memory, so the absolute sections
+        there are accepted as they are, unless a region covers them.
+        Returns False if the memory is not available.
+        '''
+        if self.iscodespace(section) and section.paddress >= self.codesize:
+            return True
+        allocator, regions, starts = self._space(section)
+        end = section.paddress + max(section.size, 1) - 1
+        i = bisect.bisect_right(starts, section.paddress) - 1
+        # With overlapping regions, any region that contains the section
+        # is good, so look back until the first candidate
+        while i >= 0 and regions[i].end < end:
+            i -= 1
+        if i < 0 or regions[i].start > section.paddress:
+            return False
+        return allocator.alloc(
+            start=section.paddress, size=section.size) is not None
+
+    def ismapped(self, section):
+        '''Tells if the script says where a section must be placed.'''
+        return section.name in self._sections
+
+    def reservestack(self):
+        '''Reserves the memory for the stack, if the script has one.
+
+        Returns False if the memory is not available.
+        '''
+        if self.stack is None:
+            return True
+        size, region = self.stack
+        regions = self._byname.get(region, self._defaults.get(lkr.DATABANK,
+            []))
+        for r in regions:
+            if self.datamem.alloc(size, r.start, r.end + 1) is not None:
+                return True
+        return False
+
+    def banks(self):
+        '''Returns the banks of the unprotected data banks regions.'''
+        banks = set()
+        for r in self._defaults.get(lkr.DATABANK, []):
+            banks.update(range(r.start // _BANK_SIZE,
+                r.end // _BANK_SIZE + 1))
+        return sorted(banks)
+
+    def bankfree(self, bank):
+        '''Returns the free bytes of a bank in the data banks regions.'''
+        start = bank * _BANK_SIZE
+        end = start + _BANK_SIZE
+        free = 0
+        for r in self._defaults.get(lkr.DATABANK, []):
+            low, high = max(start, r.start), min(end, r.end + 1)
+            i = self.datamem._first(low)
+            while i < len(self.datamem.freemem):
+                h = self.datamem.freemem[i]
+                if h.start >= high:
+                    break
+                free += max(0, min(high, h.start + h.size) - max(low, h.start))
+                i += 1
+        return free
+
+    def alloc(self, section, kind=None, bank=None):
+        '''Gives an address to a relocatable section.
+
+        kind: if given, the section is placed in the unprotected regions of
+            this kind, instead of the ones for its name or flags.
+        bank: if given, the section is placed in this bank of data memory.
+        Returns the address, or None if there's no room for it.
+        '''
+        allocator, _, _ = self._space(section)
+        iscode = allocator is self.codemem
+        if kind is not None:
+            regions = self._defaults.get(kind, [])
+        elif section.name in self._sections:
+            regions = self._sections[section.name]
+        elif iscode:
+            regions = self._defaults.get(lkr.CODEPAGE, [])
+        elif section.isaccess():
+            regions = self._defaults.get(lkr.ACCESSBANK, [])
+        else:
+            regions = self._defaults.get(lkr.DATABANK, [])
+        for r in regions:
+            if r.iscode() != iscode:
+                continue
+            start, end = r.start, r.end + 1
+            if bank is not None:
+                start = max(start, bank * _BANK_SIZE)
+                end = min(end, (bank + 1) * _BANK_SIZE)
+                if start >= end:
+                    continue
+            address = allocator.alloc(section.size, start, end)
+            if address is not None:
+                if r.kind == lkr.SHAREBANK:
+                    # Reserve the same memory in all the mirrors
+                    for m in self._byname[r.name]:
+                        if m is not r:
+                            allocator.alloc(start=m.start + address - r.start,
+                                size=section.size)
+                return address
+        return None
+
+def _mergesections(sections, merge=True):
+    '''Groups the sections with the same name and flags.
+
+    sections: list of (section, object) tuples.
+    merge: if False, only the overlay sections are grouped, the rest of the
+        sections go alone in their own group.
+    Returns a list of groups, lists of (section, object) tuples, in the order
+    of the first section of each group.
+    '''
+    groups = []
+    bykey = {}
+    for s, o in sections:
+        key = (s.name, s.flags)
+        if not merge and not s.isoverlay():
+            key = s
+        if key not in bykey:
+            bykey[key] = []
+            groups.append(bykey[key])
+        bykey[key].append((s, o))
+    return groups
+
+def _grouplayout(group):
+    '''Returns the offsets of the sections of a group and its size.
+
+    The sections are placed one after the other, except the overlay ones,
+    that all start at the beginning of the group.
+    '''
+    first = group[0][0]
+    if first.isoverlay():
+        return [0] * len(group), max(s.size for s, o in group)
+    # Keep the sections in program memory aligned to words
+    align = 2 if first.iscode() or first.isprogramdata() else 1
+    offsets = []
+    size = 0
+    for s, o in group:
+        size += -size % align
+        offsets.append(size)
+        size += s.size
+    return offsets, size
+
+def _groupsection(group):
+    '''Returns a section as big as a whole group, to allocate it.'''
+    first = group[0][0]
+    if len(group) == 1:
+        return first
+    merged = coff.Section(first.name, 0, 0, first.flags)
+    merged.size = _grouplayout(group)[1]
+    return merged
+
+def _allocgroup(plan, group, kind=None, bank=None):
+    '''Gives addresses to a group of sections, one after the other.
+
+    The group is allocated as a single section, so it does not leave holes
+    between its members. Returns False if there's no room for the group.
+    kind, bank: where to place the group (see _PlacementPlan.alloc).
+    '''
+    first = group[0][0]
+    if len(group) == 1:
+        first.paddress = plan.alloc(first, kind, bank)
+        return first.paddress is not None
+    offsets, size = _grouplayout(group)
+    address = plan.alloc(_groupsection(group), kind, bank)
+    if address is None:
+        return False
+    for (s, o), offset in zip(group, offsets):
+        s.paddress = address + offset
+    return True
+
+def _countaccesses(objects, externalsyms):
+    '''Counts the instructions that access each banked udata section.
+
+    Only the instructions that use the access bit are counted. MOVFF and
+    LFSR use the full address, so they don't need the BSR anyway.
+    Returns a dictionary from section to number of instructions.
+    '''
+    counts = {}
+    for o in objects:
+        for s in o.sections[1:]:
+            if not s.iscode():
+                continue
+            # The file register and access bit relocations of the same
+            # instruction are counted once
+            seen = set()
+            for r in s.relocations:
+                if (r.reltype not in (_RELOCT_F, _RELOCT_ACCESS)
+                        or r.address in seen):
+                    continue
+                symbol = r.symbol
+                if not symbol.isdefined():
+                    symbol = externalsyms.get(symbol.name, symbol)
+                if not symbol.isdefined():
+                    continue
+                target = symbol.section
+                if (target.isudata() and not target.isabsolute()
+                        and not target.isaccess()):
+                    seen.add(r.address)
+                    counts[target] = counts.get(target, 0) + 1
+    return counts
+
+def _promoteaccess(plan, groups, accesses):
+    '''Places the most accessed udata groups in the free access RAM.
+
+    The groups are tried by number of accesses per byte, so that the access
+    RAM holds as many accesses as possible.
+    groups: the groups of relocatable sections.
+    accesses: the dictionary returned by _countaccesses.
+    Returns the list of groups placed in the access RAM.
+    '''
+    candidates = []
+    for group in groups:
+        s = group[0][0]
+        count = sum(accesses.get(m, 0) for m, o in group)
+        size = _grouplayout(group)[1]
+        if count and size and s.isudata() and not plan.ismapped(s):
+            candidates.append((-float(count) / size, size, len(candidates),
+                group))
+    candidates.sort()
+    promoted = []
+    for _, _, _, group in candidates:
+        if _allocgroup(plan, group, lkr.ACCESSBANK):
+            promoted.append(group)
+    return promoted
+
+def _bankuses(objects, externalsyms):
+    '''Counts the instructions of each code section that use each banked
+    udata section.
+
+    The instructions that use the access bit and the bank selections are
+    counted, the ones that use the full address are not.
+    Returns a dictionary from code section to a dictionary from udata
+    section to number of instructions.
+    '''
+    uses = {}
+    for o in objects:
+        for s in o.sections[1:]:
+            if not s.iscode():
+                continue
+            counts = {}
+            seen = set()
+            for r in s.relocations:
+                if (r.reltype not in (_RELOCT_F, _RELOCT_ACCESS,
+                        _RELOCT_BANKSEL) or r.address in seen):
+                    continue
+                symbol = r.symbol
+                if not symbol.isdefined():
+                    symbol = externalsyms.get(symbol.name, symbol)
+                if not symbol.isdefined():
+                    continue
+                target = symbol.section
+                if (target.isudata() and not target.isabsolute()
+                        and not target.isaccess()):
+                    seen.add(r.address)
+                    counts[target] = counts.get(target, 0) + 1
+            if counts:
+                uses[s] = counts
+    return uses
+
+def _crossbank(uses, addressof):
+    '''Counts the accesses of the code outside the bank each code section
+    uses the most.
+
+    uses: the dictionary returned by _bankuses.
+    addressof: function that returns the address of a udata section, or None
+        if it's not known. A section that spans several banks is counted in
+        all of them.
+    '''
+    crossed = 0
+    for counts in uses.values():
+        bybank = {}
+        total = 0
+        for section, count in counts.items():
+            address = addressof(section)
+            if address is None:
+                continue
+            total += count
+            last = address + max(section.size, 1) - 1
+            for bank in range(address // _BANK_SIZE, last // _BANK_SIZE + 1):
+                bybank[bank] = bybank.get(bank, 0) + count
+        if bybank:
+            crossed += total - max(bybank.values())
+    return crossed
+
+def _usualaddresses(plan, groups):
+    '''Returns the addresses the udata sections of the groups would get if
+    placed as usual, without placing them.'''
+    freemem = plan.datamem.freemem[:]
+    addresses = {}
+    for group in groups:
+        if not plan.iscodespace(group[0][0]):
+            address = plan.alloc(_groupsection(group))
+            if address is not None:
+                for (s, o), offset in zip(group, _grouplayout(group)[0]):
+                    addresses[s] = address + offset
+    plan.datamem.freemem = freemem
+    return addresses
+
+def _colorbanks(plan, groups, uses):
+    '''Places in the same bank the udata groups used by the same code.
+
+    The code sections are taken from the one with more accesses to the one
+    with less, and the groups each one uses are placed, from the most used,
+    in the bank where it already has more accesses, or else in the one with
+    more free memory. If that doesn't make less accesses cross banks than
+    the usual placement, nothing is placed.
+    groups: the groups of relocatable sections still to place.
+    uses: the dictionary returned by _bankuses.
+    Returns the list of groups placed and the number of accesses that would
+    cross banks if the groups were placed as usual.
+    '''
+    index = {}
+    for i, group in enumerate(groups):
+        for s, o in group:
+            index[s] = i
+    freemem = plan.datamem.freemem[:]
+    before = _crossbank(uses, _usualaddresses(plan, groups).get)
+    # Only the groups that go to the data banks can be colored
+    candidates = set()
+    for i, group in enumerate(groups):
+        s = group[0][0]
+        if (s.isudata() and not s.isaccess() and not s.isoverlay()
+                and not plan.ismapped(s)):
+            candidates.add(i)
+    free = dict((bank, plan.bankfree(bank)) for bank in plan.banks())
+    bankof = {}
+    placed = []
+    functions = []
+    for counts in uses.values():
+        bygroup = {}
+        for section, count in counts.items():
+            i = index.get(section)
+            if i in candidates:
+                bygroup[i] = bygroup.get(i, 0) + count
+        if bygroup:
+            functions.append((-sum(bygroup.values()), len(functions),
+                bygroup))
+    functions.sort()
+    for _, _, bygroup in functions:
+        weights = {}
+        for i, count in bygroup.items():
+            if i in bankof:
+                weights[bankof[i]] = weights.get(bankof[i], 0) + count
+        for i in sorted(bygroup, key=lambda i: (-bygroup[i], i)):
+            if i in bankof:
+                continue
+            size = _grouplayout(groups[i])[1]
+            for bank in sorted(free, key=lambda b: (-weights.get(b, 0),
+                    -free[b], b)):
+                if free[bank] >= size and _allocgroup(plan, groups[i],
+                        bank=bank):
+                    bankof[i] = bank
+                    free[bank] -= size
+                    weights[bank] = weights.get(bank, 0) + bygroup[i]
+                    placed.append(groups[i])
+                    break
+            else:
+                # Placed later as usual
+                bankof[i] = None
+    # Compare with the usual placement, the rest of the groups included
+    ids = set(id(g) for g in placed)
+    addresses = _usualaddresses(plan, [g for g in groups
+        if id(g) not in ids])
+    for group in placed:
+        for s, o in group:
+            addresses[s] = s.paddress
+    if _crossbank(uses, addresses.get) >= before:
+        plan.datamem.freemem = freemem
+        for group in placed:
+            for s, o in group:
+                s.paddress = None
+        return [], before
+    return placed, before
+
+def _callgraph(groups, externalsyms):
+    '''Builds the graph of calls and branches between groups of code.
+
+    groups: the groups of relocatable code sections.
+    Returns a dictionary from pairs of indexes in groups to the weight of
+    the edge between them. The relative branches weight more than the
+    calls, because they fail if their target is too far.
+    '''
+    index = {}
+    for i, group in enumerate(groups):
+        for s, o in group:
+            index[s] = i
+    weights = {}
+    for i, group in enumerate(groups):
+        for s, o in group:
+            for r in s.relocations:
+                if r.reltype in _BRANCH_RANGES:
+                    weight = 2
+                elif r.reltype == _RELOCT_CALL:
+                    weight = 1
+                else:
+                    continue
+                symbol = r.symbol
+                if not symbol.isdefined():
+                    symbol = externalsyms.get(symbol.name, symbol)
+                j = index.get(symbol.section)
+                if j is not None and j != i:
+                    edge = (min(i, j), max(i, j))
+                    weights[edge] = weights.get(edge, 0) + weight
+    return weights
+
+def _clustercode(objects, externalsyms, merge=True):
+    '''Orders the relocatable code so that the sections that call each
+    other are placed together.
 
-def _allocsections(objects, picinfo, codemem, datamem):
+    The chains of sections are joined following the edges of the call graph
+    from the heaviest to the lightest, as in the algorithm of Pettis and
+    Hansen. Each join puts the two ends of the edge as close as possible.
+    Returns a dictionary from each relocatable code section to its position
+    in the new order.
+    '''
+    sections = [(s, o) for o in objects for s in o.sections[1:]
+        if s.iscode() and not s.isabsolute()]
+    groups = _mergesections(sections, merge)
+    weights = _callgraph(groups, externalsyms)
+    chains = dict((i, [i]) for i in range(len(groups)))
+    for (i, j), w in sorted(weights.items(), key=lambda e: (-e[1], e[0])):
+        first, second = chains[i], chains[j]
+        if first is second:
+            continue
+        options = [first + second, first + second[::-1],
+            first[::-1] + second, second + first]
+        chain = min(options, key=lambda c: abs(c.index(i) - c.index(j)))
+        for k in chain:
+            chains[k] = chain
+    # The chains keep the order of their first group in the input
+    order = []
+    seen = set()
+    for i in range(len(groups)):
+        chain = chains[i]
+        if id(chain) not in seen:
+            seen.add(id(chain))
+            order.extend(chain)
+    layout = {}
+    for position, i in enumerate(order):
+        for s, o in groups[i]:
+            layout[s] = position
+    return layout
+
+def _calltree(objects, externalsyms):
+    '''Finds the calls between code sections and the entry points.
+
+    A code section is an entry point if nobody calls it (like the reset
+    and interrupt vectors) or if its address is taken other than to call
+    it or jump to it, because then it can be called from anywhere.
+    Returns a tuple (callees, roots) with a dictionary from each code
+    section to the set of code sections that it calls and the list of
+    entry points.
+    '''
+    codes = [s for o in objects for s in o.sections[1:] if s.iscode()]
+    callees = dict((s, set()) for s in codes)
+    called = set()
+    addressed = set()
+    for o in objects:
+        for s in o.sections[1:]:
+            for r in s.relocations:
+                symbol = r.symbol
+                if not symbol.isdefined():
+                    symbol = externalsyms.get(symbol.name, symbol)
+                if not symbol.isdefined() or not symbol.section.iscode():
+                    continue
+                target = symbol.section
+                if s.iscode() and r.reltype in _CALL_RELOCS:
+                    if target is not s:
+                        callees[s].add(target)
+                        called.add(target)
+                elif r.reltype != _RELOCT_GOTO2:
+                    addressed.add(target)
+    roots = [s for s in codes if s not in called or s in addressed]
+    return callees, roots
+
+def _compiledstack(objects, externalsyms, plan, merge=True):
+    '''Finds the overlay udata sections that can share RAM.
+
+    Each overlay group used by a single code section is taken as the local
+    variables of that code section. The locals of the code sections
+    reached from a single entry point are laid out as a compiled stack:
+    the interval of each code section starts after the intervals of all
+    the code sections that call it, so the intervals of two code sections
+    overlap only if neither can be active while the other runs. The code
+    sections reached from several entry points (like the ones called from
+    main and from an interrupt) or in a loop of calls keep their locals
+    apart.
+    Returns a list of areas, tuples (entry point, size, frames), with frames
+    a list of tuples (offset, group) with the offset of each group in the
+    area.
+    '''
+    overlays = [(s, o) for o in objects for s in o.sections[1:]
+        if s.isudata() and s.isoverlay() and not s.isabsolute()
+        and not s.isaccess() and not plan.ismapped(s)]
+    groups = _mergesections(overlays, merge)
+    index = {}
+    for i, group in enumerate(groups):
+        for s, o in group:
+            index[s] = i
+    # The code section that uses each group, or None if used by several
+    users = {}
+    for o in objects:
+        for s in o.sections[1:]:
+            for r in s.relocations:
+                symbol = r.symbol
+                if not symbol.isdefined():
+                    symbol = externalsyms.get(symbol.name, symbol)
+                i = index.get(symbol.section) if symbol.isdefined() else None
+                if i is None:
+                    continue
+                user = s if s.iscode() else None
+                users[i] = user if users.get(i, user) is user else None
+    frames = {}
+    for i, user in users.items():
+        if user is not None:
+            frames.setdefault(user, []).append(groups[i])
+    if not frames:
+        return []
+    callees, roots = _calltree(objects, externalsyms)
+    # The entry points from where each code section is reached
+    reachedby = {}
+    for root in roots:
+        pending = [root]
+        seen = set(pending)
+        while pending:
+            s = pending.pop()
+            reachedby.setdefault(s, []).append(root)
+            for c in callees[s]:
+                if c not in seen:
+                    seen.add(c)
+                    pending.append(c)
+    # Visit the code sections in topological order. The ones in a loop of
+    # calls (or called from one) are never visited
+    callers = dict((s, 0) for s in callees)
+    for s in callees:
+        for c in callees[s]:
+            callers[c] += 1
+    pending = [s for s in callees if not callers[s]]
+    offsets = dict((s, 0) for s in callees)
+    areas = dict((root, (0, [])) for root in roots)
+    while pending:
+        s = pending.pop()
+        end = offsets[s]
+        if s in frames and len(reachedby.get(s, [])) == 1:
+            root = reachedby[s][0]
+            size, stackframes = areas[root]
+            for group in frames[s]:
+                stackframes.append((end, group))
+                end += _grouplayout(group)[1]
+            areas[root] = (max(size, end), stackframes)
+        for c in callees[s]:
+            offsets[c] = max(offsets[c], end)
+            callers[c] -= 1
+            if not callers[c]:
+                pending.append(c)
+    return [(root, areas[root][0], areas[root][1]) for root in roots
+        if len(areas[root][1]) > 1]
+
+def _allocarea(plan, area):
+    '''Gives addresses to the overlay groups of an area of the compiled
+    stack (see _compiledstack).
+
+    Returns False if there's no room for the area.
+    '''
+    root, size, frames = area
+    stack = coff.Section('{}.locals'.format(root.name), 0, 0, coff._STYP_BSS)
+    stack.size = size
+    address = plan.alloc(stack)
+    if address is None:
+        return False
+    for offset, group in frames:
+        for (s, o), suboffset in zip(group, _grouplayout(group)[0]):
+            s.paddress = address + offset + suboffset
+    return True
+
+def _allocsections(objects, plan, merge=True, accesses=None, layout=None,
+                   stack=None, uses=None, stubs=None):
     '''Give absolute addresses to all sections.
-    
+
     objects: the list of Coff objects to link.
-    codemem: the allocator manager for the code memory.
-    datamem: the allocator manager for the data memory.
+    plan: the _PlacementPlan that decides where the sections go.
+    merge: if True, the relocatable sections with the same name and flags
+        are placed together, as a single section.
+    accesses: if given, the number of instructions that access each udata
+        section (see _countaccesses), used to place the most accessed ones
+        in the free access RAM.
+    layout: if given, the position of each relocatable code section in the
+        program memory (see _clustercode).
+    stack: if given, the areas of overlay groups that share RAM (see
+        _compiledstack).
+    uses: if given, the accesses of each code section to each udata section
+        (see _bankuses), used to place in the same bank the udata sections
+        used by the same code.
+    stubs: if given, the stub section of trampolines to place just before
+        each section (see _Trampolines).
+    Returns the list of groups of sections placed in the access RAM because
+    of their accesses, the list of groups placed by bank and the number of
+    accesses that would cross banks if those were placed as usual.
     '''
     # Make three lists with the absolute sections, then with the sections that
     # must be allocated in the access ram and then with the relocatable ones
     absolute_sections = []
     access_sections = []
     relocatable_sections = []
+    placedstubs = set(stubs.values()) if stubs else set()
     for o in objects:
         for s in o.sections[1:]:
-            if s.isabsolute():
+            if s in placedstubs:
+                continue
+            elif s.isabsolute():
                 absolute_sections.append((s, o))
             elif s.isaccess():
                 access_sections.append((s, o))
             else:
                 relocatable_sections.append((s, o))
 
-    # Allocate absolute sections
+    # Allocate absolute sections. They are sorted by address to find the
+    # ones that overlap
+    absolute_sections.sort(key=lambda so: (plan.iscodespace(so[0]),
+        so[0].paddress))
+    # The section that reaches further in each memory space so far
+    furthest = {}
     for s, o in absolute_sections:
-        # Get the correct allocator
-        allocator = _getallocator(o, s, codemem, datamem)
-        if allocator.alloc(start=s.paddress, size=s.size) is None:
-            if s.iscode(): typemem = 'program'
-            else: typemem = 'data'
-            error.errorf(o.filename,
-                "No target memory available for section {b}'{s}'{re}".format(
-                 b=error.BOLD, re=error.RESET, s=s.name))
-    # Allocate access sections
-    for s, o in access_sections:
-        s.paddress = datamem.alloc(s.size, start=0, end=picinfo.access)
-        if s.paddress is None:
+        space = plan.iscodespace(s)
+        last = furthest.get(space)
+        used = s
+        if s.size and last is not None and s.paddress < last[0]:
+            if (not s.isoverlay() or s.name != last[1].name
+                    or s.flags != last[1].flags):
+                error.errorf(o.filename, "section {b}'{s}'{re} overlaps "
+                    "section {b}'{l}'{re} from {b}'{f}'{re}".format(
+                    b=error.BOLD, re=error.RESET, s=s.name, l=last[1].name,
+                    f=last[2].filename))
+                continue
+            # The absolute overlay sections with the same name can overlap,
+            # only the memory after the previous one is still to be used
+            if s.paddress + s.size <= last[0]:
+                continue
+            used = coff.Section(s.name, last[0], last[0], s.flags)
+            used.size = s.paddress + s.size - last[0]
+        if s.size and (last is None or s.paddress + s.size > last[0]):
+            furthest[space] = (s.paddress + s.size, s, o)
+        if not plan.allocabsolute(used):
+            plan.unplaced.add(s)
             error.errorf(o.filename,
                 "No target memory available for section {b}'{s}'{re}".format(
                  b=error.BOLD, re=error.RESET, s=s.name))
-    # Allocate the relocatable sections
-    for s, o in relocatable_sections:
-        # Get the correct allocator
-        allocator = _getallocator(o, s, codemem, datamem)
-        s.paddress = allocator.alloc(s.size)
-        if s.paddress is None:
-            error.errorf(o.filename,
-                "No target memory available for section {b}'{s}'{re}".format(
-                 b=error.BOLD, re=error.RESET, s=s.name))
-            s.paddress = 0
+    if not plan.reservestack():
+        error.errorf(plan.filename, 'No target memory available for the stack')
+    # Allocate access sections and then the relocatable sections
+    promoted = []
+    colored = []
+    before = 0
+    for sections in (access_sections, relocatable_sections):
+        groups = _mergesections(sections, merge)
+        if stack and sections is relocatable_sections:
+            overlaid = set()
+            for area in stack:
+                if _allocarea(plan, area):
+                    overlaid.update(g[0][0] for _, g in area[2])
+            groups = [g for g in groups if g[0][0] not in overlaid]
+        if accesses and sections is relocatable_sections:
+            promoted = _promoteaccess(plan, groups, accesses)
+            groups = [g for g in groups if g not in promoted]
+        if uses and sections is relocatable_sections:
+            colored, before = _colorbanks(plan, groups, uses)
+            placed = set(id(g) for g in colored)
+            groups = [g for g in groups if id(g) not in placed]
+        if layout and sections is relocatable_sections:
+            # Put the code groups in the order of the layout, in the same
+            # places of the list where they were
+            code = [g for g in groups if g[0][0] in layout]
+            code.sort(key=lambda g: layout[g[0][0]])
+            code.reverse()
+            groups = [code.pop() if g[0][0] in layout else g
+                for g in groups]
+        if stubs:
+            groups = [[m for s, o in g for m in ([(stubs[s], o), (s, o)]
+                if s in stubs else [(s, o)])] for g in groups]
+        for group in groups:
+            if not _allocgroup(plan, group):
+                s, o = group[0]
+                error.errorf(o.filename, "No target memory available for "
+                    "section {b}'{s}'{re}".format(b=error.BOLD,
+                    re=error.RESET, s=s.name))
+                for s, o in group:
+                    s.paddress = 0
+                    plan.unplaced.add(s)
+    return promoted, colored, before
 
 def _getexternals(objects):
     '''Compile a dictionary with all the external symbols.'''
@@ -353,78 +1134,412 @@ def _getexternals(objects):
                     symfiles[s.name] = o.filename
     return externals
 
-def _applyrelocations(objects, externalsyms, picinfo):
-    '''Patch the data of the code sections with the right addresses.'''
-    # Hold a set of seen symbols to avoid repeating error messages
-    undefset = set()
-    noteseen = False
-    # Compile the list of code sections
+def _undefined(objects, defined):
+    '''Yields the objects and the external symbols they use not in defined.'''
+    for o in objects:
+        for s in o.symbols:
+            if (isinstance(s, coff.Symbol) and s.isexternal()
+                    and not s.isdefined() and s.name not in defined):
+                yield o, s.name
+
+def checksymbols(objects):
+    '''Reports the duplicated and the undefined symbols of the objects.
+
+    Only the symbols tables are used, so the objects can be read without
+    their data (see coff.readcoff).
+    '''
+    externalsyms = _getexternals(objects)
+    for o, name in _undefined(objects, externalsyms):
+        error.errorf(o.filename, "undefined symbol {b}'{s}'{re}".format(
+            b=error.BOLD, re=error.RESET, s=name))
+
+def undefinedsymbols(objects):
+    '''Returns the sorted names of the external symbols that are used but
+    defined by none of the objects.'''
+    defined = set(s.name for o in objects for s in o.symbols
+        if isinstance(s, coff.Symbol) and s.isexternal() and s.isdefined())
+    return sorted(set(name for _, name in _undefined(objects, defined)))
+
+def _sectionkey(section, externalsyms):
+    '''Returns what makes two code sections interchangeable.
+
+    That is, their flags, their data and their relocations, with the
+    targets of the relocations resolved to the sections they point to.
+    '''
+    relocations = []
+    for r in section.relocations:
+        symbol = r.symbol
+        if not symbol.isdefined():
+            symbol = externalsyms.get(symbol.name, symbol)
+        if not symbol.isdefined():
+            target = symbol.name
+        elif symbol.section is section:
+            # Two copies are identical if they point to the same place of
+            # themselves
+            target = (None, symbol.value)
+        else:
+            target = (symbol.section, symbol.value)
+        relocations.append((r.address, r.reltype, r.offset, target))
+    return (section.flags, bytes(section.data), tuple(relocations))
+
+def _foldcode(objects, externalsyms):
+    '''Removes the duplicated relocatable code sections.
+
+    The symbols of each duplicated section are moved to the copy that is
+    kept, so that all the relocations that pointed to the removed section
+    point now to the kept one. Folding some sections may make identical
+    other sections that call them, so the process is repeated until no
+    more sections are folded.
+    Returns the number of bytes saved.
+    '''
+    # Index the symbols by section, to move them quickly
+    symbols = {}
+    for o in objects:
+        for sym in o.symbols:
+            if isinstance(sym, coff.Symbol) and sym.isdefined():
+                symbols.setdefault(sym.section, []).append(sym)
+    saved = 0
+    folded = True
+    while folded:
+        folded = False
+        kept = {}
+        for o in objects:
+            for s in o.sections[1:]:
+                if not s.iscode() or s.isabsolute():
+                    continue
+                key = _sectionkey(s, externalsyms)
+                if key not in kept:
+                    kept[key] = s
+                    continue
+                # Move the symbols to the kept copy and remove this one
+                k = kept[key]
+                for sym in symbols.pop(s, []):
+                    sym.section = k
+                    symbols.setdefault(k, []).append(sym)
+                o.sections.remove(s)
+                saved += s.size
+                folded = True
+    return saved
+
+def _symbolvalue(symbol, offset, externalsyms):
+    '''Returns the address pointed by a relocation, or None if undefined.'''
+    if not symbol.isdefined():
+        symbol = externalsyms.get(symbol.name)
+        if symbol is None:
+            return None
+    value = symbol.value + offset
+    if not symbol.section.isabsolute():
+        value += symbol.section.paddress
+    return value
+
+def _inrange(value, address, reltype):
+    '''Tells if a relative branch at address can jump to value.'''
+    low, high = _BRANCH_RANGES[reltype]
+    return low <= int((value - address - 2)/2) <= high
+
+class _Trampolines(object):
+    '''The trampolines added to redirect the out of range branches.
+
+    The trampolines go at the end of the section of the branch or, if that
+    is too far, in a stub section placed just before it.
+    '''
+
+    def __init__(self):
+        # The stub section of each section, and the labels in each stub
+        self.stubs = {}
+        self._stublabels = {}
+        self.labels = set()
+
+    def _label(self, obj, section, value, name):
+        label = coff.Symbol(name, value, section, 0, 0, coff._C_LABEL)
+        obj.addsymbol(label)
+        self.labels.add(label)
+        return label
+
+    def address(self, label, section):
+        '''Returns the address of a trampoline for the given section.'''
+        stub = self.stubs.get(section)
+        if label.section is stub:
+            return section.paddress - len(stub.data) + label.value
+        return _symbolvalue(label, 0, {})
+
+    def endaddress(self, section):
+        '''Returns the address of a new trampoline at the end of a section.'''
+        return section.paddress + len(section.data)
+
+    def stubaddress(self, section):
+        '''Returns the address of a new trampoline in the stub of a section.
+
+        The new trampolines go at the beginning of the stub, so that the
+        ones already in it keep their distance to the section.
+        '''
+        stub = self.stubs.get(section)
+        return section.paddress - (len(stub.data) if stub else 0) - 4
+
+    def addend(self, obj, section, symbol, offset):
+        '''Appends a trampoline to the given target at the end of a section.
+
+        Growing a section at its end does not move any of its instructions,
+        so the code already in the section stays valid.
+        Returns the label of the new trampoline.
+        '''
+        section.unshare()
+        tramp = len(section.data)
+        section.data.extend(struct.pack('=HH', _GOTO_OPCODE, _GOTO2_OPCODE))
+        _addgoto(section, tramp, symbol, offset)
+        # The values of the symbols in absolute sections are absolute
+        # addresses
+        value = tramp
+        if section.isabsolute():
+            value += section.paddress
+        return self._label(obj, section, value,
+            '{}.tramp{:#x}'.format(section.name, tramp))
+
+    def addstub(self, obj, section, symbol, offset):
+        '''Puts a trampoline to the given target at the beginning of the stub
+        of a section.
+
+        Returns the label of the new trampoline.
+        '''
+        stub = self.stubs.get(section)
+        if stub is None:
+            stub = coff.Section('{}.tramp'.format(section.name), 0, 0,
+                section.flags)
+            stub.data = bytearray()
+            obj.addsection(stub)
+            self.stubs[section] = stub
+            self._stublabels[stub] = []
+        stub.data[0:0] = struct.pack('=HH', _GOTO_OPCODE, _GOTO2_OPCODE)
+        for r in stub.relocations:
+            r.address += 4
+        for label in self._stublabels[stub]:
+            label.value += 4
+        _addgoto(stub, 0, symbol, offset)
+        label = self._label(obj, stub, 0, '{}.{}'.format(stub.name,
+            len(self._stublabels[stub])))
+        self._stublabels[stub].append(label)
+        return label
+
+def _addgoto(section, address, symbol, offset):
+    '''Adds the relocations of a GOTO to the given target.'''
+    section.relocations.append(
+        coff.Relocation(address, symbol, offset, _RELOCT_GOTO))
+    section.relocations.append(
+        coff.Relocation(address + 2, symbol, offset, _RELOCT_GOTO2))
+
+def _relaxbranches(objects, externalsyms, trampolines):
+    '''Redirect the out of range relative branches through trampolines.
+
+    Each BRA, RCALL or conditional branch that cannot reach its target is
+    pointed to a GOTO appended to its own section or, if that is out of its
+    range too, to a GOTO in a stub section placed just before it. The
+    branches of a section to the same target share the trampolines in
+    range. The branches that can't reach any trampoline are left as they
+    are, to be reported.
+    trampolines: the _Trampolines of the link.
+    Returns the number of trampolines added.
+    '''
+    added = 0
+    # The stubs only have GOTOs
+    stubs = set(trampolines.stubs.values())
     code_sections = [(s, o) for o in objects for s in o.sections[1:]
-        if s.iscode()]
+        if s.iscode() and s not in stubs]
     for s, o in code_sections:
-        for r in s.relocations:
-            # Get the value for patching
+        shared = {}
+        # The relocations of the new trampolines need not to be checked
+        for r in s.relocations[:]:
+            # The branches already redirected are always in range
+            if (r.reltype not in _BRANCH_RANGES
+                    or r.symbol in trampolines.labels):
+                continue
+            address = s.paddress + r.address
+            value = _symbolvalue(r.symbol, r.offset, externalsyms)
+            if value is None or _inrange(value, address, r.reltype):
+                continue
             symbol = r.symbol
             if not symbol.isdefined():
-                # The symbol to use is an external symbol
-                if symbol.name not in externalsyms:
-                    # Report error only the first time
-                    if symbol.name not in undefset:
-                        error.errorfa(o.filename, s.name, r.address,
-                            "undefined symbol {b}'{s}'{re}".format(
-                            b=error.BOLD, re=error.RESET, s=symbol.name))
-                        undefset.add(symbol.name)
-                        if not noteseen:
-                            error.notefa(o.filename, s.name, r.address,
-                                'each undefined symbol is reported only once')
-                            noteseen = True
-                    continue
                 symbol = externalsyms[symbol.name]
-            value = symbol.value + r.offset
-            if not symbol.section.isabsolute():
-                value += symbol.section.paddress
-            # The passed addr parameter must be the address of the first byte
-            # of the current instruction. As addr is in fact the index of a
-            # word, this value must be multiplied by two.
-            context = _RelocationContext(
-                o.filename, s, r.address, value, picinfo)
-            s.data[r.address:r.address + 2] = struct.pack(
-                '=H', _RELOCT_DICT[r.reltype](context))
-
-def _buildhex(objects):
-    '''Builds an HEX object with the binary data.'''
+            key = (symbol, r.offset)
+            label = None
+            for l in shared.get(key, []):
+                if _inrange(trampolines.address(l, s), address, r.reltype):
+                    label = l
+                    break
+            if label is None:
+                if _inrange(trampolines.endaddress(s), address, r.reltype):
+                    label = trampolines.addend(o, s, symbol, r.offset)
+                elif (not s.isabsolute() and _inrange(
+                        trampolines.stubaddress(s), address, r.reltype)):
+                    label = trampolines.addstub(o, s, symbol, r.offset)
+                else:
+                    continue
+                shared.setdefault(key, []).append(label)
+                added += 1
+            r.symbol = label
+            r.offset = 0
+    return added
+
+def _applyrelocations(obj, section, externalsyms, picinfo, undefset):
+    '''Patch the data of a code section with the right addresses.
+
+    undefset: the names of the undefined symbols already reported, to avoid
+        repeating error messages.
+    '''
+    patches = _getpatches()
+    if section.relocations:
+        section.unshare()
+    for r in section.relocations:
+        # Get the value for patching
+        value = _symbolvalue(r.symbol, r.offset, externalsyms)
+        if value is None:
+            # Report error only the first time
+            symbol = r.symbol
+            if symbol.name not in undefset:
+                error.errorfa(obj.filename, section.name, r.address,
+                    "undefined symbol {b}'{s}'{re}".format(
+                    b=error.BOLD, re=error.RESET, s=symbol.name), symbol.name)
+                if not undefset:
+                    error.notefa(obj.filename, section.name, r.address,
+                        'each undefined symbol is reported only once')
+                undefset.add(symbol.name)
+            continue
+        # The passed addr parameter must be the address of the first byte
+        # of the current instruction. As addr is in fact the index of a
+        # word, this value must be multiplied by two.
+        context = _RelocationContext(
+            obj.filename, section, r.address, value, picinfo, r.symbol.name)
+        section.data[r.address:r.address + 2] = struct.pack(
+            '=H', patches[r.reltype](context))
+
+def _buildhex(objects, externalsyms, picinfo, release=False):
+    '''Relocates the sections and builds an HEX object with their data.
+
+    Each section is written to the HEX object as soon as it's relocated.
+    release: if True, the data, relocations and line numbers of each section
+        are freed once it's written, only its address and size are kept.
+    '''
+    import intelhex
     ih = intelhex.IntelHex()
+    undefset = set()
     for o in objects:
         for s in o.sections[1:]:
+            if s.iscode():
+                _applyrelocations(o, s, externalsyms, picinfo, undefset)
             if s.iscode() or s.isprogramdata():
                 ih.puts(s.paddress, bytes(s.data))
+            if release:
+                s.release()
     return ih
 
-def link(objects):
+def getprocessor(objects):
+    '''Returns the processor of the first object that has one.
+
+    The objects read from HEX files don't have processor. Returns None if no
+    object has one.
+    '''
+    return next((o.processor for o in objects if o.processor is not None),
+        None)
+
+def link(objects, relax=True, processor=None, script=None, merge=True,
+         icf=False, optimize_access=False, cluster=False, overlay=False,
+         color_banks=False, memory=None, release=False):
     '''Link together several Coff objects to create a PIC program.
 
-    objects: the list of Coff objects to link together.
+    objects: the list of Coff objects to link together. They are modified,
+        link copies of them (see Coff.clone) to link them more than once.
+    relax: if True, out of range relative branches are redirected through
+        trampolines instead of reported as errors.
+    processor: the processor to link for. By default, the processor the
+        objects were assembled for.
+    script: a lkr.LinkerScript with the memory regions to use. By default,
+        all the memory of the processor is available.
+    merge: if True, the relocatable sections with the same name and flags
+        from different objects are placed together.
+    icf: if True, the identical relocatable code sections are folded into
+        a single copy.
+    optimize_access: if True, the udata sections accessed by more
+        instructions are placed in the access RAM left free.
+    cluster: if True, the code sections that call each other are placed
+        together, instead of in the order of the objects.
+    overlay: if True, the overlay udata sections used by code that never
+        runs at the same time share RAM, even if their names differ.
+    color_banks: if True, the udata sections used by the same code are
+        placed in the same bank, so that the code selects the bank less.
+    memory: if given, a memmap.MemoryReport that is filled with the use of
+        the memory once the sections are placed.
+    release: if True, the data, relocations and line numbers of the
+        sections are freed as soon as they are written to the HEX object,
+        so that they don't take memory at the same time. The addresses,
+        sizes and symbols are kept.
 
     Precondition: objects has at least one element.
     '''
-    # Check that all the objects are assembled for the same processor
-    processor = objects[0].processor
-    for o in objects[1:]:
-        if o.processor != processor:
-            error.warnf(o.filename, 'processor mismatch')
+    # Check that all the objects are assembled for the same processor. The
+    # objects read from HEX files don't have processor
+    if processor is None:
+        processor = getprocessor(objects)
+        for o in objects:
+            if o.processor is not None and o.processor != processor:
+                error.warnf(o.filename, 'processor mismatch')
+        if processor is None:
+            error.fatal('no processor to link for, the HEX files don\'t tell '
+                'it (link them with at least one COFF object)')
 
     # Load the configuration for the given Microcontroller
     picinfo = _loadpicinfo(processor)
 
-    # Create memory allocator objects for data and code
-    codemem = _MemoryAllocator(picinfo.progmem)
-    datamem = _MemoryAllocator(picinfo.ram)
-
-    _allocsections(objects, picinfo, codemem, datamem)
     # Get a dictionary with the external symbols
     externalsyms = _getexternals(objects)
-    _applyrelocations(objects, externalsyms, picinfo)
-    
-    # Build the HEX object
-    return _buildhex(objects)
+    if icf:
+        _foldcode(objects, externalsyms)
+    accesses = None
+    if optimize_access:
+        accesses = _countaccesses(objects, externalsyms)
+    layout = None
+    if cluster:
+        layout = _clustercode(objects, externalsyms, merge)
+    uses = None
+    if color_banks:
+        uses = _bankuses(objects, externalsyms)
+
+    # Adding trampolines makes the sections grow, so the layout is repeated
+    # until no more branches need them
+    plan = _PlacementPlan(picinfo, script)
+    stack = None
+    if overlay:
+        stack = _compiledstack(objects, externalsyms, plan, merge)
+    trampolines = _Trampolines()
+    passes = 0
+    while True:
+        plan.reset()
+        errors = error.errors
+        promoted, colored, before = _allocsections(objects, plan, merge,
+            accesses, layout, stack, uses, trampolines.stubs)
+        if (not relax or error.errors != errors
+                or passes == _MAX_RELAX_PASSES
+                or not _relaxbranches(objects, externalsyms, trampolines)):
+            break
+        passes += 1
+    if optimize_access:
+        sections = [s for group in promoted for s, o in group]
+        saved = sum(accesses.get(s, 0) for s in sections)
+        error.note('{} sections ({} bytes) moved to access RAM, up to {} '
+            'bank selections saved (1 cycle each)'.format(len(sections),
+            sum(s.size for s in sections), saved))
+    if overlay:
+        frames = [g for area in stack for _, g in area[2]]
+        saved = (sum(_grouplayout(g)[1] for g in frames)
+            - sum(area[1] for area in stack))
+        error.note('{} overlay sections share RAM, {} bytes saved'.format(
+            len(frames), saved))
+    if color_banks:
+        after = _crossbank(uses, lambda s: s.paddress)
+        error.note('{} udata sections placed by bank, {} cross-bank accesses '
+            'avoided ({} left)'.format(sum(len(g) for g in colored),
+            max(before - after, 0), after))
+    if memory is not None:
+        memory.fill(plan, objects)
+
+    # Relocate the sections and build the HEX object
+    return _buildhex(objects, externalsyms, picinfo, release)
 
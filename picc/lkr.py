@@ -0,0 +1,189 @@
+'''Read linker scripts in the gplink format.
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+import re
+from . import error
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
+__version__ = '0.2.2'
+__license__ = 'GPL'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+CODEPAGE = 'CODEPAGE'
+DATABANK = 'DATABANK'
+ACCESSBANK = 'ACCESSBANK'
+SHAREBANK = 'SHAREBANK'
+
+_REGION_KINDS = [CODEPAGE, DATABANK, ACCESSBANK, SHAREBANK]
+_COMMENT = re.compile(r'//.*')
+_TOKEN = re.compile(r'[^\s=]+\s*=\s*(?:[^\s=+-]+(?:\s*[+-]\s*[^\s=+-]+)*)'
+    r'|[^\s=]+')
+_TERM = re.compile(r'\s*([+-]?)\s*([^\s+-]+)')
+
+class Region(object):
+    '''A range of memory where the linker can place sections.'''
+
+    def __init__(self, kind, name, start, end, protected):
+        '''Creates a region.
+
+        kind: one of CODEPAGE, DATABANK, ACCESSBANK or SHAREBANK.
+        name: the name of the region. All the SHAREBANK regions with the
+            same name are mirrors of the same memory.
+        start: first address of the region.
+        end: last address of the region (included).
+        protected: if True, only the sections explicitly assigned to this
+            region (or absolute) can be placed in it.
+        '''
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.end = end
+        self.protected = protected
+
+    def iscode(self):
+        return self.kind == CODEPAGE
+
+    @property
+    def size(self):
+        return self.end - self.start + 1
+
+    def __str__(self):
+        return '{} {} [{:#x}, {:#x}]{}'.format(self.kind, self.name,
+            self.start, self.end, ' PROTECTED' if self.protected else '')
+
+class LinkerScript(object):
+    '''The contents of a linker script.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.regions = []
+        # Section name to region name
+        self.sections = {}
+        self.libpath = []
+        self.files = []
+        # Size of the stack and region where it must be placed
+        self.stack = None
+
+    def addregion(self, region):
+        self.regions.append(region)
+
+def _evaluate(text, defines):
+    '''Evaluates an expression made of numbers, names, + and -.'''
+    value = 0
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        m = _TERM.match(text, pos)
+        if m is None:
+            raise ValueError("invalid expression '{}'".format(text))
+        sign, term = m.groups()
+        if term in defines:
+            # Remove the name to avoid endless recursion in cyclic defines
+            others = dict(defines)
+            del others[term]
+            term = _evaluate(defines[term], others)
+        else:
+            term = int(term, 0)
+        value += -term if sign == '-' else term
+        pos = m.end()
+    return value
+
+def _attributes(tokens):
+    '''Returns a dictionary with the NAME=VALUE attributes of a directive.'''
+    attrs = {}
+    for t in tokens:
+        if '=' in t:
+            name, value = t.split('=', 1)
+            attrs[name.strip().upper()] = value.strip()
+        else:
+            attrs[t.upper()] = None
+    return attrs
+
+def _parseline(script, tokens, defines):
+    '''Interprets a directive of a linker script.'''
+    directive = tokens[0].upper()
+    attrs = _attributes(tokens[1:])
+    if directive in _REGION_KINDS:
+        script.addregion(Region(directive, attrs['NAME'],
+            _evaluate(attrs['START'], defines),
+            _evaluate(attrs['END'], defines), 'PROTECTED' in attrs))
+    elif directive == 'SECTION':
+        region = attrs.get('ROM', attrs.get('RAM'))
+        if region is None:
+            raise KeyError('ROM or RAM')
+        script.sections[attrs['NAME']] = region
+    elif directive == 'LIBPATH':
+        script.libpath.extend(t for t in tokens[1:] if t != ';')
+    elif directive == 'FILES':
+        script.files.extend(tokens[1:])
+    elif directive == 'STACK':
+        script.stack = (_evaluate(attrs['SIZE'], defines), attrs.get('RAM'))
+    else:
+        raise ValueError("unknown directive '{}'".format(tokens[0]))
+
+def readscript(filename, defines=None):
+    '''Reads a linker script.
+
+    filename: the name of the linker script.
+    defines: dictionary with the names defined for the #IFDEF directives,
+        like the -D option of gplink.
+    Returns a LinkerScript object.
+    '''
+    defines = dict(defines or {})
+    script = LinkerScript(filename)
+    # Stack of the states of the nested #IFDEF: True if the lines inside
+    # are taken into account
+    active = [True]
+    with open(filename) as f:
+        for linenum, line in enumerate(f, 1):
+            line = _COMMENT.sub('', line).strip()
+            if not line:
+                continue
+            try:
+                tokens = _TOKEN.findall(line)
+                directive = tokens[0].upper()
+                if directive in ('#IFDEF', '#IFNDEF'):
+                    cond = (tokens[1] in defines) == (directive == '#IFDEF')
+                    active.append(active[-1] and cond)
+                elif directive in ('#ELSE', '#FI') and len(active) == 1:
+                    raise ValueError('{} without #IFDEF'.format(tokens[0]))
+                elif directive == '#ELSE':
+                    active[-1] = not active[-1] and active[-2]
+                elif directive == '#FI':
+                    active.pop()
+                elif not active[-1]:
+                    continue
+                elif directive == '#DEFINE':
+                    parts = line.split(None, 2)
+                    defines[parts[1]] = parts[2] if len(parts) > 2 else ''
+                else:
+                    _parseline(script, tokens, defines)
+            except KeyError as ke:
+                error.fatalf(filename, 'line {}: missing attribute {}'.format(
+                    linenum, ke))
+            except (ValueError, IndexError) as e:
+                error.fatalf(filename, 'line {}: {}'.format(linenum, e))
+    if len(active) > 1:
+        error.fatalf(filename, 'missing #FI')
+    return script
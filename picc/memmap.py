@@ -0,0 +1,165 @@
+'''Report of the use of the memory after a link.
+
+For each memory region the report tells how many bytes are used and which
+is the largest free hole, so that the layouts about to overflow can be
+spotted. The holes of each memory space are also counted by size, to see
+how fragmented the free memory is, and the sections that use more memory
+are listed.
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
+__version__ = '0.2.2'
+__license__ = 'GPL'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+FORMATS = ['text', 'json']
+
+# Number of sections listed as the top consumers
+_TOP = 10
+
+def _clip(holes, start, end):
+    '''Returns the parts of the holes inside [start, end].
+
+    holes: list of (start, size) tuples, sorted by address.
+    '''
+    clipped = []
+    for h, size in holes:
+        low = max(h, start)
+        high = min(h + size - 1, end)
+        if low <= high:
+            clipped.append((low, high - low + 1))
+    return clipped
+
+def _union(regions):
+    '''Returns the ranges covered by the regions, as (start, end) tuples.'''
+    ranges = []
+    for r in sorted(regions, key=lambda r: r.start):
+        if ranges and r.start <= ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], r.end))
+        else:
+            ranges.append((r.start, r.end))
+    return ranges
+
+def _histogram(holes):
+    '''Counts the holes by size, in buckets of powers of two.
+
+    Returns a sorted list of (lowest size, highest size, number of holes).
+    '''
+    counts = {}
+    for _, size in holes:
+        low = 1 << (size.bit_length() - 1)
+        counts[low] = counts.get(low, 0) + 1
+    return [(low, 2 * low - 1, n) for low, n in sorted(counts.items())]
+
+class MemoryReport(object):
+    '''The use of the memory of a linked program.'''
+
+    def __init__(self):
+        self.regions = []
+        self.spaces = []
+        self.consumers = []
+
+    def fill(self, plan, objects):
+        '''Takes the use of the memory from a placement plan.
+
+        plan: the placement plan used to place the sections of the objects.
+        objects: the linked objects.
+        '''
+        spaces = (('program', plan.coderegions, plan.codemem),
+            ('data', plan.dataregions, plan.datamem))
+        self.regions = []
+        self.spaces = []
+        for space, regions, allocator in spaces:
+            freemem = [(h.start, h.size) for h in allocator.freemem
+                if h.size]
+            for r in regions:
+                holes = _clip(freemem, r.start, r.end)
+                free = sum(size for _, size in holes)
+                self.regions.append({'space': space, 'kind': r.kind,
+                    'name': r.name, 'start': r.start, 'end': r.end,
+                    'size': r.size, 'used': r.size - free, 'free': free,
+                    'largest_hole': max([0] + [s for _, s in holes]),
+                    'protected': r.protected})
+            holes = []
+            for start, end in _union(regions):
+                holes.extend(_clip(freemem, start, end))
+            size = sum(end - start + 1 for start, end in _union(regions))
+            free = sum(s for _, s in holes)
+            self.spaces.append({'space': space, 'size': size,
+                'used': size - free, 'free': free, 'holes': len(holes),
+                'largest_hole': max([0] + [s for _, s in holes]),
+                'histogram': [{'min': low, 'max': high, 'holes': n}
+                    for low, high, n in _histogram(holes)]})
+        # The sections with the same name are counted together. The overlay
+        # ones share their memory, so only the largest counts
+        usage = {}
+        for o in objects:
+            for s in o.sections[1:]:
+                if (not s.size or s.paddress is None
+                        or s in plan.unplaced):
+                    continue
+                key = ('program' if plan.iscodespace(s) else 'data', s.name)
+                used = usage.setdefault(key, [0, 0])
+                used[0] = max(used[0], s.size) if s.isoverlay() else (
+                    used[0] + s.size)
+                used[1] += 1
+        if plan.stack is not None:
+            usage[('data', '(stack)')] = [plan.stack[0], 0]
+        consumers = sorted(usage.items(), key=lambda kv: (-kv[1][0], kv[0]))
+        self.consumers = [{'space': space, 'name': name, 'size': size,
+            'sections': n} for (space, name), (size, n) in consumers[:_TOP]]
+
+    def todict(self):
+        return {'regions': self.regions, 'spaces': self.spaces,
+            'consumers': self.consumers}
+
+    def tojson(self):
+        import json
+        return json.dumps(self.todict(), sort_keys=True)
+
+    def __str__(self):
+        lines = ['{:<10} {:<12} {:>17} {:>8} {:>8} {:>6} {:>8}'.format(
+            'kind', 'region', 'range', 'used', 'free', '%', 'largest')]
+        for r in self.regions:
+            lines.append('{:<10} {:<12} {:>17} {:>8} {:>8} {:>6.1f} '
+                '{:>8}'.format(r['kind'], r['name'] + (' (p)' if
+                r['protected'] else ''), '{:#x}-{:#x}'.format(r['start'],
+                r['end']), r['used'], r['free'],
+                100.0 * r['used'] / r['size'], r['largest_hole']))
+        for s in self.spaces:
+            lines.append('')
+            lines.append('{} memory: {} of {} bytes used ({:.1f}%), {} holes, '
+                'largest {}'.format(s['space'], s['used'], s['size'],
+                100.0 * s['used'] / s['size'] if s['size'] else 0.0,
+                s['holes'], s['largest_hole']))
+            for h in s['histogram']:
+                lines.append('  {:>17} bytes: {}'.format('{}-{}'.format(
+                    h['min'], h['max']), h['holes']))
+        lines.append('')
+        lines.append('{:>8}  {:<8} section'.format('size', 'space'))
+        for c in self.consumers:
+            lines.append('{:>8}  {:<8} {}{}'.format(c['size'], c['space'],
+                c['name'], ' ({} sections)'.format(c['sections'])
+                if c['sections'] > 1 else ''))
+        return '\n'.join(lines)
@@ -0,0 +1,181 @@
+'''Stages that overlap the reading and writing of files with the link.
+
+The Prefetcher reads the input files in a pool of threads while the ones
+already read are parsed, and the BackgroundWriter writes the output file
+from a thread while the program goes on. Each stage holds a bounded number
+of files or chunks, and measures how long it worked and how long the
+program waited for it.
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+import collections
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
+__version__ = '0.2.2'
+__license__ = 'GPL'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+DEFAULT_DEPTH = 8
+
+# Size of the chunks written by the BackgroundWriter
+_CHUNK_SIZE = 64 * 1024
+
+class Stage(object):
+    '''The time spent by a stage of the pipeline.
+
+    busy: seconds the stage spent working.
+    waited: seconds the program waited for the stage.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def addbusy(self, seconds):
+        # The busy time is added from several threads
+        with self._lock:
+            self.busy += seconds
+
+    def __str__(self):
+        return '{}: {:.1f} ms ({:.1f} ms waited)'.format(self.name,
+            self.busy * 1000, self.waited * 1000)
+
+class Prefetcher(object):
+    '''Reads files ahead of their use in a pool of threads.
+
+    Iterating the prefetcher yields the contents of the files in order. At
+    most depth files are read or kept ahead of the one being used.
+    '''
+
+    def __init__(self, read, filenames, threads, depth=DEFAULT_DEPTH):
+        '''Starts reading the first files.
+
+        read: the function that returns the contents of a file.
+        filenames: the files to read.
+        threads: number of files read at the same time.
+        depth: maximum number of files read ahead.
+        '''
+        import concurrent.futures
+        self.stage = Stage('read')
+        self._read = read
+        self._pending = collections.deque(filenames)
+        self._futures = collections.deque()
+        self._depth = max(depth, 1)
+        self._pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self._fill()
+
+    def _timedread(self, filename):
+        start = time.time()
+        try:
+            return self._read(filename)
+        finally:
+            self.stage.addbusy(time.time() - start)
+
+    def _fill(self):
+        '''Starts the reads until there are depth files ahead.'''
+        while self._pending and len(self._futures) < self._depth:
+            self._futures.append(self._pool.submit(self._timedread,
+                self._pending.popleft()))
+
+    def __iter__(self):
+        try:
+            while self._futures:
+                future = self._futures.popleft()
+                start = time.time()
+                data = future.result()
+                self.stage.waited += time.time() - start
+                self._fill()
+                yield data
+        finally:
+            # Don't read the rest if the program stops using the files
+            self._pending.clear()
+            for f in self._futures:
+                f.cancel()
+            self._pool.shutdown()
+
+class BackgroundWriter(object):
+    '''A text file written by a thread.
+
+    The text written is joined in chunks, and at most depth chunks wait to
+    be written. The errors of the writes are raised by close.
+    '''
+
+    def __init__(self, filename, depth=DEFAULT_DEPTH):
+        self.stage = Stage('write')
+        self._file = open(filename, 'w')
+        self._queue = queue.Queue(max(depth, 1))
+        self._chunk = []
+        self._size = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            if self._error is not None:
+                continue
+            start = time.time()
+            try:
+                self._file.write(chunk)
+            except IOError as e:
+                self._error = e
+            self.stage.addbusy(time.time() - start)
+
+    def _put(self, chunk):
+        start = time.time()
+        self._queue.put(chunk)
+        self.stage.waited += time.time() - start
+
+    def write(self, text):
+        self._chunk.append(text)
+        self._size += len(text)
+        if self._size >= _CHUNK_SIZE:
+            self._put(''.join(self._chunk))
+            self._chunk = []
+            self._size = 0
+
+    def close(self):
+        '''Waits until everything is written and closes the file.'''
+        if self._chunk:
+            self._put(''.join(self._chunk))
+            self._chunk = []
+        self._put(None)
+        start = time.time()
+        self._thread.join()
+        self.stage.waited += time.time() - start
+        self._file.close()
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,770 @@
+'''Simulate the PIC18 instruction set to profile linked programs.
+
+The simulator runs a linked program (the IntelHex object returned by
+linker.link or read from a HEX file) and counts the cycles spent in each
+instruction and in each symbol. It has no peripherals: the registers of the
+peripherals are plain memory unless a hook gives them a behaviour.
+
+Each program word is decoded once, the first time it's executed, into a
+method and its operands, so running an instruction again is a lookup and a
+call.
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+import bisect
+from . import disasm
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
+__version__ = '0.2.2'
+__license__ = 'GPL'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+# Size of the data memory and first address of the SFRs in the access bank
+_RAM_SIZE = 0x1000
+_DEFAULT_ACCESS = 0x60
+# The program memory ends where the configuration memory begins
+_PROGMEM_END = 0x200000
+_STACK_SIZE = 31
+
+# Special function registers
+_STATUS = 0xfd8
+_FSR2L = 0xfd9
+_BSR = 0xfe0
+_FSR1L = 0xfe1
+_WREG = 0xfe8
+_FSR0L = 0xfe9
+_PRODL = 0xff3
+_PRODH = 0xff4
+_TABLAT = 0xff5
+_TBLPTRL = 0xff6
+_PCL = 0xff9
+_PCLATH = 0xffa
+_PCLATU = 0xffb
+
+# Indirect addressing registers: INDFn, POSTINCn, POSTDECn, PREINCn and
+# PLUSWn are at consecutive decreasing addresses from INDFn
+_INDF = {0xfef: _FSR0L, 0xfe7: _FSR1L, 0xfdf: _FSR2L}
+_INDIRECT = dict((indf - mode, (fsr, mode)) for indf, fsr in _INDF.items()
+    for mode in range(5))
+_MODE_INDF = 0
+_MODE_POSTINC = 1
+_MODE_POSTDEC = 2
+_MODE_PREINC = 3
+_MODE_PLUSW = 4
+
+# STATUS bits
+_C = 0x01
+_DC = 0x02
+_Z = 0x04
+_OV = 0x08
+_N = 0x10
+
+# Marks the file register operands that use the BSR
+_BANKED = 0x10000
+
+class SimulationError(Exception):
+    '''Raised when the simulated program can't go on.'''
+
+class Simulator(object):
+    '''A PIC18 core running a linked program.'''
+
+    def __init__(self, program, labels=None, access=_DEFAULT_ACCESS):
+        '''Creates a simulator and resets it.
+
+        program: the IntelHex object with the program.
+        labels: dictionary from program address to the names of the symbols
+            at that address (see disasm.programlabels), to profile by symbol.
+        access: the first address of the access bank that is mapped to the
+            SFRs instead of the general purpose RAM.
+        '''
+        addresses = [a for a in program.todict() if isinstance(a, int)
+            and a < _PROGMEM_END]
+        size = max(addresses) + 2 if addresses else 2
+        self.flash = bytearray([0xff] * (size + size % 2))
+        for a in addresses:
+            self.flash[a] = program[a]
+        self.labels = labels or {}
+        self.access = access
+        self._readhooks = {}
+        self._writehooks = {}
+        # Decoded instructions by address
+        self._code = {}
+        self.reset()
+
+    def reset(self):
+        '''Clears the state of the core and the counters.'''
+        self.ram = bytearray(_RAM_SIZE)
+        self.pc = 0
+        self.stack = []
+        self.halted = False
+        self.cycles = 0
+        self.counts = {}
+        # The fast register stack (WREG, STATUS and BSR)
+        self._shadow = (0, 0, 0)
+        self._special = set(_INDIRECT) | set([_PCL]) | set(self._readhooks)
+        self._special.update(self._writehooks)
+
+    def addhook(self, address, read=None, write=None):
+        '''Gives a behaviour to a register of the data memory.
+
+        address: the address of the register.
+        read: function called with the simulator and the address when the
+            register is read, that returns the value read.
+        write: function called with the simulator, the address and the value
+            when the register is written.
+        '''
+        if read is not None:
+            self._readhooks[address] = read
+        if write is not None:
+            self._writehooks[address] = write
+        self._special.add(address)
+
+    @property
+    def w(self):
+        return self.ram[_WREG]
+
+    @w.setter
+    def w(self, value):
+        self.ram[_WREG] = value & 0xff
+
+    def address(self, name):
+        '''Returns the program address of a symbol.'''
+        for address, names in self.labels.items():
+            if name in names:
+                return address
+        raise KeyError(name)
+
+    def run(self, cycles=None, until=None):
+        '''Runs the program.
+
+        cycles: stop after (at least) this number of cycles.
+        until: stop when the program reaches this address or symbol.
+        The program also stops when it executes SLEEP or RESET.
+        Returns the number of cycles run.
+        '''
+        if isinstance(until, str):
+            until = self.address(until)
+        limit = None if cycles is None else self.cycles + cycles
+        start = self.cycles
+        code = self._code
+        counts = self.counts
+        self.halted = False
+        while not self.halted:
+            pc = self.pc
+            if pc == until or (limit is not None and self.cycles >= limit):
+                break
+            entry = code.get(pc)
+            if entry is None:
+                entry = self._decode(pc)
+            method, args, size = entry
+            self.pc = pc + size
+            try:
+                c = method(*args)
+            except SimulationError as e:
+                self.pc = pc
+                raise SimulationError('{} at {:#08x}'.format(e, pc))
+            self.cycles += c
+            counts[pc] = counts.get(pc, 0) + c
+        return self.cycles - start
+
+    def profile(self):
+        '''Returns the cycles spent in each symbol.
+
+        The cycles of an instruction go to the closest symbol before it.
+        Returns a list of tuples (symbol, cycles) sorted by cycles.
+        '''
+        starts = sorted(self.labels)
+        bysymbol = {}
+        for pc, c in self.counts.items():
+            i = bisect.bisect_right(starts, pc) - 1
+            if i < 0:
+                name = '{:#08x}'.format(pc)
+            else:
+                name = ', '.join(sorted(self.labels[starts[i]]))
+            bysymbol[name] = bysymbol.get(name, 0) + c
+        return sorted(bysymbol.items(), key=lambda x: (-x[1], x[0]))
+
+    # Memory access
+
+    def _word(self, address):
+        if address + 1 >= len(self.flash):
+            return 0xffff
+        return self.flash[address] | self.flash[address + 1] << 8
+
+    def _file(self, f, a):
+        '''Returns the operand of a file register instruction.'''
+        if a:
+            return f | _BANKED
+        return f if f < self.access else 0xf00 | f
+
+    def _address(self, x):
+        '''Returns the address of a file register operand.'''
+        if x & _BANKED:
+            return (self.ram[_BSR] & 0xf) << 8 | (x & 0xff)
+        return x
+
+    def _operand(self, x):
+        '''Returns the address of the operand of a read-modify-write
+        instruction.
+
+        The indirect addressing registers are resolved here, so that their
+        FSR is only changed once by the read and the write.
+        '''
+        address = self._address(x)
+        if (address in _INDIRECT and address not in self._readhooks
+                and address not in self._writehooks):
+            address = self._indirect(address)
+        return address
+
+    def _indirect(self, address):
+        '''Returns the address pointed by an indirect addressing register.'''
+        fsr, mode = _INDIRECT[address]
+        pointer = (self.ram[fsr + 1] & 0xf) << 8 | self.ram[fsr]
+        target = pointer
+        if mode == _MODE_POSTINC:
+            pointer += 1
+        elif mode == _MODE_POSTDEC:
+            pointer -= 1
+        elif mode == _MODE_PREINC:
+            pointer += 1
+            target = pointer
+        elif mode == _MODE_PLUSW:
+            w = self.ram[_WREG]
+            target = pointer + (w - 0x100 if w & 0x80 else w)
+        pointer &= 0xfff
+        self.ram[fsr] = pointer & 0xff
+        self.ram[fsr + 1] = pointer >> 8
+        return target & 0xfff
+
+    def read(self, address):
+        '''Reads a register of the data memory.'''
+        if address in self._special:
+            hook = self._readhooks.get(address)
+            if hook is not None:
+                return hook(self, address) & 0xff
+            if address in _INDIRECT:
+                return self.read(self._indirect(address))
+            if address == _PCL:
+                self.ram[_PCLATH] = (self.pc >> 8) & 0xff
+                self.ram[_PCLATU] = (self.pc >> 16) & 0x1f
+                return self.pc & 0xff
+        return self.ram[address]
+
+    def write(self, address, value):
+        '''Writes a register of the data memory.'''
+        value &= 0xff
+        if address in self._special:
+            hook = self._writehooks.get(address)
+            if hook is not None:
+                hook(self, address, value)
+                return
+            if address in _INDIRECT:
+                self.write(self._indirect(address), value)
+                return
+            if address == _PCL:
+                self.pc = (self.ram[_PCLATU] << 16 | self.ram[_PCLATH] << 8
+                    | value) & ~1
+        self.ram[address] = value
+
+    def _push(self, address):
+        if len(self.stack) == _STACK_SIZE:
+            raise SimulationError('stack overflow')
+        self.stack.append(address)
+
+    def _pop(self):
+        if not self.stack:
+            raise SimulationError('stack underflow')
+        return self.stack.pop()
+
+    def _setflags(self, result, mask):
+        '''Sets the Z and N flags of a result, clearing the ones in mask.'''
+        status = self.ram[_STATUS] & ~mask
+        if not result:
+            status |= _Z
+        if result & 0x80:
+            status |= _N
+        self.ram[_STATUS] = status
+
+    def _add(self, a, b, carry=0):
+        '''Adds two bytes and a carry and sets all the flags.'''
+        result = a + b + carry
+        status = self.ram[_STATUS] & ~(_C | _DC | _Z | _OV | _N)
+        if result > 0xff:
+            status |= _C
+        if (a & 0xf) + (b & 0xf) + carry > 0xf:
+            status |= _DC
+        result &= 0xff
+        if not result:
+            status |= _Z
+        if result & 0x80:
+            status |= _N
+        if ~(a ^ b) & (a ^ result) & 0x80:
+            status |= _OV
+        self.ram[_STATUS] = status
+        return result
+
+    def _sub(self, a, b, borrow=0):
+        '''Subtracts b and a borrow from a. The carry is set if no borrow.'''
+        return self._add(a, ~b & 0xff, 1 - borrow)
+
+    def _carry(self):
+        return self.ram[_STATUS] & _C
+
+    def _skip(self):
+        '''Skips the next instruction. Returns the cycles of the skip.'''
+        entry = self._code.get(self.pc) or self._decode(self.pc)
+        self.pc += entry[2]
+        return entry[2] // 2
+
+    # Decoding
+
+    def _decode(self, pc):
+        '''Decodes the instruction at pc.
+
+        Returns a tuple (method, arguments, size).
+        '''
+        if pc >= len(self.flash) or pc & 1:
+            raise SimulationError('no program at {:#08x}'.format(pc))
+        word = self._word(pc)
+        entry = disasm._gettable()[word]
+        if entry is None:
+            raise SimulationError('invalid instruction {:#06x} at {:#08x}'
+                .format(word, pc))
+        mnemonic, fmt = entry
+        size = 2
+        second = 0
+        if fmt in disasm._TWO_WORDS:
+            second = self._word(pc + 2)
+            if second & 0xf000 != 0xf000:
+                raise SimulationError('invalid instruction {:#06x} at '
+                    '{:#08x}'.format(word, pc))
+            size = 4
+        f = word & 0xff
+        a = (word >> 8) & 1
+        if fmt == disasm._FDA:
+            args = (_FDA_OPS[mnemonic], self._file(f, a), (word >> 9) & 1)
+            method = self._fda
+            if mnemonic in _FDA_SKIPS:
+                method = self._fdaskip
+                args += (_FDA_SKIPS[mnemonic],)
+        elif fmt == disasm._FA:
+            args = (self._file(f, a),)
+            method = getattr(self, '_' + mnemonic)
+        elif fmt == disasm._BFA:
+            args = (self._file(f, a), 1 << ((word >> 9) & 7))
+            method = getattr(self, '_' + mnemonic)
+        elif fmt in (disasm._N8, disasm._N11):
+            if fmt == disasm._N8:
+                n = f - 0x100 if f & 0x80 else f
+                method = self._condbranch
+                args = (_CONDITIONS[mnemonic], pc + 2 + 2 * n)
+            else:
+                n = word & 0x7ff
+                n = n - 0x800 if n & 0x400 else n
+                method = getattr(self, '_' + mnemonic)
+                args = (pc + 2 + 2 * n,)
+        elif fmt == disasm._K8:
+            method = getattr(self, '_' + mnemonic)
+            args = (f,)
+        elif fmt == disasm._K4:
+            method = self._movlb
+            args = (word & 0xf,)
+        elif fmt == disasm._S:
+            method = getattr(self, '_' + mnemonic)
+            args = (word & 1,)
+        elif fmt in (disasm._CALL, disasm._GOTO):
+            method = getattr(self, '_' + mnemonic)
+            args = (((second & 0xfff) << 8 | f) << 1,)
+            if fmt == disasm._CALL:
+                args += (a,)
+        elif fmt == disasm._LFSR:
+            method = self._lfsr
+            args = ((_FSR0L, _FSR1L, _FSR2L)[(word >> 4) & 3],
+                (word & 0xf) << 8 | second & 0xff)
+        elif fmt == disasm._MOVFF:
+            method = self._movff
+            args = (word & 0xfff, second & 0xfff)
+        else:
+            method = getattr(self, '_' + _NAMES.get(mnemonic, mnemonic))
+            args = ()
+        entry = (method, args, size)
+        self._code[pc] = entry
+        return entry
+
+    # Instructions. Each one returns the number of cycles it takes
+
+    def _fda(self, op, x, d):
+        address = self._operand(x)
+        result = op(self, self.read(address), self.ram[_WREG])
+        if d:
+            self.write(address, result)
+        else:
+            self.ram[_WREG] = result
+        return 1
+
+    def _fdaskip(self, op, x, d, zero):
+        address = self._operand(x)
+        result = op(self, self.read(address), self.ram[_WREG])
+        if d:
+            self.write(address, result)
+        else:
+            self.ram[_WREG] = result
+        if (result == 0) == zero:
+            return 1 + self._skip()
+        return 1
+
+    def _mulwf(self, x):
+        product = self.read(self._address(x)) * self.ram[_WREG]
+        self.ram[_PRODL] = product & 0xff
+        self.ram[_PRODH] = product >> 8
+        return 1
+
+    def _cpfslt(self, x):
+        if self.read(self._address(x)) < self.ram[_WREG]:
+            return 1 + self._skip()
+        return 1
+
+    def _cpfseq(self, x):
+        if self.read(self._address(x)) == self.ram[_WREG]:
+            return 1 + self._skip()
+        return 1
+
+    def _cpfsgt(self, x):
+        if self.read(self._address(x)) > self.ram[_WREG]:
+            return 1 + self._skip()
+        return 1
+
+    def _tstfsz(self, x):
+        if not self.read(self._address(x)):
+            return 1 + self._skip()
+        return 1
+
+    def _setf(self, x):
+        self.write(self._address(x), 0xff)
+        return 1
+
+    def _clrf(self, x):
+        self.write(self._address(x), 0)
+        self.ram[_STATUS] = (self.ram[_STATUS] & ~_N) | _Z
+        return 1
+
+    def _negf(self, x):
+        address = self._operand(x)
+        self.write(address, self._sub(0, self.read(address)))
+        return 1
+
+    def _movwf(self, x):
+        self.write(self._address(x), self.ram[_WREG])
+        return 1
+
+    def _btg(self, x, bit):
+        address = self._operand(x)
+        self.write(address, self.read(address) ^ bit)
+        return 1
+
+    def _bsf(self, x, bit):
+        address = self._operand(x)
+        self.write(address, self.read(address) | bit)
+        return 1
+
+    def _bcf(self, x, bit):
+        address = self._operand(x)
+        self.write(address, self.read(address) & ~bit)
+        return 1
+
+    def _btfss(self, x, bit):
+        if self.read(self._address(x)) & bit:
+            return 1 + self._skip()
+        return 1
+
+    def _btfsc(self, x, bit):
+        if not self.read(self._address(x)) & bit:
+            return 1 + self._skip()
+        return 1
+
+    def _movff(self, source, dest):
+        self.write(dest, self.read(source))
+        return 2
+
+    def _bra(self, target):
+        self.pc = target
+        return 2
+
+    def _rcall(self, target):
+        self._push(self.pc)
+        self.pc = target
+        return 2
+
+    def _condbranch(self, condition, target):
+        if condition(self.ram[_STATUS]):
+            self.pc = target
+            return 2
+        return 1
+
+    def _call(self, target, fast):
+        if fast:
+            self._shadow = (self.ram[_WREG], self.ram[_STATUS],
+                self.ram[_BSR])
+        self._push(self.pc)
+        self.pc = target
+        return 2
+
+    def _goto(self, target):
+        self.pc = target
+        return 2
+
+    def _return(self, fast):
+        self.pc = self._pop()
+        if fast:
+            self.ram[_WREG], self.ram[_STATUS], self.ram[_BSR] = self._shadow
+        return 2
+
+    def _retfie(self, fast):
+        return self._return(fast)
+
+    def _lfsr(self, fsr, value):
+        self.ram[fsr] = value & 0xff
+        self.ram[fsr + 1] = value >> 8
+        return 2
+
+    def _movlb(self, k):
+        self.ram[_BSR] = k
+        return 1
+
+    def _sublw(self, k):
+        self.ram[_WREG] = self._sub(k, self.ram[_WREG])
+        return 1
+
+    def _iorlw(self, k):
+        self.ram[_WREG] |= k
+        self._setflags(self.ram[_WREG], _Z | _N)
+        return 1
+
+    def _xorlw(self, k):
+        self.ram[_WREG] ^= k
+        self._setflags(self.ram[_WREG], _Z | _N)
+        return 1
+
+    def _andlw(self, k):
+        self.ram[_WREG] &= k
+        self._setflags(self.ram[_WREG], _Z | _N)
+        return 1
+
+    def _retlw(self, k):
+        self.ram[_WREG] = k
+        self.pc = self._pop()
+        return 2
+
+    def _mullw(self, k):
+        product = k * self.ram[_WREG]
+        self.ram[_PRODL] = product & 0xff
+        self.ram[_PRODH] = product >> 8
+        return 1
+
+    def _movlw(self, k):
+        self.ram[_WREG] = k
+        return 1
+
+    def _addlw(self, k):
+        self.ram[_WREG] = self._add(self.ram[_WREG], k)
+        return 1
+
+    def _nop(self):
+        return 1
+
+    def _sleep(self):
+        self.halted = True
+        return 1
+
+    def _reset(self):
+        self.pc = 0
+        self.stack = []
+        self.halted = True
+        return 1
+
+    def _clrwdt(self):
+        return 1
+
+    def _push_(self):
+        self._push(self.pc)
+        return 1
+
+    def _pop_(self):
+        self._pop()
+        return 1
+
+    def _daw(self):
+        w = self.ram[_WREG]
+        status = self.ram[_STATUS]
+        if w & 0xf > 9 or status & _DC:
+            w += 6
+        if w >> 4 > 9 or status & _C or w > 0xff:
+            w += 0x60
+        status &= ~_C
+        if w > 0xff:
+            status |= _C
+        self.ram[_STATUS] = status
+        self.ram[_WREG] = w & 0xff
+        return 1
+
+    def _table(self, write, step, pre):
+        '''Runs a table read or write, incrementing the pointer by step
+        before (if pre) or after the access.'''
+        pointer = (self.ram[_TBLPTRL + 2] << 16 | self.ram[_TBLPTRL + 1] << 8
+            | self.ram[_TBLPTRL])
+        if pre:
+            pointer += step
+        if not write:
+            self.ram[_TABLAT] = (self.flash[pointer]
+                if pointer < len(self.flash) else 0xff)
+        if not pre:
+            pointer += step
+        pointer &= 0x3fffff
+        self.ram[_TBLPTRL] = pointer & 0xff
+        self.ram[_TBLPTRL + 1] = (pointer >> 8) & 0xff
+        self.ram[_TBLPTRL + 2] = pointer >> 16
+        return 2
+
+    def _tblrd(self):
+        return self._table(False, 0, False)
+
+    def _tblrd_postinc(self):
+        return self._table(False, 1, False)
+
+    def _tblrd_postdec(self):
+        return self._table(False, -1, False)
+
+    def _tblrd_preinc(self):
+        return self._table(False, 1, True)
+
+    # The writes to the Flash are not simulated, only the pointer moves
+
+    def _tblwt(self):
+        return self._table(True, 0, False)
+
+    def _tblwt_postinc(self):
+        return self._table(True, 1, False)
+
+    def _tblwt_postdec(self):
+        return self._table(True, -1, False)
+
+    def _tblwt_preinc(self):
+        return self._table(True, 1, True)
+
+# Mnemonics that aren't valid method names
+_NAMES = {
+    'push': 'push_',
+    'pop': 'pop_',
+    'tblrd*': 'tblrd',
+    'tblrd*+': 'tblrd_postinc',
+    'tblrd*-': 'tblrd_postdec',
+    'tblrd+*': 'tblrd_preinc',
+    'tblwt*': 'tblwt',
+    'tblwt*+': 'tblwt_postinc',
+    'tblwt*-': 'tblwt_postdec',
+    'tblwt+*': 'tblwt_preinc',
+}
+
+def _rotate(f, left, carry=None):
+    '''Rotates a byte, through carry if carry is not None.
+
+    Returns the result and the bit shifted out.
+    '''
+    if left:
+        out = f >> 7
+        inbit = out if carry is None else carry
+        return ((f << 1) | inbit) & 0xff, out
+    out = f & 1
+    inbit = out if carry is None else carry
+    return (f >> 1) | (inbit << 7), out
+
+def _logic(sim, result):
+    sim._setflags(result, _Z | _N)
+    return result
+
+def _rlcf(sim, f, w):
+    result, out = _rotate(f, True, sim._carry())
+    sim._setflags(result, _Z | _N | _C)
+    sim.ram[_STATUS] |= out
+    return result
+
+def _rrcf(sim, f, w):
+    result, out = _rotate(f, False, sim._carry())
+    sim._setflags(result, _Z | _N | _C)
+    sim.ram[_STATUS] |= out
+    return result
+
+def _rlncf(sim, f, w):
+    return _logic(sim, _rotate(f, True)[0])
+
+def _rrncf(sim, f, w):
+    return _logic(sim, _rotate(f, False)[0])
+
+# Operations of the instructions with file register, destination and access
+# bit. Each one takes the simulator, the register and W and returns the
+# result
+_FDA_OPS = {
+    'decf': lambda sim, f, w: sim._sub(f, 1),
+    'iorwf': lambda sim, f, w: _logic(sim, f | w),
+    'andwf': lambda sim, f, w: _logic(sim, f & w),
+    'xorwf': lambda sim, f, w: _logic(sim, f ^ w),
+    'comf': lambda sim, f, w: _logic(sim, ~f & 0xff),
+    'addwfc': lambda sim, f, w: sim._add(f, w, sim._carry()),
+    'addwf': lambda sim, f, w: sim._add(f, w),
+    'incf': lambda sim, f, w: sim._add(f, 1),
+    'decfsz': lambda sim, f, w: (f - 1) & 0xff,
+    'rrcf': _rrcf,
+    'rlcf': _rlcf,
+    'swapf': lambda sim, f, w: ((f << 4) | (f >> 4)) & 0xff,
+    'incfsz': lambda sim, f, w: (f + 1) & 0xff,
+    'rrncf': _rrncf,
+    'rlncf': _rlncf,
+    'infsnz': lambda sim, f, w: (f + 1) & 0xff,
+    'dcfsnz': lambda sim, f, w: (f - 1) & 0xff,
+    'movf': lambda sim, f, w: _logic(sim, f),
+    'subfwb': lambda sim, f, w: sim._sub(w, f, 1 - sim._carry()),
+    'subwfb': lambda sim, f, w: sim._sub(f, w, 1 - sim._carry()),
+    'subwf': lambda sim, f, w: sim._sub(f, w),
+}
+
+# The skip instructions of _FDA_OPS: True if they skip when the result is
+# zero, False if they skip when it isn't
+_FDA_SKIPS = {'decfsz': True, 'incfsz': True, 'infsnz': False,
+    'dcfsnz': False}
+
+# Conditions of the conditional branches, on the STATUS register
+_CONDITIONS = {
+    'bz': lambda s: s & _Z,
+    'bnz': lambda s: not s & _Z,
+    'bc': lambda s: s & _C,
+    'bnc': lambda s: not s & _C,
+    'bov': lambda s: s & _OV,
+    'bnov': lambda s: not s & _OV,
+    'bn': lambda s: s & _N,
+    'bnn': lambda s: not s & _N,
+}
+
+def loadhex(filename, labels=None, access=_DEFAULT_ACCESS):
+    '''Returns a Simulator for the program in a HEX file.'''
+    import intelhex
+    return Simulator(intelhex.IntelHex(filename), labels, access)
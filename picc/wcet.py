@@ -0,0 +1,430 @@
+'''Estimate the cycles taken by the functions of a linked program.
+
+The code is split in functions at the external and static symbols. Each
+function is split in basic blocks at the jumps, branches and skips, and the
+minimum and maximum number of cycles from its entry to its returns are the
+shortest and the longest paths of the graph of blocks. The calls add the
+cycles of the called function, that is analysed only once.
+
+The loops need a bound, the maximum number of times their back jump is
+taken, or the maximum cycles of their function are unbounded.
+
+Copyright 2016 Antonio Serrano Hernandez
+
+This file is part of picc.
+
+picc is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+picc is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with picc; see the file COPYING.  If not, see
+<http://www.gnu.org/licenses/>.
+'''
+
+import bisect
+from . import coff, disasm, error
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright (C) 2016 Antonio Serrano Hernandez'
+__version__ = '0.2.2'
+__license__ = 'GPL'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+_PCL = 0xf9
+_PCL_ADDRESS = 0xff9
+
+_RETURNS = ('return', 'retlw', 'retfie')
+_STOPS = ('sleep', 'reset')
+_JUMPS = ('bra', 'goto')
+_CALLS = ('call', 'rcall')
+_CONDBRANCHES = ('bz', 'bnz', 'bc', 'bnc', 'bov', 'bnov', 'bn', 'bnn')
+_SKIPS = ('cpfseq', 'cpfsgt', 'cpfslt', 'tstfsz', 'decfsz', 'incfsz',
+    'dcfsnz', 'infsnz', 'btfsc', 'btfss')
+# Instructions that take two cycles, besides the jumps, calls and returns
+_TWO_CYCLES = ('movff', 'lfsr', 'tblrd*', 'tblrd*+', 'tblrd*-', 'tblrd+*',
+    'tblwt*', 'tblwt*+', 'tblwt*-', 'tblwt+*')
+# Instructions with a file register operand that write it
+_WRITES = ('movwf', 'clrf', 'setf', 'negf', 'bsf', 'bcf', 'btg')
+
+class FunctionCost(object):
+    '''The cycles taken by a function.'''
+
+    def __init__(self, name, address):
+        self.name = name
+        self.address = address
+        self.mincycles = 0
+        # None if unbounded
+        self.maxcycles = 0
+        # Reasons why the maximum is unbounded
+        self.notes = []
+
+    def unbounded(self, note):
+        self.maxcycles = None
+        if note not in self.notes:
+            self.notes.append(note)
+
+class _Block(object):
+    '''A basic block: instructions that run one after the other.'''
+
+    def __init__(self, address):
+        self.address = address
+        self.mincycles = 0
+        self.maxcycles = 0
+        # Tuples (block address or None for the exit of the function,
+        # minimum and maximum cycles of the edge)
+        self.edges = []
+
+def _writespcl(instruction):
+    '''Tells if an instruction writes the PCL (a computed jump).'''
+    word = instruction.words[0]
+    mnemonic = instruction.mnemonic
+    if mnemonic == 'movff':
+        return instruction.words[1] & 0xfff == _PCL_ADDRESS
+    entry = disasm._gettable()[word]
+    if entry is None or word & 0x1ff != _PCL:
+        return False
+    if entry[1] == disasm._FDA:
+        return bool(word & 0x200)
+    return mnemonic in _WRITES
+
+class Analyzer(object):
+    '''Analyses the functions of linked objects.'''
+
+    def __init__(self, objects, bounds=None):
+        '''Creates the analyzer.
+
+        objects: the linked Coff objects.
+        bounds: dictionary from the program address of the first
+            instruction of each loop (the target of its back jump) to the
+            maximum number of times the back jump is taken.
+        '''
+        self.bounds = bounds or {}
+        self._instructions = {}
+        # Start, end and name of each function, sorted by start
+        self._functions = []
+        for o in objects:
+            for s in o.sections[1:]:
+                if not s.iscode() or not s.size:
+                    continue
+                for i in disasm.decode(s.data, s.paddress):
+                    self._instructions[i.address] = i
+                starts = {}
+                for sym in o.symbols:
+                    if (isinstance(sym, coff.Symbol) and sym.section is s
+                            and sym.storage_class in
+                            (coff._C_EXT, coff._C_STAT)):
+                        address = sym.value
+                        if not s.isabsolute():
+                            address += s.paddress
+                        starts.setdefault(address, sym.name)
+                starts.setdefault(s.paddress, s.name)
+                addresses = sorted(starts)
+                ends = addresses[1:] + [s.paddress + s.size]
+                for start, end in zip(addresses, ends):
+                    self._functions.append((start, end, starts[start]))
+        self._functions.sort()
+        self._starts = [f[0] for f in self._functions]
+        # Results by entry address
+        self._results = {}
+        self._active = set()
+
+    def _function(self, address):
+        '''Returns the start, end and name of the function of an address.'''
+        i = bisect.bisect_right(self._starts, address) - 1
+        if i < 0 or address >= self._functions[i][1]:
+            return None
+        return self._functions[i]
+
+    def functions(self):
+        '''Analyses all the functions.
+
+        Returns a list of FunctionCost, the most expensive first.
+        '''
+        costs = [self.cost(f[0]) for f in self._functions]
+        costs.sort(key=lambda c: (c.maxcycles is not None,
+            -(c.maxcycles or 0), -c.mincycles, c.name))
+        return costs
+
+    def cost(self, address):
+        '''Returns the FunctionCost of the code that starts at address.'''
+        result = self._results.get(address)
+        if result is None:
+            self._active.add(address)
+            result = self._analyse(address)
+            self._active.discard(address)
+            self._results[address] = result
+        return result
+
+    def _callcost(self, result, address):
+        '''Returns the minimum and maximum cycles of a call to address.'''
+        if address in self._active:
+            result.unbounded('recursion through {:#08x}'.format(address))
+            return 0, 0
+        if self._function(address) is None:
+            result.unbounded('call to {:#08x}, out of the code'.format(
+                address))
+            return 0, 0
+        callee = self.cost(address)
+        if callee.maxcycles is None:
+            result.unbounded('calls {}, unbounded'.format(callee.name))
+            return callee.mincycles, 0
+        return callee.mincycles, callee.maxcycles
+
+    def _analyse(self, entry):
+        function = self._function(entry)
+        name = function[2]
+        if entry != function[0]:
+            name = '{}+{:#x}'.format(name, entry - function[0])
+        result = FunctionCost(name, entry)
+        blocks = self._blocks(result, entry, function[1])
+        order, backedges = _dfs(blocks, entry)
+        # The minimum doesn't repeat the loops
+        result.mincycles = _longest(blocks, order, entry, False)
+        extra = {}
+        for header, (body, latches) in _loops(blocks, order, backedges):
+            bound = self.bounds.get(header)
+            if bound is None:
+                result.unbounded('loop at {:#08x} without bound'.format(
+                    header))
+                continue
+            dist = _distances(blocks, order, header, body, extra)
+            iteration = max(dist.get(u, 0) + c for u, c in latches)
+            extra[header] = bound * iteration
+        if result.maxcycles is not None:
+            result.maxcycles = _longest(blocks, order, entry, True, extra)
+        return result
+
+    def _blocks(self, result, entry, end):
+        '''Builds the basic blocks of a function.
+
+        Returns a dictionary from address to _Block with the blocks reached
+        from entry.
+        '''
+        # The blocks start at the entry and at the targets of the jumps,
+        # branches and skips
+        leaders = set([entry])
+        address = entry
+        while address < end:
+            i = self._instructions.get(address)
+            if i is None or i.mnemonic is None:
+                break
+            following = address + i.size
+            if (i.mnemonic in _JUMPS or i.mnemonic in _CONDBRANCHES) and (
+                    i.target is not None and entry <= i.target < end):
+                leaders.add(i.target)
+            if i.mnemonic in _CONDBRANCHES or i.mnemonic in _SKIPS:
+                leaders.add(following)
+            if i.mnemonic in _SKIPS:
+                skipped = self._instructions.get(following)
+                leaders.add(following + (skipped.size if skipped else 2))
+            address = following
+        blocks = {}
+        pending = [entry]
+        while pending:
+            address = pending.pop()
+            if address in blocks:
+                continue
+            block = blocks[address] = _Block(address)
+            while True:
+                i = self._instructions.get(address)
+                if i is None or i.mnemonic is None:
+                    result.unbounded('no valid instruction at {:#08x}'.format(
+                        address))
+                    block.edges.append((None, 0, 0))
+                    break
+                following = address + i.size
+                mnemonic = i.mnemonic
+                cycles = 2 if (mnemonic in _TWO_CYCLES or mnemonic in _RETURNS
+                    or mnemonic in _JUMPS or mnemonic in _CALLS) else 1
+                block.mincycles += cycles
+                block.maxcycles += cycles
+                if mnemonic in _CALLS:
+                    low, high = self._callcost(result, i.target)
+                    block.mincycles += low
+                    block.maxcycles += high
+                inside = i.target is not None and entry <= i.target < end
+                if mnemonic in _RETURNS or mnemonic in _STOPS:
+                    block.edges.append((None, 0, 0))
+                    break
+                elif _writespcl(i):
+                    result.unbounded('computed jump at {:#08x}'.format(
+                        address))
+                    block.edges.append((None, 0, 0))
+                    break
+                elif mnemonic in _JUMPS or mnemonic in _CONDBRANCHES:
+                    taken = 1 if mnemonic in _CONDBRANCHES else 0
+                    if inside:
+                        block.edges.append((i.target, taken, taken))
+                        pending.append(i.target)
+                    else:
+                        # A jump out of the function ends in the function
+                        # of the target
+                        low, high = self._callcost(result, i.target)
+                        block.edges.append((None, low + taken,
+                            high + taken))
+                    if taken:
+                        block.edges.append((following, 0, 0))
+                        pending.append(following)
+                    break
+                elif mnemonic in _SKIPS:
+                    skipped = self._instructions.get(following)
+                    over = following + (skipped.size if skipped else 2)
+                    words = (over - following) // 2
+                    block.edges.append((following, 0, 0))
+                    block.edges.append((over, words, words))
+                    pending.extend([following, over])
+                    break
+                elif following >= end:
+                    # Runs into the next function
+                    low, high = self._callcost(result, following)
+                    block.edges.append((None, low, high))
+                    break
+                address = following
+                if address in leaders:
+                    block.edges.append((address, 0, 0))
+                    pending.append(address)
+                    break
+        return blocks
+
+def _dfs(blocks, entry):
+    '''Returns the blocks in topological order without the back edges and
+    the set of back edges (source, target).'''
+    order = []
+    backedges = set()
+    state = {entry: 1}
+    stack = [(entry, iter(blocks[entry].edges))]
+    while stack:
+        address, edges = stack[-1]
+        for target, low, high in edges:
+            if target is None or target not in blocks:
+                continue
+            if state.get(target) == 1:
+                backedges.add((address, target))
+            elif target not in state:
+                state[target] = 1
+                stack.append((target, iter(blocks[target].edges)))
+                break
+        else:
+            stack.pop()
+            state[address] = 2
+            order.append(address)
+    order.reverse()
+    return order, backedges
+
+def _loops(blocks, order, backedges):
+    '''Returns the loops, the innermost first.
+
+    Returns a list of tuples (header, (body, latches)), with body the set of
+    blocks of the loop and latches a list of tuples (block, cycles of the
+    back edge).
+    '''
+    predecessors = {}
+    for address in order:
+        for target, low, high in blocks[address].edges:
+            if target is not None:
+                predecessors.setdefault(target, []).append(address)
+    loops = {}
+    for source, header in backedges:
+        body, latches = loops.setdefault(header, (set([header]), []))
+        for target, low, high in blocks[source].edges:
+            if target == header:
+                latches.append((source, high))
+        pending = [source]
+        while pending:
+            b = pending.pop()
+            if b not in body:
+                body.add(b)
+                pending.extend(predecessors.get(b, []))
+    return sorted(loops.items(), key=lambda l: len(l[1][0]))
+
+def _distances(blocks, order, header, body, extra):
+    '''Returns the maximum cycles from the start of a loop to the end of
+    each block of its body, in one iteration.'''
+    position = dict((a, i) for i, a in enumerate(order))
+    dist = {header: blocks[header].maxcycles}
+    for address in order[position[header]:]:
+        if address not in dist:
+            continue
+        for target, low, high in blocks[address].edges:
+            if (target not in body
+                    or position[target] <= position[address]):
+                continue
+            d = (dist[address] + high + blocks[target].maxcycles
+                + extra.get(target, 0))
+            dist[target] = max(dist.get(target, d), d)
+    return dist
+
+def _longest(blocks, order, entry, maximum, extra=None):
+    '''Returns the longest (or shortest) path from entry to the exit.
+
+    The back edges are not followed. extra are the cycles added to the loop
+    headers for their repetitions.
+    '''
+    extra = extra or {}
+    position = dict((a, i) for i, a in enumerate(order))
+    best = max if maximum else min
+    dist = {entry: (blocks[entry].maxcycles if maximum
+        else blocks[entry].mincycles) + extra.get(entry, 0)}
+    exits = []
+    for address in order:
+        if address not in dist:
+            continue
+        for target, low, high in blocks[address].edges:
+            edge = high if maximum else low
+            if target is None:
+                exits.append(dist[address] + edge)
+                continue
+            if target not in position or position[target] <= position[
+                    address]:
+                continue
+            block = blocks[target]
+            d = (dist[address] + edge + (block.maxcycles if maximum
+                else block.mincycles) + (extra.get(target, 0) if maximum
+                else 0))
+            dist[target] = best(dist.get(target, d), d)
+    return best(exits) if exits else 0
+
+def readbounds(filename, labels):
+    '''Reads the bounds of the loops from a file.
+
+    Each line of the file has the location of the first instruction of a
+    loop (an address, a symbol or a symbol plus an offset, like loop+0x4)
+    and the maximum number of times the loop jumps back. The text after a #
+    is a comment.
+    labels: dictionary from program address to the names of the symbols at
+        that address (see disasm.programlabels).
+    Returns a dictionary from address to bound.
+    '''
+    addresses = {}
+    for address, names in labels.items():
+        for name in names:
+            addresses[name] = address
+    bounds = {}
+    with open(filename) as f:
+        for linenum, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                location, bound = line.split()
+                name, _, offset = location.partition('+')
+                if name in addresses:
+                    address = addresses[name]
+                else:
+                    address = int(name, 0)
+                if offset:
+                    address += int(offset, 0)
+                bounds[address] = int(bound, 0)
+            except ValueError:
+                error.fatalf(filename, "line {}: expected a location and a "
+                    "bound, got '{}'".format(linenum, line))
+    return bounds
@@ -15,7 +15,7 @@ setup(name=PKGNAME,
       license='GPLv3',
       requires=['intelhex'],
       packages=['picc'],
-      scripts=['bin/picc', 'bin/picc-objdump'],
+      scripts=['bin/picc', 'bin/picc-objdump', 'bin/picc-index'],
       data_files=[(os.path.join(DATAROOTDIR, PKGNAME),
           ['data/processors.xml'])],
      )
@@ -0,0 +1,108 @@
+'''Builds small COFF objects for the tests.'''
+
+import io
+import struct
+
+from picc import coff, linker
+
+# Section flags
+TEXT = 0x20
+BSS = 0x80
+ABS = 0x1000
+OVR = 0x4000
+
+# Storage classes of the symbols
+EXTERNAL = 2
+SECTION = 109
+
+# Relocation types
+CALL = 1
+F = 10
+CONDBRA = 20
+
+# Processor 18f26j13
+_PROCESSOR = 0xd616
+
+def words(*values):
+    '''Returns the bytes of some instruction words.'''
+    return b''.join(struct.pack('<H', v) for v in values)
+
+def _name(name, strings):
+    if len(name) <= 8:
+        return name.encode().ljust(8, b'\0')
+    offset = 4 + len(strings)
+    strings.extend(name.encode() + b'\0')
+    return struct.pack('<LL', 0, offset)
+
+def build(sections, symbols):
+    '''Returns the contents of a COFF object.
+
+    sections: list of dictionaries with the keys 'name', 'flags' and
+        optionally 'address', 'data' (the contents), 'size' (if there's no
+        data) and 'relocations' (tuples (offset, symbol index, addend,
+        type)).
+    symbols: list of tuples (name, value, section number, class). The
+        section numbers start at 1, 0 is for the undefined symbols.
+    '''
+    strings = bytearray()
+    position = 20 + 18 + 40 * len(sections)
+    # Where the data and the relocations of each section start
+    datapointers = []
+    for s in sections:
+        datapointers.append(position)
+        position += len(s.get('data', b''))
+    relpointers = []
+    for s in sections:
+        relpointers.append(position)
+        position += 12 * len(s.get('relocations', []))
+    headers = b''
+    for s, d, r in zip(sections, datapointers, relpointers):
+        size = len(s['data']) if 'data' in s else s['size']
+        headers += struct.pack('<8sLLLLLLHHL', _name(s['name'], strings),
+            s.get('address', 0), s.get('address', 0), size, d, r, 0,
+            len(s.get('relocations', [])), 0, s['flags'])
+    table = b''.join(struct.pack('<8sLhHHBB', _name(n, strings), value,
+        number, 0, 0, cls, 0) for n, value, number, cls in symbols)
+    out = struct.pack('<HHLLLHH', 0x1240, len(sections), 0, position,
+        len(symbols), 18, 0)
+    out += struct.pack('<HHxxHLLxx', 0x5678, 1, _PROCESSOR, 16, 8)
+    out += headers + b''.join(s.get('data', b'') for s in sections)
+    for s in sections:
+        for r in s.get('relocations', []):
+            out += struct.pack('<LLhH', *r)
+    out += table + struct.pack('<l', 4 + len(strings) + 1) + bytes(strings)
+    return out + b'\0'
+
+def read(data, filename='test.o'):
+    '''Returns the Coff object with the given contents.'''
+    f = io.BytesIO(data)
+    f.name = filename
+    return coff.readcoff(f)
+
+def link(*files, **options):
+    '''Links the contents of some COFF objects.
+
+    Returns the IntelHex object and the linked Coff objects.
+    '''
+    objects = [read(d, 'test{}.o'.format(i)) for i, d in enumerate(files)]
+    return linker.link(objects, **options), objects
+
+def address(objects, name):
+    '''Returns the address of a symbol of the linked objects.'''
+    for o in objects:
+        for s in o.symbols:
+            if (isinstance(s, coff.Symbol) and s.name == name
+                    and s.isdefined()):
+                value = s.value
+                if not s.section.isabsolute():
+                    value += s.section.paddress
+                return value
+    raise KeyError(name)
+
+def section(objects, name):
+    '''Returns the first section with a name of the linked objects.'''
+    for o in objects:
+        for s in o.sections[1:]:
+            if s.name == name:
+                return s
+    raise KeyError(name)
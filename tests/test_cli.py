@@ -0,0 +1,135 @@
+'''Tests of the picc command.'''
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import intelhex
+
+import coffgen
+from coffgen import words
+
+_PICC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin',
+    'picc')
+
+def _program(*values):
+    '''Returns an object with a relocatable code section and a call to it.'''
+    return coffgen.build(
+        [{'name': 'main', 'flags': coffgen.TEXT,
+          'data': words(0xec00, 0xf000, 0x0003),
+          'relocations': [(0, 2, 0, coffgen.CALL)]},
+         {'name': 'func', 'flags': coffgen.TEXT, 'data': words(*values)}],
+        [('main', 0, 1, coffgen.EXTERNAL), ('.func', 0, 2, coffgen.SECTION),
+         ('func', 0, 2, coffgen.EXTERNAL)])
+
+class CommandTestCase(unittest.TestCase):
+    '''Runs picc in a temporary directory.'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def write(self, filename, data):
+        with open(self.path(filename), 'wb') as f:
+            f.write(data)
+
+    def contents(self, filename):
+        with open(self.path(filename), 'rb') as f:
+            return f.read()
+
+    def picc(self, *args):
+        '''Runs picc and returns its standard error.'''
+        process = subprocess.Popen([sys.executable, _PICC] + list(args),
+            cwd=self.directory, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        _, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0, stderr)
+        return stderr
+
+class CacheTestCase(CommandTestCase):
+    '''The programs taken from the cache are the ones linked.'''
+
+    def test_hit(self):
+        self.write('a.o', _program(0x0012))
+        self.picc('a.o', '-o', 'plain.hex')
+        self.picc('a.o', '-o', 'first.hex', '--cache-dir', 'cache')
+        stderr = self.picc('a.o', '-o', 'second.hex', '--cache-dir', 'cache',
+            '--timings')
+        # The second program is copied, not linked
+        self.assertIn('copy:', stderr)
+        self.assertNotIn('link:', stderr)
+        self.assertEqual(self.contents('first.hex'),
+            self.contents('plain.hex'))
+        self.assertEqual(self.contents('second.hex'),
+            self.contents('plain.hex'))
+
+    def test_miss(self):
+        self.write('a.o', _program(0x0012))
+        self.picc('a.o', '-o', 'first.hex', '--cache-dir', 'cache')
+        self.write('a.o', _program(0x0000, 0x0012))
+        self.picc('a.o', '-o', 'plain.hex')
+        stderr = self.picc('a.o', '-o', 'second.hex', '--cache-dir', 'cache',
+            '--timings')
+        self.assertIn('link:', stderr)
+        self.assertEqual(self.contents('second.hex'),
+            self.contents('plain.hex'))
+        self.assertNotEqual(self.contents('second.hex'),
+            self.contents('first.hex'))
+
+def _image(changed=None):
+    '''Returns an object with 3000 bytes of code at address 0.
+
+    changed: if given, the address of the instruction that is changed.
+    '''
+    values = [0x0000] * 1500
+    if changed is not None:
+        values[changed // 2] = 0x0012
+    return coffgen.build(
+        [{'name': 'code', 'flags': coffgen.TEXT | coffgen.ABS, 'address': 0,
+          'data': words(*values)}],
+        [('code', 0, 1, coffgen.EXTERNAL)])
+
+class DeltaTestCase(CommandTestCase):
+    '''The delta has the erase pages that changed.'''
+
+    def _delta(self, changed):
+        self.write('a.o', _image())
+        self.picc('a.o', '-o', 'old.hex')
+        self.write('a.o', _image(changed))
+        self.picc('a.o', '-o', 'new.hex', '--delta-from', 'old.hex',
+            '--erase-page', '1024')
+        with open(self.path('new.delta.hex.json')) as f:
+            manifest = json.load(f)
+        new = intelhex.IntelHex(self.path('new.hex'))
+        delta = intelhex.IntelHex(self.path('new.delta.hex'))
+        return manifest, new, delta
+
+    def test_page(self):
+        manifest, new, delta = self._delta(1500)
+        self.assertEqual(manifest['pagesize'], 1024)
+        self.assertEqual([p['address'] for p in manifest['pages']], [1024])
+        # The whole page is written, and nothing else
+        self.assertEqual(delta.minaddr(), 1024)
+        self.assertEqual(delta.maxaddr(), 2047)
+        self.assertEqual(delta.tobinarray(1024, 2047),
+            new.tobinarray(1024, 2047))
+        self.assertEqual(delta[1500], 0x12)
+
+    def test_last_page(self):
+        # The bytes after the program are written erased
+        manifest, new, delta = self._delta(2998)
+        self.assertEqual([p['address'] for p in manifest['pages']], [2048])
+        self.assertEqual(delta[2998], 0x12)
+        self.assertEqual(list(delta.tobinarray(3000, 4095)), [0xff] * 1096)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+'''Tests of the placement and relocation of the linked sections.'''
+
+import unittest
+
+from picc import error
+
+import coffgen
+from coffgen import words
+
+# BZ with no offset, to be relocated
+_BZ = 0xe000
+_NOP = 0x0000
+_RETURN = 0x0012
+
+def _far():
+    '''Returns an object with the absolute function far at 0x8000.'''
+    return coffgen.build(
+        [{'name': 'farc', 'flags': coffgen.TEXT | coffgen.ABS,
+          'address': 0x8000, 'data': words(_RETURN)}],
+        [('far', 0x8000, 1, coffgen.EXTERNAL)])
+
+def _branches(before, after):
+    '''Returns an object with a section with two branches to far.
+
+    before, after: number of NOPs before and after the first branch. The
+        second branch is the last instruction.
+    '''
+    data = words(*([_NOP] * before + [_BZ] + [_NOP] * after + [_BZ]))
+    return coffgen.build(
+        [{'name': 'big', 'flags': coffgen.TEXT, 'data': data,
+          'relocations': [(2 * before, 1, 0, coffgen.CONDBRA),
+                          (len(data) - 2, 1, 0, coffgen.CONDBRA)]}],
+        [('big', 0, 1, coffgen.EXTERNAL), ('far', 0, 0, coffgen.EXTERNAL)])
+
+def _word(h, address):
+    return h[address] | h[address + 1] << 8
+
+class RelaxationTestCase(unittest.TestCase):
+    '''The branches out of range go through trampolines.'''
+
+    def setUp(self):
+        error.errors = 0
+
+    def _target(self, h, address):
+        '''Returns where the BZ at address jumps to.'''
+        offset = _word(h, address) & 0xff
+        if offset & 0x80:
+            offset -= 0x100
+        return address + 2 + 2 * offset
+
+    def _assertgoto(self, h, address, target):
+        self.assertEqual(_word(h, address), 0xef00 | (target >> 1) & 0xff)
+        self.assertEqual(_word(h, address + 2), 0xf000 | target >> 9)
+
+    def test_trampolines(self):
+        h, objects = coffgen.link(_branches(0, 298), _far())
+        self.assertEqual(error.errors, 0)
+        big = coffgen.section(objects, 'big')
+        for offset in (0, 598):
+            branch = big.paddress + offset
+            target = self._target(h, branch)
+            self.assertLessEqual(abs(target - branch - 2), 256)
+            self._assertgoto(h, target, 0x8000)
+
+    def test_no_relax(self):
+        coffgen.link(_branches(0, 298), _far(), relax=False)
+        self.assertEqual(error.errors, 2)
+
+    def test_unreachable(self):
+        # No trampoline can be in range of a branch in the middle of a
+        # section that is too big, the link must end with an error
+        coffgen.link(_branches(300, 299), _far())
+        self.assertEqual(error.errors, 1)
+
+def _shared(name, *values):
+    '''Returns an object with a code section shared and a symbol at it.'''
+    return coffgen.build(
+        [{'name': 'shared', 'flags': coffgen.TEXT, 'data': words(*values)},
+         {'name': 'other', 'flags': coffgen.TEXT, 'data': words(_RETURN)}],
+        [(name, 0, 1, coffgen.EXTERNAL)])
+
+class MergeTestCase(unittest.TestCase):
+    '''The sections with the same name go together.'''
+
+    def setUp(self):
+        error.errors = 0
+
+    def test_merge(self):
+        h, objects = coffgen.link(_shared('a', 0x0001, 0x0002),
+            _shared('b', 0x0003))
+        a, b = coffgen.address(objects, 'a'), coffgen.address(objects, 'b')
+        self.assertEqual(b, a + 4)
+        self.assertEqual([_word(h, x) for x in (a, a + 2, b)],
+            [0x0001, 0x0002, 0x0003])
+
+    def test_no_merge(self):
+        h, objects = coffgen.link(_shared('a', 0x0001, 0x0002),
+            _shared('b', 0x0003), merge=False)
+        a, b = coffgen.address(objects, 'a'), coffgen.address(objects, 'b')
+        # The section other of the first object goes between them
+        self.assertEqual(b, a + 6)
+        self.assertEqual(_word(h, b), 0x0003)
+
+def _function(name, *callees):
+    '''Returns an object with a function that calls others and returns.'''
+    data = words(*([0xec00, 0xf000] * len(callees) + [_RETURN]))
+    return coffgen.build(
+        [{'name': name, 'flags': coffgen.TEXT, 'data': data,
+          'relocations': [(4 * i, i + 1, 0, coffgen.CALL)
+                          for i in range(len(callees))]}],
+        [(name, 0, 1, coffgen.EXTERNAL)]
+        + [(c, 0, 0, coffgen.EXTERNAL) for c in callees])
+
+def _called(h, address):
+    '''Returns the address called by the CALL at address.'''
+    return ((_word(h, address) & 0xff) << 1
+        | (_word(h, address + 2) & 0xfff) << 9)
+
+class FoldTestCase(unittest.TestCase):
+    '''The identical code sections are kept once.'''
+
+    def setUp(self):
+        error.errors = 0
+
+    def _link(self, icf):
+        return coffgen.link(_function('main', 'g1', 'g2'),
+            _function('g1', 'f1'), _function('g2', 'f2'), _function('f1'),
+            _function('f2'), icf=icf)
+
+    def test_fold(self):
+        # Once f2 is folded into f1, g2 is the same as g1
+        h, objects = self._link(True)
+        main = coffgen.address(objects, 'main')
+        g = coffgen.address(objects, 'g1')
+        f = coffgen.address(objects, 'f1')
+        self.assertEqual(coffgen.address(objects, 'g2'), g)
+        self.assertEqual(coffgen.address(objects, 'f2'), f)
+        self.assertEqual([_called(h, main), _called(h, main + 4)], [g, g])
+        self.assertEqual(_called(h, g), f)
+        self.assertEqual(sum(len(o.sections) - 1 for o in objects), 3)
+
+    def test_no_fold(self):
+        h, objects = self._link(False)
+        main = coffgen.address(objects, 'main')
+        g1 = coffgen.address(objects, 'g1')
+        g2 = coffgen.address(objects, 'g2')
+        self.assertNotEqual(g1, g2)
+        self.assertEqual([_called(h, main), _called(h, main + 4)], [g1, g2])
+        self.assertEqual(_called(h, g2), coffgen.address(objects, 'f2'))
+
+def _locals(name, size, *callees):
+    '''Returns an object with a function that clears its overlay local
+    variables, calls others and returns.'''
+    data = words(*([0x6a00] + [0xec00, 0xf000] * len(callees) + [_RETURN]))
+    return coffgen.build(
+        [{'name': name, 'flags': coffgen.TEXT, 'data': data,
+          'relocations': [(0, 1, 0, coffgen.F)]
+                         + [(2 + 4 * i, i + 2, 0, coffgen.CALL)
+                            for i in range(len(callees))]},
+         {'name': name + '_l', 'flags': coffgen.BSS | coffgen.OVR,
+          'size': size}],
+        [(name, 0, 1, coffgen.EXTERNAL), (name + '_l', 0, 2, coffgen.EXTERNAL)]
+        + [(c, 0, 0, coffgen.EXTERNAL) for c in callees])
+
+class OverlayTestCase(unittest.TestCase):
+    '''The locals of the functions that don't run at the same time share
+    RAM.'''
+
+    def setUp(self):
+        error.errors = 0
+
+    def _link(self, overlay):
+        h, objects = coffgen.link(_locals('main', 4, 'f1', 'f2'),
+            _locals('f1', 8, 'f3'), _locals('f2', 8), _locals('f3', 8),
+            overlay=overlay)
+        self.assertEqual(error.errors, 0)
+        return dict((name, coffgen.address(objects, name + '_l'))
+            for name in ('main', 'f1', 'f2', 'f3'))
+
+    def _assertapart(self, addresses, *names):
+        ranges = sorted((addresses[n], addresses[n] + (4 if n == 'main'
+            else 8)) for n in names)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertLessEqual(end, start)
+
+    def test_overlay(self):
+        addresses = self._link(True)
+        # f1 and f2 never run at the same time, f3 runs while f1 does
+        self.assertEqual(addresses['f1'], addresses['f2'])
+        self._assertapart(addresses, 'main', 'f1', 'f3')
+        self._assertapart(addresses, 'main', 'f2')
+
+    def test_no_overlay(self):
+        addresses = self._link(False)
+        self._assertapart(addresses, 'main', 'f1', 'f2', 'f3')
+
+def _banked(sizes, used):
+    '''Returns an object with udata sections and a function that clears
+    some of them.
+
+    sizes: the sizes of the udata sections v0, v1...
+    used: the indexes of the sections cleared.
+    '''
+    return coffgen.build(
+        [{'name': 'code', 'flags': coffgen.TEXT,
+          'data': words(*([0x6a00] * len(used) + [_RETURN])),
+          'relocations': [(2 * i, u + 1, 0, coffgen.F)
+                          for i, u in enumerate(used)]}]
+        + [{'name': 'v{}'.format(i), 'flags': coffgen.BSS, 'size': size}
+           for i, size in enumerate(sizes)],
+        [('code', 0, 1, coffgen.EXTERNAL)]
+        + [('v{}'.format(i), 0, i + 2, coffgen.EXTERNAL)
+           for i in range(len(sizes))])
+
+class BankColoringTestCase(unittest.TestCase):
+    '''The udata sections used by the same code go to the same bank.'''
+
+    def setUp(self):
+        error.errors = 0
+
+    def _addresses(self, sizes, used, color_banks):
+        h, objects = coffgen.link(_banked(sizes, used),
+            color_banks=color_banks)
+        return [coffgen.address(objects, 'v{}'.format(i))
+            for i in range(len(sizes))]
+
+    def test_same_bank(self):
+        # As usual, v2 is placed after v1, in another bank than v0
+        sizes = [100, 200, 100]
+        usual = self._addresses(sizes, [0, 2], False)
+        self.assertNotEqual(usual[0] // 256, usual[2] // 256)
+        colored = self._addresses(sizes, [0, 2], True)
+        for i in (0, 2):
+            self.assertEqual(colored[i] // 256, colored[0] // 256)
+            self.assertEqual((colored[i] + 99) // 256, colored[0] // 256)
+
+    def test_worse(self):
+        # Six sections used by the same code can't share a bank, and they
+        # are closer together as usual than spread by bank
+        sizes = [100] * 6
+        self.assertEqual(self._addresses(sizes, range(6), True),
+            self._addresses(sizes, range(6), False))
+
+if __name__ == '__main__':
+    unittest.main()
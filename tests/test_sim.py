@@ -0,0 +1,53 @@
+'''Tests of the PIC18 simulator.'''
+
+import unittest
+
+import intelhex
+
+from picc import sim
+
+def _simulator(*words):
+    '''Returns a simulator running the given instruction words.'''
+    program = intelhex.IntelHex()
+    for i, w in enumerate(words):
+        program[2 * i] = w & 0xff
+        program[2 * i + 1] = w >> 8
+    return sim.Simulator(program)
+
+class IndirectTestCase(unittest.TestCase):
+    '''The indirect addressing of the read-modify-write instructions.'''
+
+    def setUp(self):
+        self.fsr0 = 0x100
+
+    def _run(self, word):
+        s = _simulator(word)
+        s.ram[0xfe9] = self.fsr0 & 0xff
+        s.ram[0xfea] = self.fsr0 >> 8
+        s.ram[0x100] = 5
+        s.run(cycles=1)
+        return s, s.ram[0xfea] << 8 | s.ram[0xfe9]
+
+    def test_incf_postinc(self):
+        # incf POSTINC0, F
+        s, fsr0 = self._run(0x2aee)
+        self.assertEqual(s.ram[0x100], 6)
+        self.assertEqual(s.ram[0x101], 0)
+        self.assertEqual(fsr0, 0x101)
+
+    def test_bsf_postdec(self):
+        # bsf POSTDEC0, 7
+        s, fsr0 = self._run(0x8eed)
+        self.assertEqual(s.ram[0x100], 0x85)
+        self.assertEqual(s.ram[0xff], 0)
+        self.assertEqual(fsr0, 0xff)
+
+    def test_negf_preinc(self):
+        # negf PREINC0
+        s, fsr0 = self._run(0x6cec)
+        self.assertEqual(s.ram[0x101], 0)
+        self.assertEqual(s.ram[0x100], 5)
+        self.assertEqual(fsr0, 0x101)
+
+if __name__ == '__main__':
+    unittest.main()